@@ -1,8 +1,43 @@
+import base64
+
+from django.contrib.postgres.indexes import BTreeIndex
 from django.db import models
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext_lazy as _
 
 
-class ActiveManager(models.Manager):
+def active_index(*fields, name):
+    # A PostgreSQL partial index covering only active rows, for queries made through `actives`.
+    return BTreeIndex(fields=list(fields), condition=Q(is_active=True), name=name)
+
+
+def encode_cursor(obj):
+    value = f'{obj.created_time.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    created_time, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return parse_datetime(created_time), int(pk)
+
+
+class ActiveQuerySet(models.QuerySet):
+    def keyset_page(self, cursor=None, size=25):
+        # Returns a page of rows, newest first, and the cursor of the next page (None on the last one).
+        # Seeking past the cursor instead of using OFFSET makes every page a short range scan of
+        # the active index, however deep it is.
+        queryset = self.order_by('-created_time', '-id')
+        if cursor:
+            created_time, pk = decode_cursor(cursor)
+            queryset = queryset.filter(created_time__lte=created_time).exclude(created_time=created_time, id__gte=pk)
+
+        items = list(queryset[:size + 1])
+        next_cursor = encode_cursor(items[size - 1]) if len(items) > size else None
+        return items[:size], next_cursor
+
+
+class ActiveManager(models.Manager.from_queryset(ActiveQuerySet)):
     def get_queryset(self):
         return super(ActiveManager, self).get_queryset().filter(is_active=True)
 
@@ -17,3 +52,8 @@ class BaseModel(models.Model):
 
     class Meta:
         abstract = True
+        # Subclasses declaring their own indexes should extend these, e.g.
+        # `indexes = [*BaseModel.Meta.indexes, active_index('user', '-created_time', name=...)]`.
+        indexes = [
+            active_index('-created_time', '-id', name='%(class)s_active_idx'),
+        ]
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+
+logger = logging.getLogger('info')
+
+BatchStats = namedtuple('BatchStats', ['size', 'fill_ratio', 'max_queue_wait', 'mean_queue_wait', 'run_time'])
+
+
+class MicroBatcher:
+    # Collects requests submitted from many threads and runs them through `run_batch` together.
+    # A batch is dispatched once it holds `max_batch_size` requests or its oldest request has
+    # waited `max_wait` seconds. Only requests with identical options share a batch.
+    #
+    # `run_batch(prompts, **options)` must return one result per prompt, in order.
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.05, stats_size=1000):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = deque(maxlen=stats_size)
+
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def submit(self, prompt, **options):
+        future = Future()
+        key = tuple(sorted(options.items()))
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('MicroBatcher is closed')
+            self._pending.setdefault(key, deque()).append((prompt, future, time.monotonic()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def close(self, wait=True):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def summary(self):
+        stats = list(self.stats)
+        if not stats:
+            return {'batches': 0}
+        return {
+            'batches': len(stats),
+            'mean_batch_size': sum(s.size for s in stats) / len(stats),
+            'mean_fill_ratio': sum(s.fill_ratio for s in stats) / len(stats),
+            'mean_queue_wait': sum(s.mean_queue_wait for s in stats) / len(stats),
+            'max_queue_wait': max(s.max_queue_wait for s in stats),
+            'mean_run_time': sum(s.run_time for s in stats) / len(stats),
+        }
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._condition.wait()
+                    continue
+
+                # The first key always holds the oldest request.
+                key, queue = next(iter(self._pending.items()))
+                remaining = queue[0][2] + self.max_wait - time.monotonic()
+                if len(queue) < self.max_batch_size and remaining > 0 and not self._closed:
+                    self._condition.wait(remaining)
+                    continue
+
+                batch = []
+                while queue and len(batch) < self.max_batch_size:
+                    request = queue.popleft()
+                    # Skip requests whose callers cancelled them while queued.
+                    if request[1].set_running_or_notify_cancel():
+                        batch.append(request)
+                if not queue:
+                    del self._pending[key]
+                if batch:
+                    return key, batch
+
+    def _run(self):
+        while True:
+            item = self._next_batch()
+            if item is None:
+                return
+
+            key, batch = item
+            started = time.monotonic()
+            waits = [started - enqueued_at for _, _, enqueued_at in batch]
+            try:
+                results = self.run_batch([prompt for prompt, _, _ in batch], **dict(key))
+            except Exception as exc:
+                for _, future, _ in batch:
+                    future.set_exception(exc)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+            stats = BatchStats(
+                size=len(batch),
+                fill_ratio=len(batch) / self.max_batch_size,
+                max_queue_wait=max(waits),
+                mean_queue_wait=sum(waits) / len(waits),
+                run_time=time.monotonic() - started,
+            )
+            self.stats.append(stats)
+            logger.info('Batch of %d (fill %.2f), queue wait mean %.3fs max %.3fs, run %.3fs',
+                        stats.size, stats.fill_ratio, stats.mean_queue_wait, stats.max_queue_wait, stats.run_time)
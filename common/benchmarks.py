@@ -0,0 +1,329 @@
+import io
+import json
+import statistics
+import time
+
+import numpy as np
+
+# Metrics ending in one of these suffixes get better as they grow, all others as they shrink.
+HIGHER_IS_BETTER = ('_per_sec',)
+
+
+def measure(fn, repeat=10, warmup=1):
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return {
+        'median_ms': statistics.median(times),
+        'p95_ms': times[round(0.95 * (len(times) - 1))],
+        'min_ms': times[0],
+    }
+
+
+def tiny_dream_model(layer_count=2, depth=4):
+    # A small CNN standing in for InceptionV3, with the last `layer_count` conv layers as outputs.
+    import tensorflow as tf
+
+    inputs = tf.keras.Input(shape=(None, None, 3))
+    x = inputs
+    outputs = []
+    for i in range(depth):
+        x = tf.keras.layers.Conv2D(16, 3, strides=2 if i % 2 else 1, padding='same', activation='relu',
+                                   name=f'conv{i}')(x)
+        outputs.append(x)
+    return tf.keras.Model(inputs=inputs, outputs=outputs[-layer_count:])
+
+
+def bench_deep_dream_steps(sizes=(128, 256, 512), steps=10, jit_compile=False):
+    import tensorflow as tf
+
+    from common.deep_dream import CompiledDeepDream
+
+    deep_dream = CompiledDeepDream(tiny_dream_model(), jit_compile=jit_compile)
+    results = []
+    for size in sizes:
+        img = tf.random.uniform((size, size, 3), -1, 1)
+        timings = measure(lambda: deep_dream(img, steps, 0.01), repeat=5)
+        results.append({
+            'benchmark': 'deep_dream_steps',
+            'params': {'size': size, 'steps': steps, 'jit_compile': jit_compile},
+            'metrics': {**timings, 'steps_per_sec': steps / (timings['median_ms'] / 1000)},
+        })
+    results.append({
+        'benchmark': 'deep_dream_traces',
+        'params': {'sizes': list(sizes)},
+        'metrics': {'trace_count': deep_dream.trace_count},
+    })
+    return results
+
+
+def bench_deep_dream_batch(batch_sizes=(1, 4, 8), size=128, steps=10, jit_compile=False):
+    # Per image throughput of the batched DeepDream call against one call per image.
+    import tensorflow as tf
+
+    from common.deep_dream import CompiledDeepDream
+
+    deep_dream = CompiledDeepDream(tiny_dream_model(), jit_compile=jit_compile)
+    results = []
+    for batch_size in batch_sizes:
+        imgs = [tf.random.uniform((size, size, 3), -1, 1) for _ in range(batch_size)]
+        for mode, fn in (('single', lambda: [deep_dream(img, steps, 0.01) for img in imgs]),
+                         ('batched', lambda: deep_dream.batch(imgs, steps, 0.01))):
+            timings = measure(fn, repeat=5)
+            results.append({
+                'benchmark': 'deep_dream_batch',
+                'params': {'batch_size': batch_size, 'size': size, 'steps': steps, 'mode': mode},
+                'metrics': {**timings, 'images_per_sec': batch_size / (timings['median_ms'] / 1000)},
+            })
+    return results
+
+
+def bench_dream_models(layer_sets=(('conv2',), ('conv3',), ('conv2', 'conv3'), ('conv1', 'conv3'))):
+    # Building a further layer set on a resident base network should cost next to nothing.
+    from common.deep_dream import DreamModelRegistry
+
+    registry = DreamModelRegistry({'tiny': lambda: tiny_dream_model(layer_count=4)}, jit_compile=False)
+    started = time.perf_counter()
+    registry.base('tiny')
+    base_ms = (time.perf_counter() - started) * 1000
+
+    layer_ms = []
+    for layers in layer_sets:
+        started = time.perf_counter()
+        registry.get('tiny', layers)
+        layer_ms.append((time.perf_counter() - started) * 1000)
+
+    weights = {id(weight) for layers in layer_sets for weight in registry.model('tiny', layers).weights}
+    return [{
+        'benchmark': 'dream_models',
+        'params': {'layer_sets': len(layer_sets)},
+        'metrics': {
+            'base_build_ms': base_ms,
+            'layer_set_median_ms': statistics.median(layer_ms),
+            # Distinct weight variables across every layer set, equal to the base network's.
+            'weight_count': len(weights),
+            'base_weight_count': len(registry.base('tiny').weights),
+        },
+    }]
+
+
+def bench_calc_loss(layer_counts=(1, 2, 3, 4), size=256):
+    import tensorflow as tf
+
+    from common.deep_dream import calc_loss
+
+    img = tf.random.uniform((size, size, 3), -1, 1)
+    results = []
+    for layer_count in layer_counts:
+        model = tiny_dream_model(layer_count=layer_count)
+        loss = tf.function(lambda x: calc_loss(x, model))
+        results.append({
+            'benchmark': 'calc_loss',
+            'params': {'layers': layer_count, 'size': size},
+            'metrics': measure(lambda: loss(img).numpy(), repeat=20),
+        })
+    return results
+
+
+def bench_encode(sizes=(256, 512, 1024), quality=90):
+    from common.encoding import get_encoder
+
+    encoder = get_encoder()
+    results = []
+    for size in sizes:
+        img = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+        timings = measure(lambda: encoder.encode(img, 'JPEG', quality=quality), repeat=10)
+        results.append({
+            'benchmark': 'encode_jpeg',
+            'params': {'size': size, 'quality': quality},
+            'metrics': {**timings, 'images_per_sec': 1000 / timings['median_ms']},
+        })
+    return results
+
+
+def _encode_memory_child(mode, size, results):
+    # Runs in a fresh process so ru_maxrss only reflects this encode path.
+    import resource
+
+    import PIL.Image
+    import tensorflow as tf
+
+    from common.encoding import get_encoder
+    from common.deep_dream import deprocess
+
+    img = tf.random.uniform((size, size, 3), -1, 1)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def encode():
+        if mode == 'copy':
+            buffer = io.BytesIO()
+            PIL.Image.fromarray(np.array(deprocess(img))).save(buffer, format='JPEG')
+        else:
+            get_encoder().encode(img)
+
+    timings = measure(encode, repeat=5)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({**timings, 'peak_rss_delta_kb': peak - baseline})
+
+
+def bench_encode_memory(size=2048):
+    # Compares deprocess + np.array + fromarray against encoding from the tensor buffer.
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for mode in ('copy', 'zero_copy'):
+        queue = context.Queue()
+        process = context.Process(target=_encode_memory_child, args=(mode, size, queue))
+        process.start()
+        metrics = queue.get()
+        process.join()
+        results.append({'benchmark': 'encode_memory', 'params': {'size': size, 'mode': mode}, 'metrics': metrics})
+    return results
+
+
+# What each process type imports before serving its first request or task.
+STARTUP_ENTRY_POINTS = {
+    'manage': 'import django; django.setup(); import_module(settings.ROOT_URLCONF)',
+    'asgi': 'import image_weaver.asgi; import_module(settings.ROOT_URLCONF)',
+    'worker': 'import django; django.setup(); from image_weaver.celery import app; app.loader.import_default_modules()',
+}
+HEAVY_MODULES = ('tensorflow', 'keras', 'keras_cv', 'matplotlib', 'IPython')
+STARTUP_CHILD = """
+import json, os, resource, sys, time
+started = time.perf_counter()
+from importlib import import_module
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_weaver.settings')
+from django.conf import settings
+{code}
+print(json.dumps({{
+    'import_ms': (time.perf_counter() - started) * 1000,
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'heavy_modules': [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def bench_startup(entry_points=tuple(STARTUP_ENTRY_POINTS), repeat=3):
+    # Import time and RSS of each entry point in a fresh interpreter. None of them should load
+    # an ML framework, inference workers do that lazily when the model is first needed.
+    import subprocess
+    import sys
+
+    results = []
+    for entry_point in entry_points:
+        code = STARTUP_CHILD.format(code=STARTUP_ENTRY_POINTS[entry_point], heavy=HEAVY_MODULES)
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        results.append({
+            'benchmark': 'startup',
+            'params': {'entry_point': entry_point},
+            'metrics': {
+                'import_ms': statistics.median(run['import_ms'] for run in runs),
+                'peak_rss_kb': statistics.median(run['peak_rss_kb'] for run in runs),
+                'heavy_modules_count': len(runs[-1]['heavy_modules']),
+            },
+        })
+    return results
+
+
+def bench_orm(rows=1000):
+    from django.db import transaction
+
+    from images.models import GeneratedImage, GenerationJob
+    from users.models import User
+
+    results = []
+    # Everything is rolled back, so this is safe to run against a real database.
+    with transaction.atomic():
+        user = User.objects.create(username=f'benchmark-{time.time_ns()}')
+        job = GenerationJob.objects.create(user=user, prompt_hash='0' * 64)
+        names = [f'benchmark/{i}.jpg' for i in range(rows)]
+
+        timings = measure(lambda: GeneratedImage.objects.bulk_create_for_job(job, names), repeat=3, warmup=0)
+        results.append({
+            'benchmark': 'orm_bulk_insert',
+            'params': {'rows': rows},
+            'metrics': {**timings, 'rows_per_sec': rows / (timings['median_ms'] / 1000)},
+        })
+
+        cursor = GeneratedImage.actives.filter(user=user).keyset_page(size=rows)[1]
+        results.append({
+            'benchmark': 'orm_keyset_page',
+            'params': {'rows': rows * 3, 'page_size': 25},
+            'metrics': measure(lambda: GeneratedImage.actives.filter(user=user).keyset_page(cursor, size=25)),
+        })
+        results.append({
+            'benchmark': 'orm_status_counts',
+            'params': {},
+            'metrics': measure(lambda: GenerationJob.actives.status_counts(user)),
+        })
+        transaction.set_rollback(True)
+    return results
+
+
+def bench_celery_eager():
+    from image_weaver.celery import app
+
+    # `apply` is what `delay` does under CELERY_TASK_ALWAYS_EAGER, without touching the app config.
+    task = app.tasks['celery.accumulate']
+    timings = measure(lambda: task.apply((1,)).get(), repeat=100, warmup=5)
+    return [{
+        'benchmark': 'celery_eager_round_trip',
+        'params': {},
+        'metrics': {**timings, 'tasks_per_sec': 1000 / timings['median_ms']},
+    }]
+
+
+BENCHMARKS = {
+    'deep_dream': bench_deep_dream_steps,
+    'deep_dream_batch': bench_deep_dream_batch,
+    'dream_models': bench_dream_models,
+    'calc_loss': bench_calc_loss,
+    'encode': bench_encode,
+    'encode_memory': bench_encode_memory,
+    'startup': bench_startup,
+    'orm': bench_orm,
+    'celery': bench_celery_eager,
+}
+
+
+def run(names=None):
+    results = []
+    for name in names or BENCHMARKS:
+        results.extend(BENCHMARKS[name]())
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    # Returns a description of every metric that got more than `tolerance` worse than `baseline`.
+    def key(result):
+        return result['benchmark'], tuple(sorted((k, str(v)) for k, v in result['params'].items()))
+
+    def worse(metric, old, value):
+        if metric.endswith(HIGHER_IS_BETTER):
+            return old > 0 and (old - value) / old > tolerance
+        # Counts (traces, weights, heavy modules) are exact, any growth is a regression. So is
+        # any growth from zero, which no relative tolerance covers.
+        if metric.endswith('_count') or old == 0:
+            return value > old
+        return (value - old) / old > tolerance
+
+    previous = {key(result): result['metrics'] for result in baseline}
+    regressions = []
+    for result in results:
+        for metric, value in result['metrics'].items():
+            old = previous.get(key(result), {}).get(metric)
+            if old is None:
+                continue
+            if worse(metric, old, value):
+                regressions.append(f'{result["benchmark"]} {result["params"]} {metric}: {old:.3f} -> {value:.3f}')
+    return regressions
@@ -0,0 +1,110 @@
+import functools
+import logging
+import os
+import threading
+import time
+
+from constance import settings as constance_settings
+from constance.backends.database import DatabaseBackend
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+
+logger = logging.getLogger('error')
+
+
+class CachedDatabaseBackend(DatabaseBackend):
+    # Constance's database backend behind an in-process cache. The first read loads every
+    # config value with a single query; later reads are dictionary lookups until the values
+    # are invalidated.
+    #
+    # Every save of a value publishes an invalidation on the default Redis server, and each
+    # process keeps a subscriber thread that drops its local copy when one arrives, so changes
+    # reach web and worker processes within moments. Local copies also expire after `ttl`
+    # seconds in case a message is missed, and after `fallback_ttl` seconds while the
+    # subscriber is not connected.
+    def __init__(self):
+        self.ttl = settings.CONSTANCE_CACHE_TTL
+        self.fallback_ttl = settings.CONSTANCE_CACHE_FALLBACK_TTL
+        self.channel = cache.make_key('constance:invalidate')
+
+        self._values = None
+        self._loaded_at = float('-inf')
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._subscriber_pid = None
+        self._subscribed = threading.Event()
+        super().__init__()
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    def get(self, key):
+        self._ensure_subscriber()
+        ttl = self.ttl if self._subscribed.is_set() else self.fallback_ttl
+        values = self._values
+        if values is None or time.monotonic() - self._loaded_at > ttl:
+            values = self._load()
+        return values.get(key)
+
+    def _load(self):
+        with self._lock:
+            generation, loaded_at = self._generation, time.monotonic()
+            values = dict(self.mget(constance_settings.CONFIG))
+            # Values invalidated during the query may be stale, they are used once only.
+            if generation == self._generation:
+                self._values, self._loaded_at = values, loaded_at
+        return values
+
+    def invalidate(self):
+        self._generation += 1
+        self._values = None
+
+    def clear(self, sender, instance, created, **kwargs):
+        # Connected to the Constance model's post_save, so admin edits and `config.X = ...`
+        # both end up here. Other processes are told once the save commits, before that they
+        # would reload the old value.
+        super().clear(sender, instance, created, **kwargs)
+        self.invalidate()
+        transaction.on_commit(functools.partial(self._publish, instance.key))
+
+    def _publish(self, key):
+        # Threads of this process may have reloaded the old value meanwhile, too.
+        self.invalidate()
+        try:
+            self.redis.publish(self.channel, key)
+        except Exception:
+            logger.exception('Could not publish the constance invalidation')
+
+    def _ensure_subscriber(self):
+        # Threads do not survive a fork (celery prefork), so every process starts its own.
+        pid = os.getpid()
+        if self._subscriber_pid == pid:
+            return
+        with self._lock:
+            if self._subscriber_pid == pid:
+                return
+            self._subscriber_pid = pid
+            self._subscribed = threading.Event()
+            self._values = None
+            threading.Thread(target=self._subscribe, args=(self._subscribed,), daemon=True,
+                             name='constance-invalidation').start()
+
+    def _subscribe(self, subscribed):
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                # Anything saved while not subscribed was missed.
+                self.invalidate()
+                subscribed.set()
+                for _ in pubsub.listen():
+                    self.invalidate()
+            except Exception:
+                logger.exception('Constance invalidation subscriber disconnected')
+            finally:
+                subscribed.clear()
+                pubsub.close()
+            time.sleep(1)
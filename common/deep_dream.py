@@ -0,0 +1,488 @@
+import bisect
+import io
+import threading
+import time
+from collections import OrderedDict, deque
+
+import PIL.Image
+import numpy as np
+import tensorflow as tf
+
+from common import metrics
+
+
+# The dream models resident in this process, see `get_dream_models`.
+_dream_models = None
+_dream_models_lock = threading.Lock()
+
+# Image heights and widths are padded up to the next of these sizes, so a compiled DeepDream
+# function is traced once per (height, width) bucket instead of once per input shape.
+BUCKET_SIZES = (256, 384, 512, 768, 1024, 1536, 2048)
+
+
+# Normalize an image
+def deprocess(img):
+    img = 255 * (img + 1.0) / 2.0
+    return tf.cast(img, tf.uint8)
+
+
+def calc_loss(img, model):
+    # Pass forward the image through the model to retrieve the activations.
+    # Converts the image into a batch of size 1.
+    img_batch = tf.expand_dims(img, axis=0)
+    layer_activations = model(img_batch)
+    if len(layer_activations) == 1:
+        layer_activations = [layer_activations]
+
+    losses = []
+    for act in layer_activations:
+        loss = tf.math.reduce_mean(act)
+        losses.append(loss)
+
+    return tf.reduce_sum(losses)
+
+
+def calc_batch_loss(imgs, model):
+    # The loss of every image of an `[B, H, W, 3]` batch, as a `[B]` tensor. Images do not
+    # interact, so the gradient of the summed losses holds each image's own gradient.
+    layer_activations = model(imgs)
+    if len(layer_activations) == 1:
+        layer_activations = [layer_activations]
+
+    losses = [tf.math.reduce_mean(act, axis=[1, 2, 3]) for act in layer_activations]
+    return tf.add_n(losses)
+
+
+class DeepDream(tf.Module):
+    def __init__(self, model):
+        self.model = model
+        self.trace_count = 0
+
+    @tf.function(
+        input_signature=(
+                tf.TensorSpec(shape=[None, None, 3], dtype=tf.float32),
+                tf.TensorSpec(shape=[], dtype=tf.int32),
+                tf.TensorSpec(shape=[], dtype=tf.float32),)
+    )
+    def __call__(self, img, steps, step_size):
+        # Python side effects only run while tracing.
+        self.trace_count += 1
+        loss = tf.constant(0.0)
+        for n in tf.range(steps):
+            with tf.GradientTape() as tape:
+                # This needs gradients relative to `img`
+                # `GradientTape` only watches `tf.Variable`s by default
+                tape.watch(img)
+                loss = calc_loss(img, self.model)
+
+            # Calculate the gradient of the loss with respect to the pixels of the input image.
+            gradients = tape.gradient(loss, img)
+
+            # Normalize the gradients.
+            gradients /= tf.math.reduce_std(gradients) + 1e-8
+
+            # In gradient ascent, the "loss" is maximized so that the input image increasingly "excites" the layers.
+            # You can update the image by directly adding the gradients (because they're the same shape!)
+            img = img + gradients * step_size
+            img = tf.clip_by_value(img, -1, 1)
+
+        return loss, img
+
+
+def random_roll(img, maxroll):
+    # Randomly shift the image to avoid tiled boundaries.
+    shift = tf.random.uniform(shape=[2], minval=-maxroll, maxval=maxroll, dtype=tf.int32)
+    img_rolled = tf.roll(img, shift=shift, axis=[0, 1])
+    return shift, img_rolled
+
+
+class CompiledDeepDream(tf.Module):
+    # DeepDream compiled per shape bucket. Inputs are padded to their bucket and only the valid
+    # region is updated, so every octave and chunk reuses one of a few traced functions and the
+    # image never leaves the device between them.
+    #
+    # Images larger than the largest bucket are processed in `tile_size` tiles instead: every
+    # step sums the gradients of the tiles of a randomly rolled copy, so tile boundaries land
+    # somewhere different each time, and memory stays flat regardless of the input size.
+    def __init__(self, model, bucket_sizes=BUCKET_SIZES, tile_size=512, jit_compile=True, timings_size=1000):
+        self.model = model
+        self.bucket_sizes = tuple(sorted(bucket_sizes))
+        if tile_size > self.bucket_sizes[-1]:
+            raise ValueError(f'tile_size {tile_size} is larger than the largest bucket {self.bucket_sizes[-1]}')
+        self.tile_size = tile_size
+        self.jit_compile = jit_compile
+        self.trace_count = 0
+        self.step_times = deque(maxlen=timings_size)
+        self._functions = {}
+        self._batch_functions = {}
+        self._gradient_functions = {}
+
+    def bucket(self, height, width):
+        def round_up(size):
+            index = bisect.bisect_left(self.bucket_sizes, size)
+            if index == len(self.bucket_sizes):
+                raise ValueError(f'{size} pixels is larger than the largest bucket {self.bucket_sizes[-1]}')
+            return self.bucket_sizes[index]
+
+        return round_up(height), round_up(width)
+
+    def fits(self, height, width):
+        # Whether an image is run whole, otherwise it is tiled.
+        return max(height, width) <= self.bucket_sizes[-1]
+
+    def _function(self, bucket):
+        function = self._functions.get(bucket)
+        if function is None:
+            function = tf.function(
+                self._steps,
+                input_signature=(
+                    tf.TensorSpec(shape=[bucket[0], bucket[1], 3], dtype=tf.float32),
+                    tf.TensorSpec(shape=[2], dtype=tf.int32),
+                    tf.TensorSpec(shape=[], dtype=tf.int32),
+                    tf.TensorSpec(shape=[], dtype=tf.float32),),
+                jit_compile=self.jit_compile,
+            )
+            self._functions[bucket] = function
+        return function
+
+    def _steps(self, img, size, steps, step_size):
+        # Python side effects only run while tracing.
+        self.trace_count += 1
+
+        bucket_shape = tf.shape(img)[:2]
+        mask = tf.pad(tf.ones(tf.concat([size, [3]], axis=0)),
+                      [[0, bucket_shape[0] - size[0]], [0, bucket_shape[1] - size[1]], [0, 0]])
+        count = tf.reduce_sum(mask)
+
+        loss = tf.constant(0.0)
+        for n in tf.range(steps):
+            with tf.GradientTape() as tape:
+                tape.watch(img)
+                loss = calc_loss(img, self.model)
+            gradients = tape.gradient(loss, img) * mask
+
+            # Normalize by the standard deviation of the valid region only.
+            mean = tf.reduce_sum(gradients) / count
+            std = tf.sqrt(tf.reduce_sum(tf.square(gradients - mean) * mask) / count)
+            gradients /= std + 1e-8
+
+            img = img + gradients * step_size
+            img = tf.clip_by_value(img, -1, 1)
+
+        return loss, img
+
+    def _gradient_function(self, bucket):
+        function = self._gradient_functions.get(bucket)
+        if function is None:
+            function = tf.function(
+                self._tile_gradients,
+                input_signature=(tf.TensorSpec(shape=[bucket[0], bucket[1], 3], dtype=tf.float32),),
+                jit_compile=self.jit_compile,
+            )
+            self._gradient_functions[bucket] = function
+        return function
+
+    def _tile_gradients(self, tile):
+        self.trace_count += 1
+        with tf.GradientTape() as tape:
+            tape.watch(tile)
+            loss = calc_loss(tile, self.model)
+        return loss, tape.gradient(loss, tile)
+
+    def _tiled_steps(self, img, steps, step_size):
+        height, width = img.shape[0], img.shape[1]
+        loss = tf.constant(0.0)
+        for _ in range(steps):
+            shift, img_rolled = random_roll(img, self.tile_size)
+            loss = tf.constant(0.0)
+            rows = []
+            for y in range(0, height, self.tile_size):
+                row = []
+                for x in range(0, width, self.tile_size):
+                    tile = img_rolled[y:y + self.tile_size, x:x + self.tile_size]
+                    tile_height, tile_width = tile.shape[0], tile.shape[1]
+                    bucket = self.bucket(tile_height, tile_width)
+                    padded = tf.pad(tile, [[0, bucket[0] - tile_height], [0, bucket[1] - tile_width], [0, 0]])
+                    tile_loss, gradients = self._gradient_function(bucket)(padded)
+                    loss += tile_loss
+                    row.append(gradients[:tile_height, :tile_width])
+                rows.append(tf.concat(row, axis=1))
+            gradients = tf.roll(tf.concat(rows, axis=0), shift=-shift, axis=[0, 1])
+
+            gradients /= tf.math.reduce_std(gradients) + 1e-8
+            img = img + gradients * step_size
+            img = tf.clip_by_value(img, -1, 1)
+        return loss, img
+
+    def _batch_function(self, bucket):
+        function = self._batch_functions.get(bucket)
+        if function is None:
+            function = tf.function(
+                self._batch_steps,
+                input_signature=(
+                    tf.TensorSpec(shape=[None, bucket[0], bucket[1], 3], dtype=tf.float32),
+                    tf.TensorSpec(shape=[None, 2], dtype=tf.int32),
+                    tf.TensorSpec(shape=[], dtype=tf.int32),
+                    tf.TensorSpec(shape=[], dtype=tf.float32),),
+                jit_compile=self.jit_compile,
+            )
+            self._batch_functions[bucket] = function
+        return function
+
+    def _batch_steps(self, imgs, sizes, steps, step_size):
+        # `_steps` for a stack of images padded to the same bucket, each with its own valid size,
+        # loss and gradient normalization.
+        self.trace_count += 1
+
+        bucket_shape = tf.shape(imgs)[1:3]
+        rows = tf.sequence_mask(sizes[:, 0], bucket_shape[0], dtype=tf.float32)
+        columns = tf.sequence_mask(sizes[:, 1], bucket_shape[1], dtype=tf.float32)
+        mask = rows[:, :, tf.newaxis, tf.newaxis] * columns[:, tf.newaxis, :, tf.newaxis]
+        count = tf.reduce_sum(mask, axis=[1, 2, 3], keepdims=True) * 3
+
+        losses = tf.zeros(tf.shape(imgs)[:1])
+        for n in tf.range(steps):
+            with tf.GradientTape() as tape:
+                tape.watch(imgs)
+                losses = calc_batch_loss(imgs, self.model)
+                loss = tf.reduce_sum(losses)
+            gradients = tape.gradient(loss, imgs) * mask
+
+            mean = tf.reduce_sum(gradients, axis=[1, 2, 3], keepdims=True) / count
+            std = tf.sqrt(tf.reduce_sum(tf.square(gradients - mean) * mask, axis=[1, 2, 3], keepdims=True) / count)
+            gradients /= std + 1e-8
+
+            imgs = imgs + gradients * step_size
+            imgs = tf.clip_by_value(imgs, -1, 1)
+
+        return losses, imgs
+
+    def __call__(self, img, steps, step_size):
+        # `img` is a float tensor in [-1, 1] of any size.
+        height, width = img.shape[0], img.shape[1]
+        trace_count = self.trace_count
+        started = time.perf_counter()
+        if self.fits(height, width):
+            bucket = self.bucket(height, width)
+            padded = tf.pad(img, [[0, bucket[0] - height], [0, bucket[1] - width], [0, 0]])
+            loss, padded = self._function(bucket)(
+                padded, tf.constant([height, width]), tf.constant(steps), tf.constant(step_size, dtype=tf.float32))
+            img = padded[:height, :width]
+        else:
+            loss, img = self._tiled_steps(img, steps, step_size)
+        # Reading the scalar loss waits for the device without copying the image back.
+        loss = float(loss)
+        elapsed = time.perf_counter() - started
+        if self.trace_count != trace_count:
+            # The first call per bucket is dominated by tracing and compilation.
+            metrics.compile_time.observe(elapsed, model='deep_dream')
+        elif steps:
+            self.step_times.append(elapsed / steps)
+            metrics.inference_step.observe(elapsed / steps, model='deep_dream')
+
+        return loss, img
+
+    def batch(self, imgs, steps, step_size):
+        # Runs `steps` on several images in one compiled call per bucket. Images of different
+        # sizes are grouped by bucket, images too large for any are tiled one by one; returns
+        # their losses and images in input order.
+        losses = [None] * len(imgs)
+        results = [None] * len(imgs)
+        groups = {}
+        for index, img in enumerate(imgs):
+            if self.fits(img.shape[0], img.shape[1]):
+                groups.setdefault(self.bucket(img.shape[0], img.shape[1]), []).append(index)
+            else:
+                losses[index], results[index] = self(img, steps, step_size)
+
+        for bucket, indices in groups.items():
+            sizes = [(imgs[i].shape[0], imgs[i].shape[1]) for i in indices]
+            padded = tf.stack([
+                tf.pad(imgs[i], [[0, bucket[0] - height], [0, bucket[1] - width], [0, 0]])
+                for i, (height, width) in zip(indices, sizes)
+            ])
+
+            trace_count = self.trace_count
+            started = time.perf_counter()
+            group_losses, padded = self._batch_function(bucket)(
+                padded, tf.constant(sizes, dtype=tf.int32), tf.constant(steps),
+                tf.constant(step_size, dtype=tf.float32))
+            group_losses = group_losses.numpy()
+            elapsed = time.perf_counter() - started
+            if self.trace_count != trace_count:
+                metrics.compile_time.observe(elapsed, model='deep_dream_batch')
+            elif steps:
+                # Per image step, comparable with the single image timings.
+                self.step_times.append(elapsed / steps / len(indices))
+                metrics.inference_step.observe(elapsed / steps / len(indices), model='deep_dream_batch')
+            metrics.batch_size.observe(len(indices), model='deep_dream_batch')
+
+            for position, (i, (height, width)) in enumerate(zip(indices, sizes)):
+                losses[i] = float(group_losses[position])
+                results[i] = padded[position, :height, :width]
+        return losses, results
+
+    def steps_per_second(self):
+        if not self.step_times:
+            return 0.0
+        return len(self.step_times) / sum(self.step_times)
+
+    def run(self, img, steps_per_octave=50, step_size=0.01, octave_scale=1.3, octaves=range(-2, 3),
+            chunk_size=None, on_chunk=None):
+        # `on_chunk(octave, step, loss, img)` is called after every `chunk_size` steps.
+        base_shape = tf.shape(img)[:-1]
+        float_base_shape = tf.cast(base_shape, tf.float32)
+        img = tf.keras.applications.inception_v3.preprocess_input(tf.cast(img, tf.float32))
+        chunk_size = chunk_size or steps_per_octave
+
+        for octave in octaves:
+            new_shape = tf.cast(float_base_shape * (octave_scale ** octave), tf.int32)
+            img = tf.image.resize(img, new_shape)
+
+            step = 0
+            while step < steps_per_octave:
+                run_steps = min(chunk_size, steps_per_octave - step)
+                loss, img = self(img, run_steps, step_size)
+                step += run_steps
+                if on_chunk is not None:
+                    on_chunk(octave, step, loss, img)
+
+        return deprocess(tf.image.resize(img, base_shape))
+
+    def run_batch(self, imgs, steps_per_octave=50, step_size=0.01, octave_scale=1.3, octaves=range(-2, 3),
+                  chunk_size=None, on_chunk=None):
+        # `run` for several uint8 images at once. `on_chunk(octave, step, losses, imgs)` is called
+        # after every `chunk_size` steps with the per-image losses and images.
+        base_shapes = [tf.shape(img)[:-1] for img in imgs]
+        imgs = [tf.keras.applications.inception_v3.preprocess_input(tf.cast(img, tf.float32)) for img in imgs]
+        chunk_size = chunk_size or steps_per_octave
+
+        for octave in octaves:
+            imgs = [
+                tf.image.resize(img, tf.cast(tf.cast(base_shape, tf.float32) * (octave_scale ** octave), tf.int32))
+                for img, base_shape in zip(imgs, base_shapes)
+            ]
+
+            step = 0
+            while step < steps_per_octave:
+                run_steps = min(chunk_size, steps_per_octave - step)
+                losses, imgs = self.batch(imgs, run_steps, step_size)
+                step += run_steps
+                if on_chunk is not None:
+                    on_chunk(octave, step, losses, imgs)
+
+        return [deprocess(tf.image.resize(img, base_shape)) for img, base_shape in zip(imgs, base_shapes)]
+
+
+class DreamCancelled(Exception):
+    pass
+
+
+def inception_v3():
+    return tf.keras.applications.InceptionV3(include_top=False, weights='imagenet')
+
+
+# Base networks by name, built on first use.
+BASE_NETWORKS = {
+    'inception_v3': inception_v3,
+}
+
+DEFAULT_BASE_NETWORK = 'inception_v3'
+DEFAULT_LAYERS = ('mixed3', 'mixed5')
+
+
+class DreamModelRegistry:
+    # Feature extraction models keyed by base network and layer set. Each base network is built
+    # once and every layer set is a functional model over its layers, so all combinations share
+    # one resident copy of the weights. The compiled DeepDream wrappers (and their traced
+    # functions) are kept for the `max_models` most recently used layer sets.
+    def __init__(self, base_networks=BASE_NETWORKS, max_models=8, jit_compile=True):
+        self.base_networks = dict(base_networks)
+        self.max_models = max_models
+        self.jit_compile = jit_compile
+
+        self._bases = {}
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name, build):
+        with self._lock:
+            self.base_networks[name] = build
+
+    def base(self, name):
+        with self._lock:
+            return self._base(name)
+
+    def _base(self, name):
+        base = self._bases.get(name)
+        if base is None:
+            if name not in self.base_networks:
+                raise KeyError(f'Unknown base network {name!r}')
+            with metrics.model_load.time(model=name):
+                base = self.base_networks[name]()
+            self._bases[name] = base
+        return base
+
+    def model(self, name=DEFAULT_BASE_NETWORK, layers=DEFAULT_LAYERS):
+        return self.get(name, layers).model
+
+    def get(self, name=DEFAULT_BASE_NETWORK, layers=DEFAULT_LAYERS):
+        key = (name, tuple(layers))
+        with self._lock:
+            deep_dream = self._models.get(key)
+            if deep_dream is None:
+                base = self._base(name)
+                # Reuses the base network's layer objects, so no weights are copied.
+                outputs = [base.get_layer(layer).output for layer in key[1]]
+                model = tf.keras.Model(inputs=base.input, outputs=outputs, name=f'{name}_{"_".join(key[1])}')
+                deep_dream = CompiledDeepDream(model, jit_compile=self.jit_compile)
+                self._models[key] = deep_dream
+                while len(self._models) > self.max_models:
+                    self._models.popitem(last=False)
+            self._models.move_to_end(key)
+            return deep_dream
+
+    def release(self, name=None):
+        # Drops one base network (or all of them) together with the models built on it.
+        with self._lock:
+            for key in [key for key in self._models if name is None or key[0] == name]:
+                del self._models[key]
+            for base_name in [base_name for base_name in self._bases if name is None or base_name == name]:
+                del self._bases[base_name]
+
+
+def get_dream_models():
+    global _dream_models
+    with _dream_models_lock:
+        if _dream_models is None:
+            _dream_models = DreamModelRegistry()
+        return _dream_models
+
+
+def get_deep_dream(name=DEFAULT_BASE_NETWORK, layers=DEFAULT_LAYERS):
+    return get_dream_models().get(name, layers)
+
+
+def encode_preview(img, size):
+    # `img` is a model-range tensor; returns a small JPEG for progress updates.
+    pil_img = PIL.Image.fromarray(np.asarray(deprocess(img)))
+    pil_img.thumbnail((size, size))
+    buffer = io.BytesIO()
+    pil_img.save(buffer, format='JPEG', quality=70)
+    return buffer.getvalue()
+
+
+def dream(img, steps_per_octave=50, chunk_size=10, on_chunk=None, cancelled=None, base=DEFAULT_BASE_NETWORK,
+          layers=DEFAULT_LAYERS, octaves=range(-2, 3)):
+    # Runs octave DeepDream on a uint8 image, maximizing the activations of `layers` of the `base`
+    # network. `on_chunk(octave, step, loss, img)` reports progress and setting the `cancelled`
+    # event stops the run at the next chunk.
+    def report(octave, step, loss, chunk_img):
+        if cancelled is not None and cancelled.is_set():
+            raise DreamCancelled()
+        if on_chunk is not None:
+            on_chunk(octave, step, loss, chunk_img)
+
+    deep_dream = get_deep_dream(base, layers)
+    return deep_dream.run(img, steps_per_octave=steps_per_octave, octaves=octaves, chunk_size=chunk_size,
+                          on_chunk=report)
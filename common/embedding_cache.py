@@ -0,0 +1,89 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from common import metrics
+from common.result_cache import model_version
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+class EmbeddingCache:
+    # Text encoder outputs keyed by model version and prompt. A bounded in-process LRU sits in
+    # front of the default cache (Redis), so popular prompts are encoded once per cluster and
+    # served from memory afterwards.
+    def __init__(self, max_entries=1024, ttl=86400, prefix='embedding'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefix = prefix
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, prompt):
+        digest = hashlib.sha256(f'{model_version()}\0{prompt}'.encode()).hexdigest()
+        return f'{self.prefix}:{digest}'
+
+    def get_or_encode(self, prompt, encode):
+        key = self.key(prompt)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                metrics.cache_requests.inc(cache='embedding', result='hit')
+                return embedding
+
+        embedding = cache.get(key)
+        if embedding is None:
+            metrics.cache_requests.inc(cache='embedding', result='miss')
+            embedding = np.asarray(encode(prompt))
+            cache.set(key, embedding, timeout=self.ttl)
+        else:
+            metrics.cache_requests.inc(cache='embedding', result='shared_hit')
+
+        # Shared between callers, so nobody may modify it in place.
+        embedding.setflags(write=False)
+        self._remember(key, embedding)
+        return embedding
+
+    def _remember(self, key, embedding):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# The unconditional context is the encoding of an empty prompt. The NUL prefix keeps its key
+# apart from any real prompt.
+UNCONDITIONAL = '\0unconditional'
+
+
+def cache_unconditional_context(model, embedding_cache):
+    # Stable Diffusion encodes the same empty prompt for classifier-free guidance on every
+    # `generate_image` call, route that through the cache as well.
+    get_unconditional_context = model._get_unconditional_context
+    model._get_unconditional_context = lambda: embedding_cache.get_or_encode(
+        UNCONDITIONAL, lambda _: get_unconditional_context(),
+    )
+    return model
+
+
+def get_embedding_cache():
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(
+                max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+                ttl=settings.EMBEDDING_CACHE_TTL,
+            )
+        return _embedding_cache
@@ -0,0 +1,130 @@
+import io
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import PIL.Image
+import numpy as np
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def to_array(img):
+    # Views a tensor's buffer as a NumPy array without copying it, through DLPack when the
+    # tensor supports it and the buffer protocol otherwise. The result may be read-only.
+    if isinstance(img, np.ndarray):
+        return img
+    if hasattr(img, '__dlpack__'):
+        try:
+            return np.from_dlpack(img)
+        except (BufferError, RuntimeError, TypeError):
+            pass
+    return np.asarray(img)
+
+
+class BufferPool:
+    # Reuses full-frame buffers, NumPy arrays or PIL images, instead of allocating them per image.
+    def __init__(self, max_per_key=4):
+        self.max_per_key = max_per_key
+        self._free = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, create):
+        with self._lock:
+            if self._free[key]:
+                return self._free[key].pop()
+        return create()
+
+    def release(self, key, buffer):
+        with self._lock:
+            if len(self._free[key]) < self.max_per_key:
+                self._free[key].append(buffer)
+
+    def array(self, shape, dtype):
+        key = ('array', tuple(shape), np.dtype(dtype).str)
+        return key, self.acquire(key, lambda: np.empty(shape, dtype=dtype))
+
+    def image(self, width, height):
+        key = ('image', width, height)
+        return key, self.acquire(key, lambda: PIL.Image.new('RGB', (width, height)))
+
+
+# Rows deprocessed at a time, which bounds the intermediate buffers.
+CHUNK_ROWS = 64
+
+
+def deprocess_into(img, out, scratch):
+    # The in-place equivalent of `deep_dream.deprocess` for one band of rows: maps [-1, 1] floats
+    # to uint8 in `out`, through the float32 `scratch` buffer instead of temporaries.
+    np.add(img, 1.0, out=scratch)
+    np.multiply(scratch, 127.5, out=scratch)
+    np.clip(scratch, 0, 255, out=scratch)
+    np.copyto(out, scratch, casting='unsafe')
+    return out
+
+
+class ImageEncoder:
+    # Encodes tensors or arrays read in place from their buffers, optionally on a background thread
+    # pool. Float images in the model range are deprocessed into a pooled uint8 buffer first.
+    def __init__(self, max_workers=2, pool=None):
+        self.pool = pool or BufferPool()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-encoder')
+
+    def encode(self, img, format='JPEG', **options):
+        array = to_array(img)
+        height, width = array.shape[:2]
+        image_key, pil_img = self.pool.image(width, height)
+        try:
+            if array.dtype == np.uint8:
+                # Copy the pixels straight into the pooled image. Wrapping the buffer with
+                # `frombuffer` would not help, `Image.save` copies read-only images first.
+                pil_img.frombytes(memoryview(np.ascontiguousarray(array)))
+            else:
+                self._deprocess_into_image(array, pil_img)
+
+            buffer = io.BytesIO()
+            pil_img.save(buffer, format=format, **options)
+            return buffer.getvalue()
+        finally:
+            self.pool.release(image_key, pil_img)
+
+    def _deprocess_into_image(self, array, pil_img):
+        # Deprocess band by band so no full-size float or uint8 copy of the frame is ever made.
+        rows = min(CHUNK_ROWS, array.shape[0])
+        band_shape = (rows,) + array.shape[1:]
+        out_key, out = self.pool.array(band_shape, np.uint8)
+        scratch_key, scratch = self.pool.array(band_shape, np.float32)
+        try:
+            for start in range(0, array.shape[0], rows):
+                band = array[start:start + rows]
+                count = band.shape[0]
+                deprocess_into(band, out[:count], scratch[:count])
+                pil_img.paste(PIL.Image.frombuffer('RGB', (array.shape[1], count), out[:count], 'raw', 'RGB', 0, 1),
+                              (0, start))
+        finally:
+            self.pool.release(out_key, out)
+            self.pool.release(scratch_key, scratch)
+
+    def submit(self, img, format='JPEG', **options):
+        return self._executor.submit(self.encode, img, format, **options)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def get_encoder():
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = ImageEncoder()
+        return _encoder
+
+
+def shutdown_encoder():
+    # Waits for the pending encodes, the next `get_encoder` starts a new encoder.
+    global _encoder
+    with _encoder_lock:
+        encoder, _encoder = _encoder, None
+    if encoder is not None:
+        encoder.shutdown()
@@ -0,0 +1,204 @@
+import asyncio
+import functools
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+
+from common import metrics
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+def _init_process():
+    # Process pool workers start from a clean interpreter, so set up Django and warm the model.
+    import os
+
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_weaver.settings')
+    django.setup()
+
+    from common.stable_diffusion import get_model
+    get_model()
+
+
+def _resolve(call):
+    # Process pool results are pickled back to the caller, so a future a call hands off is waited
+    # for in the worker.
+    result = call()
+    return result.result() if isinstance(result, Future) else result
+
+
+def _flatten(future):
+    # A future for the outcome of `future`, or of the future it resolves to. Calls such as
+    # `generate_and_save` return as soon as inference is done and leave the encodes and uploads
+    # to a future of their own, so the executor slot is free before the result is stored.
+    # Cancelling the returned future cancels `future` if it has not started yet.
+    flat = Future()
+
+    def settle(done):
+        try:
+            if done.cancelled():
+                flat.cancel()
+            elif done.exception() is not None:
+                flat.set_exception(done.exception())
+            elif isinstance(done.result(), Future):
+                done.result().add_done_callback(settle)
+            else:
+                flat.set_result(done.result())
+        except InvalidStateError:
+            # The caller cancelled meanwhile.
+            pass
+
+    flat.add_done_callback(lambda done: done.cancelled() and future.cancel())
+    future.add_done_callback(settle)
+    return flat
+
+
+class GenerationService:
+    # Runs blocking generation calls on a dedicated, bounded executor so the event loop stays free.
+    # At most `max_pending` calls may be queued or running at once; further calls fail fast with
+    # `ServiceBusy` instead of piling up. Awaiting callers may time out or be cancelled, which
+    # cancels their call if it has not started yet.
+    def __init__(self, max_workers=1, max_pending=256, executor='thread'):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = executor
+
+        self._executor = None
+        self._manager = None
+        self._pending = 0
+        self._in_flight = {}
+        # Reentrant: a call that finishes before `_submit` returns runs `_release` right away.
+        self._lock = threading.RLock()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            if self.executor == 'process':
+                # Spawned, not forked: the children import TensorFlow, the web process never does,
+                # and forking a process with threads running is unsafe.
+                context = multiprocessing.get_context('spawn')
+                self._manager = context.Manager()
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context,
+                                                     initializer=_init_process)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='generation')
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            manager, self._manager = self._manager, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+        if manager is not None:
+            manager.shutdown()
+
+    def channel(self):
+        # A queue and an event shared between the caller and a call it submits, e.g. for progress
+        # reports and cancellation. Process pool workers get proxies to a manager process, since
+        # they cannot share the caller's thread primitives.
+        self.start()
+        with self._lock:
+            if self._manager is not None:
+                return self._manager.Queue(), self._manager.Event()
+        return queue.Queue(), threading.Event()
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _submit(self, fn, *args, **kwargs):
+        # Must be called holding `_lock`.
+        if self._pending >= self.max_pending:
+            raise ServiceBusy(f'{self._pending} generation calls already pending')
+        self._pending += 1
+        call = functools.partial(fn, *args, **kwargs)
+        if self.executor == 'process':
+            call = functools.partial(_resolve, call)
+        # The slot is held until the call finishes or is cancelled, not until the caller gives up.
+        future = self._executor.submit(call)
+        future.add_done_callback(self._release)
+        return _flatten(future)
+
+    async def submit(self, fn, *args, timeout=None, **kwargs):
+        self.start()
+        with self._lock:
+            future = self._submit(fn, *args, **kwargs)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            future.cancel()
+            raise
+
+    async def generate(self, prompt, num_steps=50, seed=None, timeout=None):
+        from common.result_cache import generation_key, get_result_cache
+        from common.stable_diffusion import generate_and_save
+
+        # Unseeded requests are random, each one gets a generation of its own.
+        if seed is None:
+            return await self.submit(generate_and_save, prompt, num_steps=num_steps, timeout=timeout)
+
+        # Answer repeats straight from the cache instead of queueing them behind running generations.
+        key = generation_key(prompt, num_steps=num_steps, seed=seed)
+        names = await get_result_cache().aget(key)
+        if names is not None:
+            return names
+
+        # Identical requests arriving while one is in flight wait for its result instead.
+        self.start()
+        with self._lock:
+            flight = self._in_flight.get(key)
+            if flight is None:
+                flight = self._in_flight[key] = [self._submit(generate_and_save, prompt, num_steps=num_steps,
+                                                              seed=seed), 0]
+                leader = True
+            else:
+                leader = False
+            flight[1] += 1
+        future = flight[0]
+        if leader:
+            future.add_done_callback(lambda done: self._land(key, done))
+        else:
+            metrics.coalesced_requests.inc(kind='service')
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            with self._lock:
+                flight[1] -= 1
+                # Only cancel a call nobody is waiting for anymore.
+                if not flight[1]:
+                    future.cancel()
+            raise
+
+    def _land(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key, [None])[0] is future:
+                del self._in_flight[key]
+
+
+def get_generation_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = GenerationService(
+                max_workers=settings.GENERATION_SERVICE_WORKERS,
+                max_pending=settings.GENERATION_SERVICE_MAX_PENDING,
+                executor=settings.GENERATION_SERVICE_EXECUTOR,
+            )
+        return _service
@@ -0,0 +1,108 @@
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import weakref
+
+# Every queued handler of this process, restarted in children after a fork (celery prefork).
+_handlers = weakref.WeakSet()
+# File streams inherited over a fork, never flushed or closed by the child.
+_inherited_streams = []
+
+
+class QueuedFileHandler(logging.handlers.QueueHandler):
+    # Formats records in the logging thread and hands them to a listener thread, which appends
+    # them to `filename`. Logging never blocks the caller on disk I/O: when the queue is full the
+    # record is dropped and counted in `dropped`.
+    #
+    # Every web and worker process appends to the same files, so none of them may rotate: each
+    # would rename the file under the others. Rotation is left to an external logrotate, and the
+    # file is reopened when it has been moved or removed, like `WatchedFileHandler`.
+    def __init__(self, filename, queue_size=10000, encoding='utf-8'):
+        super().__init__(queue.Queue(queue_size))
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.target = logging.handlers.WatchedFileHandler(filename, encoding=encoding, delay=True)
+        self.dropped = 0
+        self.listener = None
+        self._start()
+        _handlers.add(self)
+
+    def _start(self):
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None:
+            # Writes whatever is still queued.
+            self.listener.stop()
+            self.listener = None
+        self.target.close()
+        super().close()
+
+    def _after_fork(self):
+        # The listener thread does not survive a fork, give the child its own. The parent's
+        # listener may have been writing at the time, leaving the inherited stream's buffer
+        # locked for good: keep it out of the way and reopen the file on the next record.
+        if self.target.stream is not None:
+            _inherited_streams.append(self.target.stream)
+            self.target.stream = None
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.dropped = 0
+        self._start()
+
+
+def _restart_after_fork():
+    for handler in list(_handlers):
+        if handler.listener is not None:
+            handler._after_fork()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+class SqlSampleFilter(logging.Filter):
+    # Thins out `django.db.backends` query records. Queries taking at least `slow_ms` are always
+    # kept; in 'slow' mode nothing else is, in 'sampled' mode a `sample_rate` share of the rest
+    # is kept, at most `max_per_second` of them. 'all' keeps every query and 'off' none.
+    def __init__(self, mode='sampled', sample_rate=0.01, slow_ms=200, max_per_second=50):
+        super().__init__()
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_per_second = max_per_second
+
+        self._tokens = max_per_second
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take_token(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_per_second, self._tokens + (now - self._refilled_at) * self.max_per_second)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def filter(self, record):
+        if self.mode == 'all':
+            return True
+        if self.mode == 'off':
+            return False
+
+        duration = getattr(record, 'duration', None)
+        if duration is not None and duration * 1000 >= self.slow_ms:
+            return True
+        if self.mode == 'slow':
+            return False
+        return random.random() < self.sample_rate and self._take_token()
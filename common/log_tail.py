@@ -0,0 +1,86 @@
+import os
+import re
+from itertools import islice
+
+from django.contrib.admin.utils import unquote
+from log_viewer import settings
+from log_viewer.views import LogJsonView
+
+BLOCK_SIZE = 64 * 1024
+
+
+def lines_reversed(file, block_size=BLOCK_SIZE):
+    # Yields the lines of a binary file from the last to the first, reading fixed size blocks
+    # backwards from the end. Only the requested part of a large file is ever read.
+    file.seek(0, os.SEEK_END)
+    position = file.tell()
+    remainder = b''
+    while position > 0:
+        size = min(block_size, position)
+        position -= size
+        file.seek(position)
+        block = file.read(size) + remainder
+        lines = block.split(b'\n')
+        # The first piece may continue in the previous block.
+        remainder = lines.pop(0)
+        for line in reversed(lines):
+            yield line.decode('utf-8', errors='ignore')
+    yield remainder.decode('utf-8', errors='ignore')
+
+
+def entries_reversed(file, patterns=None, exclude=None):
+    # Groups lines into log entries, newest first. An entry starts at a line beginning with one of
+    # `patterns` (LOG_VIEWER_PATTERNS), so tracebacks stay with the record that logged them.
+    patterns = tuple(settings.LOG_VIEWER_PATTERNS if patterns is None else patterns)
+    lines = []
+    for line in lines_reversed(file):
+        if not line and not lines:
+            continue
+        lines.append(line)
+        if line.startswith(patterns):
+            entry = '\n'.join(reversed(lines))
+            lines = []
+            if not (exclude and re.search(exclude, entry)):
+                yield entry
+    if lines:
+        yield '\n'.join(reversed(lines))
+
+
+class LogTailJsonView(LogJsonView):
+    # django-log-viewer's JSON view, reading pages from the end of the file instead of
+    # stepping back through it one character at a time.
+    def get_log_json(self, original_context={}):
+        file_name = unquote(original_context.get('file_name', '')).replace('/..', '').replace('..', '')
+        context = super().get_log_json({**original_context, 'file_name': ''})
+        if not file_name:
+            return context
+
+        page = int(original_context.get('page', 1))
+        lines_per_page = settings.LOG_VIEWER_MAX_READ_LINES
+        path = os.path.join(settings.LOG_VIEWER_FILES_DIR, file_name)
+        try:
+            with open(path, 'rb') as file:
+                entries = entries_reversed(file, exclude=settings.LOG_VIEWER_EXCLUDE_TEXT_PATTERN)
+                logs = list(islice(entries, (page - 1) * lines_per_page, page * lines_per_page))
+        except OSError:
+            return context
+
+        context.update({
+            'original_file_name': file_name,
+            'next_page': page + 1,
+            'last': len(logs) < lines_per_page,
+            'logs': logs,
+            'current_file': file_name,
+            'file': path,
+        })
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        # The parent expects an open file under 'file', this view only keeps its path.
+        log_json = self.get_log_json(context)
+        context.pop('view', None)
+        context.update(**log_json)
+        return self.render_to_json_response(context, **response_kwargs)
+
+
+log_tail_json = LogTailJsonView.as_view()
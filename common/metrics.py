@@ -0,0 +1,257 @@
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+
+# Seconds, from sub-millisecond encodes up to multi-minute generations.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SNAPSHOTS_KEY = 'metrics:snapshots'
+SNAPSHOT_MAX_AGE = 300
+
+logger = logging.getLogger('error')
+
+_flag = [True, float('-inf')]
+_last_flush = [0.0]
+_flusher_pid = [None]
+_flusher_lock = threading.Lock()
+
+
+def enabled():
+    # Reads the constance flag at most once per METRICS_FLAG_TTL seconds. Any thread may ask,
+    # including ones whose database connection is gone, so a failed read keeps the last value.
+    value, checked_at = _flag
+    now = time.monotonic()
+    if now - checked_at > settings.METRICS_FLAG_TTL:
+        try:
+            from constance import config
+            value = _flag[0] = bool(config.METRICS_ENABLED)
+        except Exception:
+            logger.exception('Could not read METRICS_ENABLED')
+        _flag[1] = now
+    return value
+
+
+def _never_raises(method):
+    # Metrics must not fail the code they measure.
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            logger.exception('Could not record a metric')
+    return wrapper
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @_never_raises
+    def inc(self, amount=1, **labels):
+        if not enabled():
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @_never_raises
+    def observe(self, value, **labels):
+        if not enabled():
+            return
+        key = _label_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total]] for key, (counts, total) in self._values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args)
+            return self.metrics[name]
+
+    def counter(self, name, documentation):
+        return self._get(Counter, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, buckets)
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+registry = Registry()
+
+queue_wait = registry.histogram('task_queue_wait_seconds', 'Time tasks spent in the broker queue.')
+task_duration = registry.histogram('task_duration_seconds', 'Celery task run time.')
+model_load = registry.histogram('model_load_seconds', 'Time to build and warm up a model.')
+compile_time = registry.histogram('compile_seconds', 'Calls that traced and compiled a new function.')
+inference_step = registry.histogram('inference_step_seconds', 'Time per diffusion or DeepDream step.')
+encode_time = registry.histogram('encode_seconds', 'Time to encode an image.')
+save_time = registry.histogram('save_seconds', 'Time to write an image to storage.')
+cache_requests = registry.counter('cache_requests_total', 'Cache lookups by cache and result.')
+coalesced_requests = registry.counter('coalesced_requests_total', 'Requests that joined an identical one in flight.')
+batch_size = registry.histogram('batch_size', 'Requests per inference batch.', buckets=(1, 2, 4, 8, 16, 32, 64))
+
+
+def flush(force=False):
+    # Publishes this process's metrics so the exposition endpoint, which runs in one web process,
+    # can include Celery workers and the other web processes. Called after every task and by the
+    # flusher thread, but writes at most once per interval.
+    now = time.monotonic()
+    if not force and now - _last_flush[0] < settings.METRICS_FLUSH_INTERVAL:
+        return
+    _last_flush[0] = now
+
+    from django_redis import get_redis_connection
+    from django.core.cache import cache
+
+    snapshot = {'time': time.time(), 'metrics': registry.snapshot()}
+    get_redis_connection('default').hset(
+        cache.make_key(SNAPSHOTS_KEY), f'{socket.gethostname()}:{os.getpid()}', json.dumps(snapshot))
+
+
+def start_flusher():
+    # Flushes every METRICS_FLUSH_INTERVAL seconds from a daemon thread, for processes such as
+    # web servers that have no per-task hook. Threads do not survive a fork, so every process
+    # starts its own.
+    pid = os.getpid()
+    with _flusher_lock:
+        if _flusher_pid[0] == pid:
+            return
+        _flusher_pid[0] = pid
+    threading.Thread(target=_flush_periodically, daemon=True, name='metrics-flush').start()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            flush(force=True)
+        except Exception:
+            logger.exception('Could not flush metrics')
+
+
+def collect():
+    # Merges this process's metrics with every recently flushed snapshot of other processes.
+    from django_redis import get_redis_connection
+    from django.core.cache import cache
+
+    redis = get_redis_connection('default')
+    key = cache.make_key(SNAPSHOTS_KEY)
+    own = f'{socket.gethostname()}:{os.getpid()}'
+    snapshots = [registry.snapshot()]
+    for process, value in redis.hgetall(key).items():
+        snapshot = json.loads(value)
+        if time.time() - snapshot['time'] > SNAPSHOT_MAX_AGE:
+            redis.hdel(key, process)
+        elif process.decode() != own:
+            snapshots.append(snapshot['metrics'])
+
+    merged = {}
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            metric = merged.setdefault(name, {})
+            for labels, value in values:
+                labels = tuple(tuple(label) for label in labels)
+                if labels not in metric:
+                    metric[labels] = value
+                elif isinstance(value, list):
+                    counts, total = metric[labels]
+                    metric[labels] = [[a + b for a, b in zip(counts, value[0])], total + value[1]]
+                else:
+                    metric[labels] += value
+    return merged
+
+
+def _escape_label(value):
+    # Label values of the text exposition format escape backslashes, double quotes and newlines.
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def render():
+    lines = []
+    for name, values in collect().items():
+        metric = registry.metrics.get(name)
+        if metric is None:
+            continue
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for labels, value in values.items():
+            if metric.kind == 'counter':
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4')
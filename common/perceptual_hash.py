@@ -0,0 +1,79 @@
+import functools
+from itertools import combinations
+
+import numpy as np
+
+# The hash keeps the signs of the lowest HASH_SIZE x HASH_SIZE frequencies of a DCT_SIZE square
+# grayscale thumbnail, relative to their median: 64 bits that survive re-encoding, resizing and
+# small edits, so near-identical images differ in few of them.
+HASH_SIZE = 8
+DCT_SIZE = 32
+# Parts the hash is split into for multi-index hashing, see `GeneratedImageQuerySet.similar`.
+CHUNKS = 4
+CHUNK_BITS = HASH_SIZE * HASH_SIZE // CHUNKS
+
+# ITU-R 601 luma, as Pillow's 'L' conversion.
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+@functools.lru_cache
+def _area_matrix(in_size, out_size):
+    # Averages `in_size` pixels into `out_size` equal spans, pixels on a border weighted by
+    # their overlap, so resizing a batch is two matrix products.
+    edges = np.linspace(0, in_size, out_size + 1)
+    pixels = np.arange(in_size)
+    overlap = np.clip(
+        np.minimum(edges[1:, None], pixels + 1) - np.maximum(edges[:-1, None], pixels), 0, None)
+    return (overlap / overlap.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+@functools.lru_cache
+def _dct_matrix(size):
+    # Orthonormal DCT-II.
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def perceptual_hashes(images):
+    # Hashes of a batch of RGB images (N, H, W, 3), uint8 or floats in any range, as signed
+    # 64 bit integers (a PostgreSQL bigint).
+    images = np.asarray(images)
+    _, height, width, _ = images.shape
+    gray = images[..., :3].astype(np.float32) @ LUMA
+    small = _area_matrix(height, DCT_SIZE) @ gray @ _area_matrix(width, DCT_SIZE).T
+    dct = _dct_matrix(DCT_SIZE)[:HASH_SIZE]
+    low = (dct @ small @ dct.T).reshape(len(images), -1)
+    # The DC term is the mean brightness, not structure.
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    bits = np.packbits(low > median, axis=1)
+    return [int(value) for value in bits.view('>i8').ravel()]
+
+
+def perceptual_hash(image):
+    # Hash of one PIL image.
+    return perceptual_hashes(np.asarray(image.convert('RGB'))[None])[0]
+
+
+def hamming_distance(a, b):
+    # Number of differing bits between two hashes.
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+def hash_chunks(value):
+    # The CHUNKS parts of a hash, most significant first, as unsigned integers.
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (CHUNK_BITS * (CHUNKS - 1 - i))) & mask for i in range(CHUNKS)]
+
+
+def chunk_neighbours(chunk, distance):
+    # Every chunk value differing from `chunk` in at most `distance` bits.
+    values = [chunk]
+    for count in range(1, distance + 1):
+        for positions in combinations(range(CHUNK_BITS), count):
+            flipped = chunk
+            for position in positions:
+                flipped ^= 1 << position
+            values.append(flipped)
+    return values
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django_redis import get_redis_connection
+
+from common import metrics
+from common.encoding import get_encoder
+from common.storage import gather, get_upload_queue
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def model_version():
+    if settings.STABLE_DIFFUSION_MODEL_VERSION:
+        return settings.STABLE_DIFFUSION_MODEL_VERSION
+    return f'{settings.STABLE_DIFFUSION_BACKEND}:{Path(settings.STABLE_DIFFUSION_WEIGHTS_PATH).name}'
+
+
+def result_key(prompt, seed, steps, guidance, model_version, width, height):
+    params = {
+        'prompt': prompt,
+        'seed': seed,
+        'steps': steps,
+        'guidance': guidance,
+        'model_version': model_version,
+        'width': width,
+        'height': height,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def generation_key(prompt, num_steps=50, seed=None, guidance=7.5):
+    return result_key(
+        prompt, seed, num_steps, guidance, model_version(),
+        settings.STABLE_DIFFUSION_IMAGE_WIDTH, settings.STABLE_DIFFUSION_IMAGE_HEIGHT,
+    )
+
+
+class ResultCache:
+    # Generated images addressed by the hash of everything that determines them.
+    # Metadata (the stored file names) lives in the default cache, the JPEG bytes in the media
+    # storage. A Redis sorted set ordered by last access drives LRU eviction once the entry or
+    # byte caps are exceeded, and drops entries not read for `ttl` seconds.
+    def __init__(self, ttl, max_entries, max_bytes, prefix='generated'):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+        self._lru_key = cache.make_key('result_cache:lru')
+        self._sizes_key = cache.make_key('result_cache:sizes')
+        self._total_key = cache.make_key('result_cache:total')
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    def _meta_key(self, key):
+        return f'result_cache:{key}'
+
+    def _names(self, key, count):
+        return [f'{self.prefix}/{key[:2]}/{key}_{i}.jpg' for i in range(count)]
+
+    def get(self, key):
+        meta = cache.get(self._meta_key(key))
+        if meta is None:
+            metrics.cache_requests.inc(cache='result', result='miss')
+            return None
+        metrics.cache_requests.inc(cache='result', result='hit')
+        # Entries read within `ttl` are kept, like their place in the LRU order.
+        cache.touch(self._meta_key(key), self.ttl)
+        self.redis.zadd(self._lru_key, {key: time.time()})
+        return meta['names']
+
+    async def aget(self, key):
+        return await sync_to_async(self.get, thread_sensitive=False)(key)
+
+    def put(self, key, images):
+        # Returns a future resolving to the names once every file is written and the entry is
+        # recorded; the caller, usually the inference thread, does not wait for either.
+        # Every image of the batch is encoded in parallel, straight from the model output buffers,
+        # and written from the upload queue. Content addressed, so existing files are kept.
+        names = self._names(key, len(images))
+        encoder = get_encoder()
+        uploads = get_upload_queue()
+        started = time.perf_counter()
+        encoded = [encoder.submit(img) for img in images]
+        for future in encoded:
+            future.add_done_callback(
+                lambda _: metrics.encode_time.observe(time.perf_counter() - started, format='JPEG'))
+        stored = gather(uploads.submit_encoded(name, future) for name, future in zip(names, encoded))
+
+        recorded = Future()
+
+        def record(done):
+            # The metadata must not point at files that are not written yet.
+            try:
+                done.result()
+                self._record(key, names, sum(len(future.result()) for future in encoded))
+            except Exception as exc:
+                recorded.set_exception(exc)
+            else:
+                recorded.set_result(names)
+
+        stored.add_done_callback(record)
+        return recorded
+
+    def _record(self, key, names, size):
+        cache.set(self._meta_key(key), {'names': names}, timeout=self.ttl)
+        redis = self.redis
+        redis.zadd(self._lru_key, {key: time.time()})
+        if redis.hsetnx(self._sizes_key, key, f'{size}:{len(names)}'):
+            redis.incrby(self._total_key, size)
+        self.evict()
+
+    def delete(self, key):
+        redis = self.redis
+        value = redis.hget(self._sizes_key, key)
+        redis.zrem(self._lru_key, key)
+        cache.delete(self._meta_key(key))
+        if value is None:
+            return
+
+        size, count = map(int, value.decode().split(':'))
+        for name in self._names(key, count):
+            default_storage.delete(name)
+        if redis.hdel(self._sizes_key, key):
+            redis.decrby(self._total_key, size)
+
+    def evict(self):
+        redis = self.redis
+        for key in redis.zrangebyscore(self._lru_key, 0, time.time() - self.ttl):
+            self.delete(key.decode())
+
+        while (redis.zcard(self._lru_key) > self.max_entries
+               or int(redis.get(self._total_key) or 0) > self.max_bytes):
+            oldest = redis.zrange(self._lru_key, 0, 0)
+            if not oldest:
+                break
+            self.delete(oldest[0].decode())
+
+
+def get_result_cache():
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(
+                ttl=settings.RESULT_CACHE_TTL,
+                max_entries=settings.RESULT_CACHE_MAX_ENTRIES,
+                max_bytes=settings.RESULT_CACHE_MAX_BYTES,
+            )
+        return _result_cache
@@ -0,0 +1,127 @@
+import math
+import statistics
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+GenerationPlan = namedtuple('GenerationPlan', ['num_steps', 'estimated_seconds', 'degraded'])
+DreamPlan = namedtuple('DreamPlan', ['steps_per_octave', 'octaves', 'max_dim', 'estimated_seconds', 'degraded'])
+
+
+def octave_work(octaves, octave_scale, max_dim):
+    # Pixels processed per step summed over the octaves, for a square image of `max_dim`.
+    return sum((max_dim * octave_scale ** octave) ** 2 for octave in octaves)
+
+
+class AdaptiveScheduler:
+    # Picks per job parameters so that queueing plus running stays within the configured latency
+    # target. Recent per unit timings (seconds per diffusion step, seconds per DeepDream pixel
+    # step) are shared by every process through Redis; the queue depth comes from the caller.
+    #
+    # A job queued behind `depth` others on `capacity` parallel slots expects to wait about
+    # `depth / capacity` job lengths, so its own budget is `target / (depth / capacity + 1)`.
+    # Jobs are degraded step count first, then octaves, then resolution, never below the
+    # configured minimums.
+    def __init__(self, window=50, refresh_interval=5, prefix='scheduler'):
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.prefix = prefix
+
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    def _key(self, kind):
+        return cache.make_key(f'{self.prefix}:{kind}')
+
+    def record(self, kind, seconds, work):
+        # `work` is in the kind's unit, diffusion steps or DeepDream pixel steps.
+        if work <= 0:
+            return
+        pipeline = self.redis.pipeline()
+        pipeline.lpush(self._key(kind), seconds / work)
+        pipeline.ltrim(self._key(kind), 0, self.window - 1)
+        pipeline.execute()
+        with self._lock:
+            self._timings.pop(kind, None)
+
+    def unit_time(self, kind):
+        # Median seconds per unit of work over the recent window, None before any run.
+        now = time.monotonic()
+        with self._lock:
+            cached = self._timings.get(kind)
+            if cached is not None and now - cached[1] < self.refresh_interval:
+                return cached[0]
+
+        values = [float(value) for value in self.redis.lrange(self._key(kind), 0, -1)]
+        value = statistics.median(values) if values else None
+        with self._lock:
+            self._timings[kind] = (value, now)
+        return value
+
+    def budget(self, target, depth):
+        from constance import config
+
+        return target / (depth / max(config.SCHEDULER_CAPACITY, 1) + 1)
+
+    def plan_generation(self, num_steps, depth):
+        from constance import config
+
+        step_time = self.unit_time('stable_diffusion')
+        if not config.SCHEDULER_ENABLED or step_time is None:
+            return GenerationPlan(num_steps, step_time and step_time * num_steps, False)
+
+        budget = self.budget(config.GENERATION_LATENCY_TARGET, depth)
+        steps = max(min(num_steps, int(budget / step_time)), min(config.GENERATION_MIN_STEPS, num_steps))
+        return GenerationPlan(steps, steps * step_time, steps < num_steps)
+
+    def plan_dream(self, steps_per_octave, octaves, max_dim, depth, octave_scale=1.3):
+        from constance import config
+
+        octaves = list(octaves)
+        pixel_step_time = self.unit_time('deep_dream')
+        if not config.SCHEDULER_ENABLED or pixel_step_time is None:
+            return DreamPlan(steps_per_octave, octaves, max_dim, None, False)
+
+        def estimate(steps, octaves, max_dim):
+            return pixel_step_time * steps * octave_work(octaves, octave_scale, max_dim)
+
+        budget = self.budget(config.DEEP_DREAM_LATENCY_TARGET, depth)
+        requested = (steps_per_octave, len(octaves), max_dim)
+
+        min_steps = min(config.DEEP_DREAM_MIN_STEPS, steps_per_octave)
+        steps = int(budget / estimate(1, octaves, max_dim))
+        steps = max(min(steps_per_octave, steps), min_steps)
+
+        # Dropping the largest octaves removes most of the work.
+        min_octaves = min(config.DEEP_DREAM_MIN_OCTAVES, len(octaves))
+        while len(octaves) > min_octaves and estimate(steps, octaves, max_dim) > budget:
+            octaves.pop()
+
+        overshoot = estimate(steps, octaves, max_dim) / budget
+        if overshoot > 1:
+            max_dim = max(int(max_dim / math.sqrt(overshoot)), min(config.DEEP_DREAM_MIN_DIM, max_dim))
+
+        return DreamPlan(steps, octaves, max_dim, estimate(steps, octaves, max_dim),
+                         (steps, len(octaves), max_dim) != requested)
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = AdaptiveScheduler(
+                window=settings.SCHEDULER_TIMING_WINDOW,
+                refresh_interval=settings.SCHEDULER_REFRESH_INTERVAL,
+            )
+        return _scheduler
@@ -0,0 +1,84 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+# Frees the key only while it is still held by the releasing leader, as one atomic step.
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return false
+end
+local followers = redis.call('lrange', KEYS[2], 0, -1)
+redis.call('del', KEYS[1], KEYS[2])
+return followers
+"""
+
+
+class SingleFlight:
+    # Cluster wide single flight over Redis. The first caller for a key becomes its leader and
+    # stores its id (e.g. a task id) under the key; later callers join as followers while the
+    # leader runs, and the leader collects them when it finishes to hand them the result.
+    # The lock expires after `ttl` seconds, so a crashed leader cannot hold a key forever; its
+    # followers are lost with it and must be resubmitted by the caller once `leader` no longer
+    # returns their leader. A leader
+    # only ever releases its own lock, never that of a leader that took over after expiry.
+    def __init__(self, ttl=600, prefix='single_flight'):
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    def _lock_key(self, key):
+        return cache.make_key(f'{self.prefix}:{key}')
+
+    def _followers_key(self, key):
+        return cache.make_key(f'{self.prefix}:{key}:followers')
+
+    def acquire(self, key, leader, follower):
+        # Returns None when `leader` now leads `key`, otherwise the id of the running leader,
+        # which `follower` has been registered with.
+        lock_key, followers_key = self._lock_key(key), self._followers_key(key)
+        with self.redis.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(lock_key)
+                    current = pipeline.get(lock_key)
+                    pipeline.multi()
+                    if current is None:
+                        pipeline.set(lock_key, leader, ex=self.ttl)
+                        pipeline.delete(followers_key)
+                    else:
+                        pipeline.rpush(followers_key, follower)
+                        pipeline.expire(followers_key, self.ttl)
+                    # Fails if the leader released the key in the meantime, then retry.
+                    pipeline.execute()
+                except WatchError:
+                    continue
+                return None if current is None else current.decode()
+
+    def leader(self, key):
+        # The id of the leader holding `key`, None once it released the key or its lock expired.
+        leader = self.redis.get(self._lock_key(key))
+        return None if leader is None else leader.decode()
+
+    def release(self, key, leader):
+        # Frees `key` if `leader` still holds it and returns the followers that joined it, new
+        # callers lead again. Returns no followers once the lock expired.
+        release = self.redis.register_script(RELEASE_SCRIPT)
+        followers = release(keys=[self._lock_key(key), self._followers_key(key)], args=[leader])
+        return [follower.decode() for follower in followers or []]
+
+
+def get_single_flight():
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight(ttl=settings.SINGLE_FLIGHT_TTL)
+        return _single_flight
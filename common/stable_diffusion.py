@@ -1,32 +1,157 @@
-import asyncio
-import random
-import string
+import hashlib
+import threading
+import time
+from concurrent.futures import Future
 
-import PIL.Image
-import keras_cv
-import matplotlib.pyplot as plt
 import numpy as np
-import tensorflow as tf
+from django.conf import settings
 
+from common import metrics
+from common.batching import MicroBatcher
+from common.embedding_cache import cache_unconditional_context, get_embedding_cache
+from common.encoding import get_encoder, shutdown_encoder, to_array
+from common.generation_service import get_generation_service
+from common.result_cache import generation_key, get_result_cache
+from common.scheduler import get_scheduler
+from common.storage import close_upload_queue, gather, get_upload_queue
 
-def generate_random_string(length=6):
-    # Define the characters to choose from
-    characters = string.ascii_letters + string.digits  # You can customize this if needed
+# The model and batcher resident in this process, see `get_model` and `get_batcher`.
+_model = None
+_model_lock = threading.Lock()
+_batcher = None
+_batcher_lock = threading.Lock()
 
-    # Generate the random string
-    random_string = ''.join(random.choice(characters) for _ in range(length))
 
-    return random_string
+class DummyStableDiffusion:
+    # A tiny stand-in with the same generation interface as `keras_cv.models.StableDiffusion`.
+    # It needs neither weights nor a GPU, so the model pool can be exercised on CPU.
+    def __init__(self, img_height=64, img_width=64):
+        self.img_height = img_height
+        self.img_width = img_width
+
+    def encode_text(self, prompt):
+        seed = int.from_bytes(hashlib.sha256(prompt.encode()).digest()[:8], 'little')
+        return np.random.default_rng(seed).standard_normal((1, 77, 16), dtype=np.float32)
+
+    def _get_unconditional_context(self):
+        return self.encode_text('')
+
+    def _get_initial_diffusion_noise(self, batch_size, seed):
+        rng = np.random.default_rng(seed)
+        return rng.standard_normal((batch_size, self.img_height // 8, self.img_width // 8, 4), dtype=np.float32)
+
+    def generate_image(self, encoded_text, negative_prompt=None, batch_size=1, num_steps=50,
+                       unconditional_guidance_scale=7.5, diffusion_noise=None, seed=None):
+        encoded_text = np.asarray(encoded_text)
+        if encoded_text.ndim == 2:
+            encoded_text = encoded_text[np.newaxis]
+        if encoded_text.shape[0] == 1:
+            encoded_text = np.repeat(encoded_text, batch_size, axis=0)
+        if diffusion_noise is None:
+            diffusion_noise = self._get_initial_diffusion_noise(batch_size, seed)
+        if negative_prompt is None:
+            unconditional_context = self._get_unconditional_context()
+        else:
+            unconditional_context = self.encode_text(negative_prompt)
+        guidance = unconditional_guidance_scale * float(np.asarray(unconditional_context).sum())
+
+        images = []
+        for context, noise in zip(encoded_text, np.asarray(diffusion_noise)):
+            entropy = [int.from_bytes(hashlib.sha256(noise.tobytes()).digest()[:8], 'little'),
+                       int(abs(context.sum() + guidance) * 1e6)]
+            rng = np.random.default_rng(entropy)
+            images.append(rng.integers(0, 256, (self.img_height, self.img_width, 3), dtype=np.uint8))
+        return np.stack(images)
+
+    def text_to_image(self, prompt, negative_prompt=None, batch_size=1, num_steps=50,
+                      unconditional_guidance_scale=7.5, seed=None):
+        encoded_text = self.encode_text(prompt)
+        return self.generate_image(encoded_text, negative_prompt=negative_prompt, batch_size=batch_size,
+                                   num_steps=num_steps, unconditional_guidance_scale=unconditional_guidance_scale,
+                                   seed=seed)
+
+
+def build_model():
+    if settings.STABLE_DIFFUSION_BACKEND == 'dummy':
+        return cache_unconditional_context(DummyStableDiffusion(), get_embedding_cache())
+
+    # Only inference workers get here, the web tier imports this module without loading TensorFlow.
+    import keras_cv
+    import tensorflow as tf
+
+    tf.keras.mixed_precision.set_global_policy("mixed_float16")
+    model = keras_cv.models.StableDiffusion(
+        img_width=settings.STABLE_DIFFUSION_IMAGE_WIDTH,
+        img_height=settings.STABLE_DIFFUSION_IMAGE_HEIGHT,
+        jit_compile=True,
+    )
+    if settings.STABLE_DIFFUSION_WEIGHTS_PATH:
+        model.diffusion_model.load_weights(settings.STABLE_DIFFUSION_WEIGHTS_PATH)
+
+    # Run a single step so the text encoder, diffusion model and decoder are traced and
+    # XLA-compiled now instead of on the first real request.
+    model.text_to_image('warm up', batch_size=1, num_steps=1)
+    return cache_unconditional_context(model, get_embedding_cache())
+
+
+def get_model():
+    # Builds the model on first use and keeps it for the lifetime of the process.
+    # Inference workers call this from `worker_process_init` so tasks never pay for it.
+    global _model
+    with _model_lock:
+        if _model is None:
+            with metrics.model_load.time(model='stable_diffusion'):
+                _model = build_model()
+        return _model
+
+
+def release_model():
+    global _model, _batcher
+    with _batcher_lock:
+        if _batcher is not None:
+            _batcher.close()
+            _batcher = None
+    with _model_lock:
+        _model = None
+
+
+def get_batcher():
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(
+                _generate_batch,
+                max_batch_size=settings.STABLE_DIFFUSION_MAX_BATCH_SIZE,
+                max_wait=settings.STABLE_DIFFUSION_MAX_BATCH_WAIT,
+            )
+        return _batcher
+
+
+def _generate_batch(requests, num_steps=50):
+    # Batcher requests are (prompt, seed) pairs, so prompts with different seeds share a run.
+    prompts, seeds = zip(*requests)
+    return generate_photos(list(prompts), num_steps=num_steps, seeds=list(seeds))
 
 
 def save(img):
-    pil_img = PIL.Image.fromarray(np.array(img))
-    name = generate_random_string()
-    pil_img.save(
-        f'/home/shaghayegh/image-weaver/media/experiments/{name}.jpg')
+    # Read the image buffer in place, encode and store it in the background.
+    array = np.ascontiguousarray(to_array(img))
+    # Name the file after its pixels so distinct images never collide.
+    name = hashlib.sha256(array).hexdigest()[:32]
+    path = f'experiments/{name}.jpg'
+    # Stored under MEDIA_ROOT (or the configured bucket) from the upload queue's threads.
+    get_upload_queue().submit_encoded(path, get_encoder().submit(array))
+    return path
+
+
+def encode_prompt(model, prompt):
+    # The text encoder stage on its own, cached so repeated prompts skip it entirely.
+    return get_embedding_cache().get_or_encode(prompt, model.encode_text)
 
 
 def plot_images(images):
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(20, 20))
     for i in range(len(images)):
         plt.subplot(1, len(images), i + 1)
@@ -35,20 +160,87 @@ def plot_images(images):
         save(images[i])
 
 
-async def generate_photo():
-    model_path = '/home/shaghayegh/Downloads/kcv_diffusion_model.h5'
-    tf.keras.mixed_precision.set_global_policy("mixed_float16")
-    model = keras_cv.models.StableDiffusion(jit_compile=True)
-    images = model.text_to_image("photograph of an astronaut riding a horse", batch_size=1)
-    model.load_model(model_path)
-    plot_images(images)
+def diffusion_noise(model, seeds):
+    # The initial noise of each image drawn from its own seed, exactly as a run of that image
+    # alone would draw it, so a seeded image does not depend on the batch it ran in. Unseeded
+    # images get random noise.
+    return np.concatenate([np.asarray(model._get_initial_diffusion_noise(1, seed)) for seed in seeds], axis=0)
+
+
+def generate_photos(prompts, num_steps=50, seeds=None):
+    # Runs several prompts through a single batched diffusion call, one image per prompt and
+    # seed (None for a random one).
+    seeds = seeds or [None] * len(prompts)
+    model = get_model()
+    started = time.perf_counter()
+    encoded_text = np.concatenate([encode_prompt(model, prompt) for prompt in prompts], axis=0)
+    images = model.generate_image(encoded_text, batch_size=len(prompts), num_steps=num_steps,
+                                  diffusion_noise=diffusion_noise(model, seeds))
+    elapsed = time.perf_counter() - started
+    metrics.inference_step.observe(elapsed / num_steps, model='stable_diffusion')
+    get_scheduler().record('stable_diffusion', elapsed, num_steps)
+    metrics.batch_size.observe(len(prompts), model='stable_diffusion')
+    return images
+
 
+def generate_photo(prompt, batch_size=1, num_steps=50, seed=None):
+    if batch_size == 1 and settings.STABLE_DIFFUSION_MAX_BATCH_SIZE > 1:
+        # Share a diffusion run with prompts submitted concurrently from other threads.
+        image = get_batcher().submit((prompt, seed), num_steps=num_steps).result()
+        return np.expand_dims(image, axis=0)
 
-async def process_prompt(prompt):
-    loop = asyncio.get_event_loop()
-    images = await loop.run_in_executor(None, generate_photo, prompt)
+    model = get_model()
+    started = time.perf_counter()
+    encoded_text = encode_prompt(model, prompt)
+    images = model.generate_image(encoded_text, batch_size=batch_size, num_steps=num_steps, seed=seed)
+    elapsed = time.perf_counter() - started
+    metrics.inference_step.observe(elapsed / num_steps, model='stable_diffusion')
+    get_scheduler().record('stable_diffusion', elapsed, num_steps)
     return images
 
 
+def store_images(images, prefix='generated'):
+    # Stores images that are not cached, named after their pixels. Returns a future resolving to
+    # the names once they are written.
+    arrays = [np.ascontiguousarray(to_array(img)) for img in images]
+    encoder, uploads = get_encoder(), get_upload_queue()
+    stored = []
+    for array in arrays:
+        name = hashlib.sha256(array).hexdigest()[:32]
+        stored.append(uploads.submit_encoded(f'{prefix}/{name[:2]}/{name}.jpg', encoder.submit(array)))
+    return gather(stored)
+
+
+def generate_and_save(prompt, num_steps=50, seed=None):
+    # Returns a future resolving to the media storage names of the images once they are stored,
+    # generating them only on a cache miss. The encodes and uploads finish in the background, so
+    # the caller's thread is free for the next generation as soon as this returns.
+    # Unseeded generations differ on every run, so they are neither looked up nor cached.
+    if seed is None:
+        return store_images(generate_photo(prompt, num_steps=num_steps))
+
+    result_cache = get_result_cache()
+    key = generation_key(prompt, num_steps=num_steps, seed=seed)
+    names = result_cache.get(key)
+    if names is None:
+        return result_cache.put(key, generate_photo(prompt, num_steps=num_steps, seed=seed))
+    cached = Future()
+    cached.set_result(names)
+    return cached
+
+
+async def process_prompt(prompt, timeout=None):
+    return await get_generation_service().submit(generate_photo, prompt, timeout=timeout)
+
+
 if __name__ == '__main__':
-    asyncio.run(generate_photo())
+    import os
+
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_weaver.settings')
+    django.setup()
+    plot_images(generate_photo("photograph of an astronaut riding a horse"))
+    # Let the background encodes and uploads finish before exiting.
+    shutdown_encoder()
+    close_upload_queue()
@@ -0,0 +1,313 @@
+import io
+import logging
+import mimetypes
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import Storage, default_storage
+from django.utils.deconstruct import deconstructible
+
+from common import metrics
+
+logger = logging.getLogger('info')
+
+_upload_queue = None
+_upload_queue_lock = threading.Lock()
+
+
+class ObjectNotFound(Exception):
+    # Shaped like botocore's ClientError so callers handle both clients the same way.
+    def __init__(self, key):
+        super().__init__(key)
+        self.response = {'Error': {'Code': 'NoSuchKey', 'Key': key}}
+
+
+def _is_not_found(error):
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return code in ('404', 'NoSuchKey', 'NotFound')
+
+
+class LocalObjectClient:
+    # A stand-in for the subset of the S3 client API `S3Storage` uses, keeping objects as files
+    # under `root`. Lets the S3 code path run in development and tests without a bucket.
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, bucket, key):
+        return self.root / bucket / key
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(f'.{path.name}.part')
+        temporary.write_bytes(Body if isinstance(Body, bytes) else Body.read())
+        temporary.replace(path)
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        if not path.is_file():
+            raise ObjectNotFound(Key)
+        return {'Body': io.BytesIO(path.read_bytes()), 'ContentLength': path.stat().st_size}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        if not path.is_file():
+            raise ObjectNotFound(Key)
+        return {'ContentLength': path.stat().st_size}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._path(Bucket, Key).unlink(missing_ok=True)
+        return {}
+
+
+@deconstructible
+class S3Storage(Storage):
+    # Django storage on any S3-compatible object store (AWS, MinIO, Ceph...). The client is
+    # injectable; by default a boto3 client is built from the options, or a `LocalObjectClient`
+    # when `local_root` is set.
+    def __init__(self, bucket='', location='', endpoint_url=None, region_name=None, access_key=None,
+                 secret_key=None, base_url=None, local_root=None, client=None):
+        self.bucket = bucket
+        self.location = location.strip('/')
+        self.endpoint_url = endpoint_url or None
+        self.region_name = region_name or None
+        self.access_key = access_key or None
+        self.secret_key = secret_key or None
+        self.base_url = base_url or None
+        self.local_root = local_root or None
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = self._build_client()
+            return self._client
+
+    def _build_client(self):
+        if self.local_root:
+            return LocalObjectClient(self.local_root)
+        try:
+            import boto3
+        except ImportError as exc:
+            raise ImproperlyConfigured('S3Storage needs boto3, install it or set a local_root') from exc
+        return boto3.client(
+            's3',
+            endpoint_url=self.endpoint_url,
+            region_name=self.region_name,
+            aws_access_key_id=self.access_key,
+            aws_secret_access_key=self.secret_key,
+        )
+
+    def _key(self, name):
+        name = name.replace('\\', '/').lstrip('/')
+        return f'{self.location}/{name}' if self.location else name
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode:
+            raise ValueError('S3Storage files can only be opened for reading')
+        response = self.client.get_object(Bucket=self.bucket, Key=self._key(name))
+        return File(io.BytesIO(response['Body'].read()), name=name)
+
+    def _save(self, name, content):
+        content.seek(0)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.client.put_object(Bucket=self.bucket, Key=self._key(name), Body=content.read(),
+                               ContentType=content_type)
+        return name
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+        except Exception as exc:
+            if _is_not_found(exc):
+                return False
+            raise
+        return True
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+    def size(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(name))['ContentLength']
+
+    def url(self, name):
+        if self.base_url:
+            return f'{self.base_url.rstrip("/")}/{quote(self._key(name))}'
+        if self.local_root:
+            return f'{settings.MEDIA_URL}{quote(name)}'
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self._key(name)},
+        )
+
+    def path(self, name):
+        if self.local_root:
+            return str(self.client._path(self.bucket, self._key(name)))
+        return super().path(name)
+
+
+class UploadQueue:
+    # Writes files to `storage` from background threads so callers never wait on disk or
+    # network I/O. Uploads are queued up to `max_size` (callers block beyond that, which is the
+    # back pressure), drained in batches of up to `batch_size` and written concurrently.
+    # Failed writes are retried with exponential backoff before their future fails.
+    def __init__(self, storage=default_storage, max_size=256, batch_size=16, workers=4, max_retries=3,
+                 retry_delay=0.5):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._queue = queue.Queue(max_size)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, name, content, overwrite=False):
+        # Returns a future resolving to the stored name. Without `overwrite` an existing file
+        # is kept, which is what content addressed names want.
+        future = Future()
+        self._ensure_started()
+        self._queue.put((name, content, overwrite, future))
+        return future
+
+    def submit_encoded(self, name, encoded, overwrite=False):
+        # Queues the bytes of an encoder future once it resolves, without waiting for it here.
+        future = Future()
+
+        def enqueue(done):
+            try:
+                upload = self.submit(name, done.result(), overwrite)
+            except Exception as exc:
+                future.set_exception(exc)
+                return
+            upload.add_done_callback(lambda uploaded: _chain(uploaded, future))
+
+        encoded.add_done_callback(enqueue)
+        return future
+
+    def close(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='upload-queue', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish this batch, then stop.
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            started = time.monotonic()
+            wait([self._executor.submit(self._upload, *item) for item in batch])
+            logger.info('Uploaded batch of %d in %.3fs', len(batch), time.monotonic() - started)
+
+    def _upload(self, name, content, overwrite, future):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.save_time.time():
+                    if not overwrite and self.storage.exists(name):
+                        stored = name
+                    else:
+                        if overwrite:
+                            self.storage.delete(name)
+                        stored = self.storage.save(name, ContentFile(content))
+            except Exception as exc:
+                if attempt == self.max_retries:
+                    logger.error('Upload of %s failed after %d attempts: %s', name, attempt + 1, exc)
+                    future.set_exception(exc)
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
+            else:
+                future.set_result(stored)
+                return
+
+
+def _chain(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def gather(futures):
+    # A future resolving to the results of `futures` once all of them are done, or to the first
+    # of their exceptions, without waiting for any of them here.
+    futures = list(futures)
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        failed = next((future.exception() for future in futures if future.exception() is not None), None)
+        if failed is not None:
+            gathered.set_exception(failed)
+        else:
+            gathered.set_result([future.result() for future in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
+def get_upload_queue():
+    global _upload_queue
+    with _upload_queue_lock:
+        if _upload_queue is None:
+            _upload_queue = UploadQueue(
+                max_size=settings.UPLOAD_QUEUE_MAX_SIZE,
+                batch_size=settings.UPLOAD_QUEUE_BATCH_SIZE,
+                workers=settings.UPLOAD_QUEUE_WORKERS,
+                max_retries=settings.UPLOAD_QUEUE_MAX_RETRIES,
+                retry_delay=settings.UPLOAD_QUEUE_RETRY_DELAY,
+            )
+        return _upload_queue
+
+
+def close_upload_queue():
+    # Waits for the queued uploads, the next `get_upload_queue` starts a new queue.
+    global _upload_queue
+    with _upload_queue_lock:
+        upload_queue, _upload_queue = _upload_queue, None
+    if upload_queue is not None:
+        upload_queue.close()
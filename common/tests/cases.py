@@ -0,0 +1,40 @@
+import tempfile
+import threading
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from common.storage import LocalObjectClient
+
+
+class MediaTestCase(TestCase):
+    # Fresh Redis state and a temporary MEDIA_ROOT per test.
+    def setUp(self):
+        cache.clear()
+        # Upload threads would otherwise read the metrics flag over database connections of
+        # their own, which outlive the test database.
+        metrics_enabled = mock.patch('common.metrics.enabled', return_value=True)
+        metrics_enabled.start()
+        self.addCleanup(metrics_enabled.stop)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.media_root = media_root.name
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+
+class BlockingObjectClient(LocalObjectClient):
+    def __init__(self, root):
+        super().__init__(root)
+        self.unblocked = threading.Event()
+
+    def put_object(self, **kwargs):
+        self.unblocked.wait(5)
+        return super().put_object(**kwargs)
+
+
+class FailingObjectClient(LocalObjectClient):
+    def put_object(self, **kwargs):
+        raise OSError('bucket unavailable')
@@ -0,0 +1,81 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from common.batching import MicroBatcher
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def batcher(self, run_batch=None, **options):
+        self.batches = []
+
+        def record(prompts, **batch_options):
+            self.batches.append((prompts, batch_options))
+            return run_batch(prompts) if run_batch else [prompt.upper() for prompt in prompts]
+
+        batcher = MicroBatcher(record, **options)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def test_full_batch_runs_at_once_in_order(self):
+        batcher = self.batcher(max_batch_size=3, max_wait=30)
+        futures = [batcher.submit(prompt, num_steps=2) for prompt in ('a', 'b', 'c')]
+        self.assertEqual([future.result(5) for future in futures], ['A', 'B', 'C'])
+        self.assertEqual(self.batches, [(['a', 'b', 'c'], {'num_steps': 2})])
+
+    def test_partial_batch_runs_after_the_wait(self):
+        batcher = self.batcher(max_batch_size=4, max_wait=0.05)
+        futures = [batcher.submit(prompt) for prompt in ('a', 'b')]
+        self.assertEqual([future.result(5) for future in futures], ['A', 'B'])
+        self.assertEqual(self.batches, [(['a', 'b'], {})])
+        self.assertEqual(batcher.summary()['mean_fill_ratio'], 0.5)
+
+    def test_only_identical_options_share_a_batch(self):
+        batcher = self.batcher(max_batch_size=2, max_wait=0.05)
+        futures = [batcher.submit('a', num_steps=1), batcher.submit('b', num_steps=2)]
+        self.assertEqual([future.result(5) for future in futures], ['A', 'B'])
+        self.assertCountEqual(self.batches, [(['a'], {'num_steps': 1}), (['b'], {'num_steps': 2})])
+
+    def test_failure_reaches_every_caller(self):
+        def fail(prompts):
+            raise ValueError('out of memory')
+
+        batcher = self.batcher(fail, max_batch_size=2, max_wait=30)
+        futures = [batcher.submit(prompt) for prompt in ('a', 'b')]
+        for future in futures:
+            with self.assertRaisesMessage(ValueError, 'out of memory'):
+                future.result(5)
+        self.assertEqual(batcher.summary()['batches'], 1)
+
+    def test_cancelled_requests_are_skipped(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block(prompts):
+            started.set()
+            release.wait(5)
+            return prompts
+
+        batcher = self.batcher(block, max_batch_size=2, max_wait=0.01)
+        first = batcher.submit('a')
+        self.assertTrue(started.wait(5))
+        cancelled, kept = batcher.submit('b'), batcher.submit('c')
+        self.assertTrue(cancelled.cancel())
+        release.set()
+        self.assertEqual((first.result(5), kept.result(5)), ('a', 'c'))
+        self.assertEqual([prompts for prompts, _ in self.batches], [['a'], ['c']])
+
+    def test_summary(self):
+        batcher = self.batcher(max_batch_size=2, max_wait=30)
+        self.assertEqual(batcher.summary(), {'batches': 0})
+        for prompts in (('a', 'b'), ('c', 'd')):
+            for future in [batcher.submit(prompt) for prompt in prompts]:
+                future.result(5)
+        summary = batcher.summary()
+        self.assertEqual((summary['batches'], summary['mean_batch_size'], summary['mean_fill_ratio']), (2, 2, 1))
+        self.assertGreaterEqual(summary['max_queue_wait'], summary['mean_queue_wait'])
+
+    def test_closed_batcher_rejects_requests(self):
+        batcher = self.batcher()
+        batcher.close()
+        with self.assertRaises(RuntimeError):
+            batcher.submit('a')
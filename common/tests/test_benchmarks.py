@@ -0,0 +1,31 @@
+from django.test import SimpleTestCase
+
+from common.benchmarks import compare
+
+
+class CompareBenchmarksTests(SimpleTestCase):
+    def result(self, **metrics):
+        return [{'benchmark': 'bench', 'params': {'size': 1}, 'metrics': metrics}]
+
+    def regressions(self, old, new):
+        return compare(self.result(**new), self.result(**old), tolerance=0.2)
+
+    def test_timings_within_tolerance(self):
+        self.assertEqual(self.regressions({'median_ms': 10}, {'median_ms': 11.9}), [])
+        self.assertEqual(len(self.regressions({'median_ms': 10}, {'median_ms': 12.1})), 1)
+
+    def test_throughput_is_higher_is_better(self):
+        self.assertEqual(self.regressions({'images_per_sec': 10}, {'images_per_sec': 20}), [])
+        self.assertEqual(len(self.regressions({'images_per_sec': 10}, {'images_per_sec': 7})), 1)
+
+    def test_any_growth_of_a_count(self):
+        self.assertEqual(len(self.regressions({'trace_count': 10}, {'trace_count': 11})), 1)
+        self.assertEqual(self.regressions({'trace_count': 10}, {'trace_count': 9}), [])
+
+    def test_growth_from_zero(self):
+        self.assertEqual(len(self.regressions({'heavy_modules_count': 0}, {'heavy_modules_count': 1})), 1)
+        self.assertEqual(len(self.regressions({'peak_rss_delta_kb': 0}, {'peak_rss_delta_kb': 5})), 1)
+        self.assertEqual(self.regressions({'peak_rss_delta_kb': 0}, {'peak_rss_delta_kb': 0}), [])
+
+    def test_new_metrics_are_skipped(self):
+        self.assertEqual(self.regressions({}, {'median_ms': 10}), [])
@@ -0,0 +1,56 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from common.constance_backend import CachedDatabaseBackend
+
+
+class CachedDatabaseBackendTests(TestCase):
+    def setUp(self):
+        # No subscriber thread, the tests deliver invalidations themselves.
+        patch = mock.patch.object(CachedDatabaseBackend, '_ensure_subscriber')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.backend = CachedDatabaseBackend()
+        self.backend._subscribed.set()
+        self.backend.set('METRICS_ENABLED', False)
+
+    def test_values_are_cached_for_the_ttl(self):
+        with mock.patch('time.monotonic', return_value=1000.0) as monotonic:
+            with self.assertNumQueries(1):
+                self.assertIs(self.backend.get('METRICS_ENABLED'), False)
+                self.assertIsNone(self.backend.get('EXAMPLE'))
+            monotonic.return_value += self.backend.ttl + 1
+            with self.assertNumQueries(1):
+                self.backend.get('METRICS_ENABLED')
+
+    def test_fallback_ttl_while_unsubscribed(self):
+        self.backend._subscribed.clear()
+        with mock.patch('time.monotonic', return_value=1000.0) as monotonic:
+            self.backend.get('METRICS_ENABLED')
+            monotonic.return_value += self.backend.fallback_ttl + 1
+            with self.assertNumQueries(1):
+                self.backend.get('METRICS_ENABLED')
+
+    def test_saves_invalidate_the_local_copy(self):
+        self.backend.get('METRICS_ENABLED')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.backend.set('METRICS_ENABLED', True)
+        self.assertIs(self.backend.get('METRICS_ENABLED'), True)
+
+    def test_invalidation_is_published_once_the_save_commits(self):
+        pubsub = self.backend.redis.pubsub(ignore_subscribe_messages=True)
+        self.addCleanup(pubsub.close)
+        pubsub.subscribe(self.backend.channel)
+        pubsub.get_message(timeout=1)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.backend.set('METRICS_ENABLED', True)
+            self.assertIsNone(pubsub.get_message(timeout=0.1))
+
+        # Another thread reloads the old value before the commit.
+        self.backend._values = {'METRICS_ENABLED': False}
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(self.backend._values)
+        message = pubsub.get_message(timeout=1)
+        self.assertEqual(message['data'], self.backend.add_prefix('METRICS_ENABLED').encode())
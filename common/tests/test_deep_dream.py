@@ -0,0 +1,90 @@
+from importlib.util import find_spec
+from unittest import mock, skipUnless
+
+import numpy as np
+from django.test import TestCase
+
+
+@skipUnless(find_spec('tensorflow'), 'needs TensorFlow')
+class CompiledDeepDreamTests(TestCase):
+    def setUp(self):
+        import tensorflow as tf
+
+        from common.benchmarks import tiny_dream_model
+        from common.deep_dream import CompiledDeepDream
+
+        self.tf = tf
+        self.deep_dream = CompiledDeepDream(tiny_dream_model(), bucket_sizes=(64, 128), tile_size=64, jit_compile=False)
+
+    def test_sizes_of_one_bucket_share_a_trace(self):
+        for height, width in ((64, 64), (50, 60), (33, 17)):
+            self.assertEqual(self.deep_dream.bucket(height, width), (64, 64))
+            loss, result = self.deep_dream(self.tf.random.uniform((height, width, 3), -1, 1), 2, 0.01)
+            self.assertEqual(result.shape, (height, width, 3))
+        self.assertEqual(self.deep_dream.trace_count, 1)
+
+    def test_images_larger_than_the_largest_bucket_are_tiled(self):
+        img = self.tf.random.uniform((150, 300, 3), -1, 1)
+        with mock.patch.object(self.deep_dream, '_function') as function:
+            loss, result = self.deep_dream(img, 2, 0.01)
+        function.assert_not_called()
+        self.assertEqual(result.shape, img.shape)
+        self.assertGreater(float(self.tf.reduce_max(self.tf.abs(result - img))), 0)
+
+    def test_run_tiles_the_octaves_that_outgrow_the_buckets(self):
+        img = np.random.default_rng(0).integers(0, 256, (120, 120, 3), dtype=np.uint8)
+        result = self.deep_dream.run(img, steps_per_octave=2, octaves=range(0, 3))
+        self.assertEqual(tuple(result.shape), (120, 120, 3))
+
+    def test_batch_matches_single_calls(self):
+        imgs = [self.tf.random.uniform(shape, -1, 1, seed=i)
+                for i, shape in enumerate([(64, 64, 3), (50, 60, 3), (100, 120, 3)])]
+        losses, results = self.deep_dream.batch(imgs, 3, 0.01)
+        for img, loss, result in zip(imgs, losses, results):
+            single_loss, single_result = self.deep_dream(img, 3, 0.01)
+            self.assertAlmostEqual(loss, single_loss, places=4)
+            np.testing.assert_allclose(result.numpy(), single_result.numpy(), atol=1e-4)
+
+    def test_batch_tiles_large_images_alone(self):
+        imgs = [self.tf.random.uniform((100, 120, 3), -1, 1), self.tf.random.uniform((150, 300, 3), -1, 1)]
+        losses, results = self.deep_dream.batch(imgs, 2, 0.01)
+        self.assertEqual([tuple(result.shape) for result in results], [(100, 120, 3), (150, 300, 3)])
+        self.assertTrue(all(loss is not None for loss in losses))
+
+
+@skipUnless(find_spec('tensorflow'), 'needs TensorFlow')
+class DreamModelRegistryTests(TestCase):
+    def setUp(self):
+        from common.benchmarks import tiny_dream_model
+        from common.deep_dream import DreamModelRegistry
+
+        self.build = mock.Mock(side_effect=lambda: tiny_dream_model(layer_count=4))
+        self.registry = DreamModelRegistry({'tiny': self.build}, max_models=2, jit_compile=False)
+
+    def test_identical_layer_sets_share_one_model(self):
+        deep_dream = self.registry.get('tiny', ('conv2', 'conv3'))
+        self.assertIs(self.registry.get('tiny', ['conv2', 'conv3']), deep_dream)
+        self.assertIsNot(self.registry.get('tiny', ('conv3',)), deep_dream)
+
+    def test_layer_sets_share_the_base_network_weights(self):
+        first = self.registry.model('tiny', ('conv2',))
+        second = self.registry.model('tiny', ('conv1', 'conv3'))
+        self.build.assert_called_once()
+        base_weights = {id(weight) for weight in self.registry.base('tiny').weights}
+        self.assertLessEqual({id(weight) for weight in first.weights + second.weights}, base_weights)
+
+    def test_least_recently_used_models_are_dropped(self):
+        first = self.registry.get('tiny', ('conv1',))
+        self.registry.get('tiny', ('conv2',))
+        self.registry.get('tiny', ('conv1',))
+        self.registry.get('tiny', ('conv3',))
+        self.assertIs(self.registry.get('tiny', ('conv1',)), first)
+        self.assertEqual(list(self.registry._models), [('tiny', ('conv3',)), ('tiny', ('conv1',))])
+
+    def test_release(self):
+        deep_dream = self.registry.get('tiny', ('conv1',))
+        self.registry.release('tiny')
+        self.assertIsNot(self.registry.get('tiny', ('conv1',)), deep_dream)
+        self.assertEqual(self.build.call_count, 2)
+        with self.assertRaises(KeyError):
+            self.registry.get('missing', ('conv1',))
@@ -0,0 +1,32 @@
+from importlib.util import find_spec
+from unittest import skipUnless
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from common.encoding import deprocess_into, to_array
+
+
+@skipUnless(find_spec('tensorflow'), 'needs TensorFlow')
+class EncodingTests(SimpleTestCase):
+    def setUp(self):
+        import tensorflow as tf
+
+        self.tf = tf
+
+    def test_deprocess_into_matches_deprocess(self):
+        from common.deep_dream import deprocess
+
+        # Evenly spread values, and the values that map exactly onto each level.
+        spread = np.linspace(-1, 1, 64 * 64 * 3, dtype=np.float32).reshape(64, 64, 3)
+        levels = np.repeat(np.arange(256, dtype=np.float32) / 127.5 - 1, 3).reshape(16, 16, 3)
+        for img in (spread, levels, np.random.default_rng(0).uniform(-1, 1, (48, 80, 3)).astype(np.float32)):
+            out = np.empty(img.shape, dtype=np.uint8)
+            deprocess_into(img, out, np.empty(img.shape, dtype=np.float32))
+            self.assertEqual(out.tobytes(), deprocess(self.tf.constant(img)).numpy().tobytes())
+
+    def test_tensors_are_read_in_place(self):
+        img = self.tf.random.uniform((32, 32, 3), -1, 1)
+        # Two copies would not share memory.
+        self.assertTrue(np.shares_memory(to_array(img), to_array(img)))
+        np.testing.assert_array_equal(to_array(img), img.numpy())
@@ -0,0 +1,57 @@
+import asyncio
+import subprocess
+import sys
+from concurrent.futures import Future
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+
+from common.generation_service import GenerationService
+
+
+def _no_setup():
+    pass
+
+
+def _report(progress, cancelled):
+    progress.put('started')
+    return cancelled.is_set()
+
+
+class GenerationServiceTests(TestCase):
+    async def check_channel(self, service):
+        self.addCleanup(service.shutdown)
+        progress, cancelled = service.channel()
+        cancelled.set()
+        self.assertTrue(await service.submit(_report, progress, cancelled, timeout=30))
+        self.assertEqual(progress.get(timeout=5), 'started')
+
+    async def test_channel(self):
+        await self.check_channel(GenerationService())
+
+    async def test_channel_across_processes(self):
+        with mock.patch('common.generation_service._init_process', _no_setup):
+            await self.check_channel(GenerationService(executor='process'))
+
+    async def test_slot_is_free_before_a_handed_off_future_resolves(self):
+        service = GenerationService(max_pending=1)
+        self.addCleanup(service.shutdown)
+        stored = Future()
+        call = asyncio.ensure_future(service.submit(lambda: stored, timeout=5))
+        while service.pending:
+            await asyncio.sleep(0.01)
+        self.assertFalse(call.done())
+        stored.set_result(['generated/image.jpg'])
+        self.assertEqual(await call, ['generated/image.jpg'])
+
+
+class ImportTests(SimpleTestCase):
+    def test_web_process_does_not_load_tensorflow(self):
+        # The generation service's children load the model, the ASGI application must not.
+        script = ('import sys, django.urls, image_weaver.asgi; django.urls.get_resolver().url_patterns; '
+                  'print("tensorflow" in sys.modules)')
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=120,
+                                cwd=settings.BASE_DIR)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], 'False')
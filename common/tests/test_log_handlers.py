@@ -0,0 +1,65 @@
+import logging
+import random
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from common.log_handlers import QueuedFileHandler, SqlSampleFilter
+
+
+class QueuedFileHandlerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'logs' / 'info.log'
+        self.handler = QueuedFileHandler(self.path)
+        self.addCleanup(self.handler.close)
+
+    def log(self, message):
+        self.handler.handle(logging.makeLogRecord({'msg': message}))
+        self.handler.listener.stop()
+        self.handler._start()
+
+    def test_creates_the_log_directory(self):
+        self.log('first')
+        self.assertEqual(self.path.read_text(), 'first\n')
+
+    def test_reopens_a_rotated_file(self):
+        self.log('first')
+        self.path.rename(self.path.with_name('info.log.1'))
+        self.log('second')
+        self.assertEqual(self.path.with_name('info.log.1').read_text(), 'first\n')
+        self.assertEqual(self.path.read_text(), 'second\n')
+
+
+class SqlSampleFilterTests(SimpleTestCase):
+    def query(self, duration=0.001):
+        return logging.makeLogRecord({'msg': 'SELECT 1', 'duration': duration})
+
+    def kept(self, sql_filter, count=10000):
+        with mock.patch('random.random', random.Random(0).random):
+            return sum(sql_filter.filter(self.query()) for _ in range(count))
+
+    def test_sample_rate(self):
+        kept = self.kept(SqlSampleFilter(sample_rate=0.1, max_per_second=10 ** 6))
+        self.assertAlmostEqual(kept / 10000, 0.1, delta=0.01)
+
+    def test_samples_are_rate_limited(self):
+        with mock.patch('time.monotonic', return_value=1000.0) as monotonic:
+            sql_filter = SqlSampleFilter(sample_rate=1, max_per_second=50)
+            self.assertEqual(self.kept(sql_filter), 50)
+            # A tenth of a second later, the bucket holds five more.
+            monotonic.return_value += 0.1
+            self.assertEqual(self.kept(sql_filter), 5)
+
+    def test_slow_queries_are_always_kept(self):
+        for mode in ('sampled', 'slow'):
+            sql_filter = SqlSampleFilter(mode=mode, sample_rate=0, slow_ms=200)
+            self.assertTrue(sql_filter.filter(self.query(duration=0.2)))
+            self.assertFalse(sql_filter.filter(self.query(duration=0.1)))
+
+    def test_all_and_off(self):
+        self.assertTrue(SqlSampleFilter(mode='all', sample_rate=0).filter(self.query()))
+        self.assertFalse(SqlSampleFilter(mode='off').filter(self.query(duration=10)))
@@ -0,0 +1,89 @@
+import io
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from log_viewer import settings as log_viewer_settings
+
+from common.log_tail import entries_reversed, lines_reversed
+
+LOG = '''[2026-10-01 10:00:00] INFO started
+[2026-10-01 10:00:01] ERROR request failed
+Traceback (most recent call last):
+  File "views.py", line 1, in generate
+ValueError: café
+[2026-10-01 10:00:02] INFO stopped
+'''
+
+
+class LinesReversedTests(SimpleTestCase):
+    def test_lines_across_block_boundaries(self):
+        content = LOG.encode()
+        expected = list(reversed(LOG.split('\n')))
+        for block_size in (1, 2, 7, 64, len(content), len(content) + 1):
+            self.assertEqual(list(lines_reversed(io.BytesIO(content), block_size=block_size)), expected)
+
+    def test_partial_last_line(self):
+        lines = lines_reversed(io.BytesIO(b'first\nsecond\npartial'), block_size=4)
+        self.assertEqual(list(lines), ['partial', 'second', 'first'])
+
+    def test_empty_file(self):
+        self.assertEqual(list(lines_reversed(io.BytesIO(b''))), [''])
+
+
+class EntriesReversedTests(SimpleTestCase):
+    def entries(self, **kwargs):
+        return list(entries_reversed(io.BytesIO(LOG.encode()), patterns=['[20'], **kwargs))
+
+    def test_tracebacks_stay_with_their_record(self):
+        self.assertEqual(self.entries(), [
+            '[2026-10-01 10:00:02] INFO stopped',
+            '[2026-10-01 10:00:01] ERROR request failed\nTraceback (most recent call last):\n'
+            '  File "views.py", line 1, in generate\nValueError: café',
+            '[2026-10-01 10:00:00] INFO started',
+        ])
+
+    def test_excluded_entries(self):
+        self.assertEqual(self.entries(exclude='ValueError'),
+                         ['[2026-10-01 10:00:02] INFO stopped', '[2026-10-01 10:00:00] INFO started'])
+
+    def test_lines_before_the_first_record(self):
+        entries = entries_reversed(io.BytesIO(b'orphan\n[2026-10-01] INFO first\n'), patterns=['[20'])
+        self.assertEqual(list(entries), ['[2026-10-01] INFO first', 'orphan'])
+
+
+class LogTailJsonViewTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        Path(directory.name, 'info.log').write_text(LOG)
+        for name, value in (('LOG_VIEWER_FILES_DIR', directory.name), ('LOG_VIEWER_MAX_READ_LINES', 2),
+                            ('LOG_VIEWER_PATTERNS', ['[20'])):
+            patch = mock.patch.object(log_viewer_settings, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client.force_login(get_user_model().objects.create_superuser('admin'))
+
+    def get(self, *args):
+        return self.client.get(reverse('log_viewer:log_json_view', args=args))
+
+    def test_pages_from_the_end(self):
+        first = self.get('info.log', 1).json()
+        self.assertEqual([log.splitlines()[0] for log in first['logs']],
+                         ['[2026-10-01 10:00:02] INFO stopped', '[2026-10-01 10:00:01] ERROR request failed'])
+        self.assertFalse(first['last'])
+        second = self.get('info.log', 2).json()
+        self.assertEqual(second['logs'], ['[2026-10-01 10:00:00] INFO started'])
+        self.assertTrue(second['last'])
+
+    def test_missing_file(self):
+        response = self.get('missing.log')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('logs', response.json())
+
+    def test_superusers_only(self):
+        self.client.force_login(get_user_model().objects.create_user('maker'))
+        self.assertEqual(self.get('info.log').status_code, 302)
@@ -0,0 +1,67 @@
+import threading
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import SimpleTestCase, override_settings
+
+from common import metrics
+
+# `MetricsTests` replaces it for the other tests.
+enabled = metrics.enabled
+
+
+class BrokenConfig:
+    @property
+    def METRICS_ENABLED(self):
+        raise DatabaseError('connection already closed')
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        for patch in (mock.patch.object(metrics, 'registry', metrics.Registry()),
+                      mock.patch('common.metrics.enabled', return_value=True)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(cache.delete, metrics.SNAPSHOTS_KEY)
+
+    def test_label_values_are_escaped(self):
+        metrics.registry.counter('requests_total', 'Requests.').inc(path='a"b\\c\nd')
+        self.assertIn('requests_total{path="a\\"b\\\\c\\nd"} 1', metrics.render())
+
+    def test_snapshots_of_other_processes_are_merged(self):
+        counter = metrics.registry.counter('requests_total', 'Requests.')
+        counter.inc(view='index')
+        with mock.patch('os.getpid', return_value=-1):
+            metrics.flush(force=True)
+        counter.inc(view='index')
+        self.assertEqual(metrics.collect()['requests_total'], {(('view', 'index'),): 3})
+
+    @override_settings(METRICS_FLUSH_INTERVAL=0.01)
+    def test_flusher_starts_once_per_process(self):
+        flushed = threading.Event()
+        with mock.patch.object(metrics, '_flusher_pid', [None]), \
+                mock.patch('common.metrics.flush', side_effect=lambda force: flushed.set()), \
+                mock.patch('threading.Thread.start', autospec=True, side_effect=threading.Thread.start) as start:
+            metrics.start_flusher()
+            metrics.start_flusher()
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(start.call_count, 1)
+
+    def test_failed_flag_reads_keep_the_last_value(self):
+        with mock.patch.object(metrics, '_flag', [False, float('-inf')]), \
+                mock.patch('constance.config', BrokenConfig()), self.assertLogs('error'):
+            self.assertFalse(enabled())
+        with mock.patch.object(metrics, '_flag', [True, float('-inf')]), \
+                mock.patch('constance.config', BrokenConfig()), self.assertLogs('error'):
+            self.assertTrue(enabled())
+
+    def test_metrics_do_not_raise_into_the_measured_code(self):
+        counter = metrics.registry.counter('requests_total', 'Requests.')
+        histogram = metrics.registry.histogram('request_seconds', 'Request time.')
+        with mock.patch('common.metrics.enabled', side_effect=RuntimeError), self.assertLogs('error') as logs:
+            with histogram.time():
+                measured = True
+            counter.inc()
+        self.assertTrue(measured)
+        self.assertEqual(len(logs.records), 2)
@@ -0,0 +1,23 @@
+import io
+
+import PIL.Image
+import numpy as np
+from django.test import SimpleTestCase
+
+from common.perceptual_hash import hamming_distance, perceptual_hash
+
+
+class PerceptualHashTests(SimpleTestCase):
+    def test_survives_resizing_and_reencoding(self):
+        rng = np.random.default_rng(0)
+        image = PIL.Image.fromarray(
+            np.kron(rng.integers(0, 256, (8, 8, 3)), np.ones((32, 32, 1))).astype(np.uint8))
+        buffer = io.BytesIO()
+        image.resize((200, 200)).save(buffer, format='JPEG', quality=70)
+        other = PIL.Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8))
+        self.assertLessEqual(hamming_distance(perceptual_hash(image), perceptual_hash(PIL.Image.open(buffer))), 4)
+        self.assertGreater(hamming_distance(perceptual_hash(image), perceptual_hash(other)), 16)
+
+    def test_hamming_distance_of_signed_hashes(self):
+        self.assertEqual(hamming_distance(-1, 0), 64)
+        self.assertEqual(hamming_distance(-1, -2), 1)
@@ -0,0 +1,64 @@
+from unittest import mock
+
+import numpy as np
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+from common.result_cache import ResultCache
+from common.storage import S3Storage, UploadQueue
+from common.tests.cases import BlockingObjectClient, FailingObjectClient, MediaTestCase
+
+
+class ResultCacheTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.result_cache = ResultCache(ttl=100, max_entries=2, max_bytes=10 ** 9, prefix='test')
+        self.images = np.random.default_rng(0).integers(0, 256, (2, 16, 16, 3), dtype=np.uint8)
+
+    def test_round_trip(self):
+        names = self.result_cache.put('first', self.images).result(5)
+        self.assertEqual(len(names), 2)
+        self.assertEqual(self.result_cache.get('first'), names)
+        for name in names:
+            self.assertTrue(default_storage.exists(name))
+
+    def test_miss(self):
+        self.assertIsNone(self.result_cache.get('missing'))
+
+    def test_hit_refreshes_the_ttl(self):
+        self.result_cache.put('first', self.images).result(5)
+        meta_key = self.result_cache._meta_key('first')
+        cache.touch(meta_key, 5)
+        self.result_cache.get('first')
+        self.assertGreater(cache.ttl(meta_key), 5)
+
+    def test_evicts_the_least_recently_used_entry(self):
+        first = self.result_cache.put('first', self.images).result(5)
+        second = self.result_cache.put('second', self.images[:1]).result(5)
+        self.result_cache.get('first')
+        self.result_cache.put('third', self.images[1:]).result(5)
+        self.assertIsNone(self.result_cache.get('second'))
+        self.assertEqual(self.result_cache.get('first'), first)
+        self.assertFalse(default_storage.exists(second[0]))
+
+    def test_put_does_not_wait_for_the_uploads(self):
+        client = BlockingObjectClient(self.media_root)
+        uploads = UploadQueue(storage=S3Storage(bucket='media', client=client), max_retries=0)
+        self.addCleanup(uploads.close)
+        with mock.patch('common.result_cache.get_upload_queue', return_value=uploads):
+            stored = self.result_cache.put('first', self.images)
+        self.assertFalse(stored.done())
+        self.assertIsNone(self.result_cache.get('first'))
+        client.unblocked.set()
+        names = stored.result(5)
+        self.assertEqual(self.result_cache.get('first'), names)
+
+    def test_failed_uploads_are_not_recorded(self):
+        uploads = UploadQueue(storage=S3Storage(bucket='media', client=FailingObjectClient(self.media_root)),
+                              max_retries=0)
+        self.addCleanup(uploads.close)
+        with mock.patch('common.result_cache.get_upload_queue', return_value=uploads):
+            stored = self.result_cache.put('first', self.images)
+        with self.assertRaises(OSError):
+            stored.result(5)
+        self.assertIsNone(self.result_cache.get('first'))
@@ -0,0 +1,33 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from common.scheduler import AdaptiveScheduler, GenerationPlan
+
+
+class AdaptiveSchedulerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.scheduler = AdaptiveScheduler(window=3, refresh_interval=0)
+
+    def test_unit_time_is_the_median_of_the_window(self):
+        self.assertIsNone(self.scheduler.unit_time('stable_diffusion'))
+        for seconds in (100, 1, 2, 6):
+            self.scheduler.record('stable_diffusion', seconds, 2)
+        self.assertEqual(self.scheduler.unit_time('stable_diffusion'), 1)
+
+    def test_generation_is_not_planned_without_timings(self):
+        self.assertEqual(self.scheduler.plan_generation(50, depth=10), GenerationPlan(50, None, False))
+
+    def test_generation_steps_shrink_with_the_queue(self):
+        # One second per step against the default 60 second target.
+        self.scheduler.record('stable_diffusion', 50, 50)
+        self.assertEqual(self.scheduler.plan_generation(50, depth=0), GenerationPlan(50, 50, False))
+        self.assertEqual(self.scheduler.plan_generation(50, depth=2), GenerationPlan(20, 20, True))
+        self.assertEqual(self.scheduler.plan_generation(50, depth=100).num_steps, 20)
+
+    def test_dream_is_degraded_down_to_the_minimums(self):
+        self.scheduler.record('deep_dream', 1, 10 ** 12)
+        self.assertFalse(self.scheduler.plan_dream(100, range(-2, 3), 1024, depth=0).degraded)
+        self.scheduler.record('deep_dream', 10 ** 12, 1)
+        plan = self.scheduler.plan_dream(100, range(-2, 3), 1024, depth=0)
+        self.assertEqual((plan.steps_per_octave, plan.octaves, plan.max_dim, plan.degraded), (10, [-2, -1], 256, True))
@@ -0,0 +1,37 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from common.single_flight import SingleFlight
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.single_flight = SingleFlight(ttl=100)
+
+    def test_followers_join_the_leader(self):
+        self.assertIsNone(self.single_flight.acquire('key', 'leader', 1))
+        self.assertEqual(self.single_flight.acquire('key', 'second', 2), 'leader')
+        self.assertEqual(self.single_flight.acquire('key', 'third', 3), 'leader')
+        self.assertEqual(self.single_flight.release('key', 'leader'), ['2', '3'])
+        self.assertIsNone(self.single_flight.acquire('key', 'next', 4))
+
+    def test_only_the_leader_releases(self):
+        self.single_flight.acquire('key', 'leader', 1)
+        self.single_flight.acquire('key', 'second', 2)
+        self.assertEqual(self.single_flight.release('key', 'second'), [])
+        self.assertEqual(self.single_flight.acquire('key', 'third', 3), 'leader')
+
+    def test_expired_leader_does_not_release_its_successor(self):
+        self.single_flight.acquire('key', 'leader', 1)
+        self.single_flight.redis.delete(self.single_flight._lock_key('key'))
+        self.assertIsNone(self.single_flight.acquire('key', 'successor', 2))
+        self.assertEqual(self.single_flight.release('key', 'leader'), [])
+        self.assertEqual(self.single_flight.acquire('key', 'third', 3), 'successor')
+
+    def test_leader(self):
+        self.assertIsNone(self.single_flight.leader('key'))
+        self.single_flight.acquire('key', 'leader', 1)
+        self.assertEqual(self.single_flight.leader('key'), 'leader')
+        self.single_flight.release('key', 'leader')
+        self.assertIsNone(self.single_flight.leader('key'))
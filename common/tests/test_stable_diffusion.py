@@ -0,0 +1,97 @@
+from unittest import mock
+
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+
+from common import stable_diffusion
+from common.tests.cases import MediaTestCase
+from image_weaver import celery
+
+
+@override_settings(STABLE_DIFFUSION_BACKEND='dummy', STABLE_DIFFUSION_MAX_BATCH_SIZE=1)
+class ModelPoolTests(TestCase):
+    def setUp(self):
+        stable_diffusion.release_model()
+        self.addCleanup(stable_diffusion.release_model)
+
+    def test_model_is_built_once(self):
+        with mock.patch.object(stable_diffusion, 'build_model', wraps=stable_diffusion.build_model) as build:
+            model = stable_diffusion.get_model()
+            self.assertIs(stable_diffusion.get_model(), model)
+        build.assert_called_once()
+
+    def test_generation_reuses_the_loaded_model(self):
+        stable_diffusion.get_model()
+        with mock.patch.object(stable_diffusion, 'build_model') as build:
+            first = stable_diffusion.generate_photo('a red fox', num_steps=2, seed=1)
+            second = stable_diffusion.generate_photo('a red fox', num_steps=2, seed=1)
+        build.assert_not_called()
+        self.assertEqual(first.shape, (1, 64, 64, 3))
+        self.assertTrue((first == second).all())
+
+    def test_release_model(self):
+        model = stable_diffusion.get_model()
+        stable_diffusion.release_model()
+        self.assertIsNone(stable_diffusion._model)
+        self.assertIsNot(stable_diffusion.get_model(), model)
+
+    @override_settings(STABLE_DIFFUSION_MAX_BATCH_SIZE=4)
+    def test_release_model_closes_the_batcher(self):
+        batcher = stable_diffusion.get_batcher()
+        stable_diffusion.release_model()
+        self.assertIsNone(stable_diffusion._batcher)
+        self.assertIsNot(stable_diffusion.get_batcher(), batcher)
+
+    def test_seeded_images_do_not_depend_on_their_batch(self):
+        alone = stable_diffusion.generate_photo('a red fox', num_steps=2, seed=3)[0]
+        batched = stable_diffusion.generate_photos(['a grey wolf', 'a red fox'], num_steps=2, seeds=[7, 3])
+        self.assertTrue((batched[1] == alone).all())
+        self.assertFalse((batched[0] == alone).all())
+
+    @override_settings(STABLE_DIFFUSION_MAX_BATCH_SIZE=2, STABLE_DIFFUSION_MAX_BATCH_WAIT=30)
+    def test_batched_requests_keep_their_seeds(self):
+        alone = stable_diffusion.generate_photos(['a red fox'], num_steps=2, seeds=[3])[0]
+        batcher = stable_diffusion.get_batcher()
+        futures = [batcher.submit(('a red fox', seed), num_steps=2) for seed in (5, 3)]
+        self.assertTrue((futures[1].result(5) == alone).all())
+        self.assertEqual(batcher.summary()['mean_batch_size'], 2)
+
+    @override_settings(WORKER_PROFILE='', STABLE_DIFFUSION_WARM_POOL=True)
+    def test_worker_process_signals(self):
+        celery.load_generation_model()
+        self.assertIsNotNone(stable_diffusion._model)
+        celery.release_generation_model()
+        self.assertIsNone(stable_diffusion._model)
+
+    @override_settings(WORKER_PROFILE='', STABLE_DIFFUSION_WARM_POOL=False)
+    def test_worker_process_signals_without_warm_pool(self):
+        celery.load_generation_model()
+        self.assertIsNone(stable_diffusion._model)
+
+    @override_settings(WORKER_PROFILE='')
+    def test_uploads_finish_before_the_worker_process_exits(self):
+        for warm_pool in (True, False):
+            calls = mock.Mock()
+            with override_settings(STABLE_DIFFUSION_WARM_POOL=warm_pool), \
+                    mock.patch('common.encoding.shutdown_encoder', calls.shutdown_encoder), \
+                    mock.patch('common.storage.close_upload_queue', calls.close_upload_queue), \
+                    mock.patch('common.stable_diffusion.release_model', calls.release_model):
+                celery.release_generation_model()
+            expected = [mock.call.shutdown_encoder(), mock.call.close_upload_queue()]
+            self.assertEqual(calls.mock_calls, expected + [mock.call.release_model()] * warm_pool)
+
+
+@override_settings(STABLE_DIFFUSION_BACKEND='dummy', STABLE_DIFFUSION_MAX_BATCH_SIZE=1)
+class GenerateAndSaveTests(MediaTestCase):
+    def test_seeded_generations_are_cached(self):
+        names = stable_diffusion.generate_and_save('a red fox', num_steps=2, seed=3).result(5)
+        with mock.patch.object(stable_diffusion, 'generate_photo') as generate_photo:
+            self.assertEqual(stable_diffusion.generate_and_save('a red fox', num_steps=2, seed=3).result(5), names)
+        generate_photo.assert_not_called()
+
+    def test_unseeded_generations_skip_the_cache(self):
+        with mock.patch.object(stable_diffusion, 'get_result_cache') as get_result_cache:
+            names = stable_diffusion.generate_and_save('a red fox', num_steps=2).result(5)
+        get_result_cache.assert_not_called()
+        self.assertEqual(len(names), 1)
+        self.assertTrue(default_storage.exists(names[0]))
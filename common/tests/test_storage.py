@@ -0,0 +1,39 @@
+import threading
+from unittest import mock
+
+from common import storage
+from common.storage import S3Storage, UploadQueue, close_upload_queue
+from common.tests.cases import BlockingObjectClient, FailingObjectClient, MediaTestCase
+
+
+class S3StorageTests(MediaTestCase):
+    def test_round_trip(self):
+        storage = S3Storage(bucket='media', location='site', local_root=self.media_root)
+        uploads = UploadQueue(storage=storage, max_retries=0)
+        self.addCleanup(uploads.close)
+        name = uploads.submit('test/image.jpg', b'jpeg bytes').result(5)
+        self.assertEqual(name, 'test/image.jpg')
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(storage.size(name), 10)
+        with storage.open(name) as file:
+            self.assertEqual(file.read(), b'jpeg bytes')
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_failed_upload(self):
+        storage = S3Storage(bucket='media', client=FailingObjectClient(self.media_root))
+        uploads = UploadQueue(storage=storage, max_retries=1, retry_delay=0)
+        self.addCleanup(uploads.close)
+        with self.assertRaises(OSError):
+            uploads.submit('test/image.jpg', b'jpeg bytes').result(5)
+        self.assertFalse(storage.exists('test/image.jpg'))
+
+    def test_close_waits_for_the_queued_uploads(self):
+        client = BlockingObjectClient(self.media_root)
+        uploads = UploadQueue(storage=S3Storage(bucket='media', client=client), max_retries=0)
+        with mock.patch.object(storage, '_upload_queue', uploads):
+            stored = storage.get_upload_queue().submit('test/image.jpg', b'jpeg bytes')
+            threading.Timer(0.1, client.unblocked.set).start()
+            close_upload_queue()
+            self.assertIsNone(storage._upload_queue)
+        self.assertEqual(stored.result(0), 'test/image.jpg')
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-18 09:18
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('descriptions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='description',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['-created_time', '-id'], name='description_active_idx'),
+        ),
+    ]
@@ -1,8 +1,73 @@
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField
 from django.db import models
+from django.db.models import F, FloatField, Func, Q, Value
 from django.utils.translation import gettext_lazy as _
 
-from common.base_models import BaseModel
+from common.base_models import ActiveManager, ActiveQuerySet, BaseModel
+
+# Text search configuration of the stored vector; queries must use the same one to match it.
+SEARCH_CONFIG = 'english'
+
+
+class WordDistance(Func):
+    # pg_trgm's `<->>`: one minus the word similarity of `string` to the closest part of
+    # `expression`. The column is the left operand, so a GiST trigram index can return rows in
+    # distance order.
+    template = '%(expressions)s'
+    arg_joiner = ' <->> '
+    output_field = FloatField()
+
+    def __init__(self, expression, string, **extra):
+        super().__init__(expression, Value(string), **extra)
+
+
+class DescriptionQuerySet(ActiveQuerySet):
+    def search(self, text, limit=20):
+        # Full text search, best ranked first. Only the newest DESCRIPTION_SEARCH_MAX_CANDIDATES
+        # matches are ranked, so very common terms cost no more than rare ones: through
+        # `actives` the planner either reads rare terms' matches from the GIN index and sorts
+        # them, or walks the active index newest first and stops after enough matches. A better
+        # ranked but older match beyond the cap is not returned.
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+        candidates = (
+            self.filter(search_vector=query)
+            .order_by('-created_time', '-id')
+            .values('pk')[:settings.DESCRIPTION_SEARCH_MAX_CANDIDATES]
+        )
+        return (
+            self.filter(pk__in=candidates)
+            .annotate(rank=SearchRank(F('search_vector'), query))
+            .order_by('-rank', '-id')[:limit]
+        )
+
+    def autocomplete(self, text, limit=10):
+        # Descriptions containing words similar to `text`, closest first, read in order from the
+        # GiST trigram index.
+        return (
+            self.filter(description__trigram_word_similar=text)
+            .annotate(distance=WordDistance('description', text))
+            .order_by('distance')[:limit]
+        )
 
 
 class Description(BaseModel):
     description = models.TextField(verbose_name=_('description'))
+    search_vector = models.GeneratedField(
+        verbose_name=_('search vector'),
+        expression=SearchVector('description', config=SEARCH_CONFIG),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    objects = DescriptionQuerySet.as_manager()
+    actives = ActiveManager.from_queryset(DescriptionQuerySet)()
+
+    class Meta(BaseModel.Meta):
+        indexes = [
+            *BaseModel.Meta.indexes,
+            GinIndex(fields=['search_vector'], condition=Q(is_active=True), name='description_search_idx'),
+            GistIndex(fields=['description'], opclasses=['gist_trgm_ops'], condition=Q(is_active=True),
+                      name='description_trgm_idx'),
+        ]
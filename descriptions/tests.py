@@ -1,3 +1,67 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
-# Create your tests here.
+from descriptions.models import Description
+
+
+class KeysetPageTests(TestCase):
+    def setUp(self):
+        Description.objects.bulk_create([Description(description=f'description {i}') for i in range(7)])
+        Description.objects.filter(description='description 3').update(is_active=False)
+
+    def pages(self, size):
+        cursor, pages = None, []
+        while True:
+            page, cursor = Description.actives.keyset_page(cursor, size=size)
+            pages.append([description.description for description in page])
+            if cursor is None:
+                return pages
+
+    def test_pages_newest_first(self):
+        expected = list(Description.actives.order_by('-created_time', '-id').values_list('description', flat=True))
+        pages = self.pages(size=4)
+        self.assertEqual([len(page) for page in pages], [4, 2])
+        self.assertEqual(sum(pages, []), expected)
+        self.assertNotIn('description 3', expected)
+
+    def test_rows_with_the_same_created_time(self):
+        Description.objects.update(created_time=timezone.now())
+        pages = self.pages(size=2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        self.assertEqual(sum(pages, []), [f'description {i}' for i in (6, 5, 4, 2, 1, 0)])
+
+    def test_exact_multiple_of_the_page_size(self):
+        Description.objects.filter(description='description 6').update(is_active=False)
+        self.assertEqual([len(page) for page in self.pages(size=5)], [5])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        Description.objects.bulk_create([
+            Description(description='a fox, a fox and another fox'),
+            Description(description='a red fox'),
+            Description(description='a fox in the snow'),
+            Description(description='a grey wolf'),
+        ])
+        Description.objects.filter(description='a fox in the snow').update(is_active=False)
+
+    def search(self, text):
+        return [description.description for description in Description.actives.search(text)]
+
+    def test_best_ranked_first(self):
+        self.assertEqual(self.search('fox'), ['a fox, a fox and another fox', 'a red fox'])
+        self.assertEqual(self.search('wolf'), ['a grey wolf'])
+        self.assertEqual(self.search('bear'), [])
+
+    def test_websearch_syntax(self):
+        self.assertEqual(self.search('fox -red'), ['a fox, a fox and another fox'])
+        self.assertCountEqual(self.search('"grey wolf" or "red fox"'), ['a red fox', 'a grey wolf'])
+
+    @override_settings(DESCRIPTION_SEARCH_MAX_CANDIDATES=1)
+    def test_only_the_newest_matches_are_ranked(self):
+        self.assertEqual(self.search('fox'), ['a red fox'])
+
+    def test_autocomplete_closest_first(self):
+        results = [description.description for description in Description.actives.autocomplete('wol')]
+        self.assertEqual(results[0], 'a grey wolf')
+        self.assertNotIn('a fox in the snow', results)
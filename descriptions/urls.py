@@ -0,0 +1,10 @@
+from django.urls import path
+
+from descriptions import views
+
+app_name = 'descriptions'
+
+urlpatterns = [
+    path('search/', views.search, name='search'),
+    path('autocomplete/', views.autocomplete, name='autocomplete'),
+]
@@ -1,3 +1,43 @@
-from django.shortcuts import render
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from descriptions.models import Description
+
+MAX_LIMIT = 100
+# Shorter text has too few trigrams to tell descriptions apart.
+AUTOCOMPLETE_MIN_LENGTH = 3
+
+
+def _query(request, default_limit):
+    # Returns the search text and the number of results asked for, or raises ValueError.
+    text = request.GET.get('q', '').strip()
+    if not text:
+        raise ValueError('q')
+    return text, min(max(int(request.GET.get('limit', default_limit)), 1), MAX_LIMIT)
+
+
+@require_GET
+def search(request):
+    try:
+        text, limit = _query(request, 20)
+    except ValueError:
+        return JsonResponse({'error': 'a q parameter and a numeric limit are required'}, status=400)
+
+    results = Description.actives.search(text, limit).values('id', 'description', 'rank')
+    return JsonResponse({'results': list(results)})
+
+
+@require_GET
+def autocomplete(request):
+    try:
+        text, limit = _query(request, 10)
+    except ValueError:
+        return JsonResponse({'error': 'a q parameter and a numeric limit are required'}, status=400)
+    if len(text) < AUTOCOMPLETE_MIN_LENGTH:
+        return JsonResponse({'results': []})
+
+    results = Description.actives.autocomplete(text, limit).values('id', 'description', 'distance')
+    return JsonResponse({'results': [
+        {'id': result['id'], 'description': result['description'], 'similarity': 1 - result['distance']}
+        for result in results
+    ]})
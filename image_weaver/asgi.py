@@ -7,10 +7,34 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_weaver.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from common import metrics  # noqa: E402
+from common.generation_service import get_generation_service  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # Django does not implement the ASGI lifespan protocol, so start and stop the
+    # generation service's executor and the metrics flusher here and pass everything else to
+    # Django.
+    if scope['type'] != 'lifespan':
+        return await django_application(scope, receive, send)
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_generation_service().start()
+            metrics.start_flusher()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await asyncio.to_thread(get_generation_service().shutdown)
+            await asyncio.to_thread(metrics.flush, True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -26,3 +26,82 @@ def config_loggers(*args, **kwargs):
     from logging.config import dictConfig
     from django.conf import settings
     dictConfig(settings.LOGGING)
+
+
+def get_worker_profile():
+    from django.conf import settings
+    return settings.WORKER_PROFILES.get(settings.WORKER_PROFILE, {})
+
+
+def warm_pool_enabled():
+    from django.conf import settings
+    return get_worker_profile().get('warm_pool', settings.STABLE_DIFFUSION_WARM_POOL)
+
+
+@signals.celeryd_init.connect
+def apply_worker_profile(sender=None, conf=None, instance=None, **kwargs):
+    profile = get_worker_profile()
+    if not profile:
+        return
+
+    conf.worker_concurrency = profile['concurrency']
+    conf.worker_prefetch_multiplier = profile['prefetch_multiplier']
+    instance.app.amqp.queues.select(profile['queues'])
+
+
+@signals.worker_process_init.connect
+def load_generation_model(*args, **kwargs):
+    # Load and compile the Stable Diffusion model once per worker process so every
+    # task reuses it. Only enabled on workers consuming the inference queue.
+    if not warm_pool_enabled():
+        return
+
+    from common.stable_diffusion import get_model
+    get_model()
+
+
+@signals.worker_process_shutdown.connect
+def release_generation_model(*args, **kwargs):
+    # Tasks return before their encodes and uploads finish, so let those finish first on every
+    # worker. Encodes feed the upload queue, they go first.
+    from common.encoding import shutdown_encoder
+    from common.storage import close_upload_queue
+    shutdown_encoder()
+    close_upload_queue()
+
+    if not warm_pool_enabled():
+        return
+
+    from common.stable_diffusion import release_model
+    release_model()
+
+
+@signals.before_task_publish.connect
+def stamp_published_time(headers=None, **kwargs):
+    # Lets the worker measure how long the task waited in the queue.
+    import time
+    headers['published_at'] = time.time()
+
+
+@signals.task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    import time
+
+    from common import metrics
+
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is not None:
+        metrics.queue_wait.observe(time.time() - published_at, queue=task.request.delivery_info.get('routing_key'))
+    task.request.started_at = time.perf_counter()
+
+
+@signals.task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    import time
+
+    from common import metrics
+
+    started_at = getattr(task.request, 'started_at', None)
+    if started_at is not None:
+        metrics.task_duration.observe(time.perf_counter() - started_at, task=task.name, state=state)
+    metrics.flush()
@@ -30,9 +30,11 @@ INSTALLED_APPS = [
     # apps
     'descriptions',
     'images',
+    'orders',
     'users',
     # packages
     'django.contrib.postgres',
+    'constance',
     'log_viewer',
 ]
 
@@ -139,6 +141,39 @@ STATIC_URL = '%sstatic/' % config('BASE_URL')
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '%smedia/' % config('BASE_URL')
 
+# Media storage, 'local' keeps files under MEDIA_ROOT, 's3' uses any S3-compatible object store.
+# Setting S3_LOCAL_ROOT runs the S3 backend against a local directory instead of a bucket.
+STORAGE_BACKEND = config('STORAGE_BACKEND', default='local')
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+if STORAGE_BACKEND == 's3':
+    STORAGES['default'] = {
+        'BACKEND': 'common.storage.S3Storage',
+        'OPTIONS': {
+            'bucket': config('S3_BUCKET', default='image-weaver'),
+            'location': config('S3_LOCATION', default='media'),
+            'endpoint_url': config('S3_ENDPOINT_URL', default=''),
+            'region_name': config('S3_REGION_NAME', default=''),
+            'access_key': config('S3_ACCESS_KEY', default=''),
+            'secret_key': config('S3_SECRET_KEY', default=''),
+            'base_url': config('S3_BASE_URL', default=''),
+            'local_root': config('S3_LOCAL_ROOT', default=''),
+        },
+    }
+
+# Background writes of generated media
+UPLOAD_QUEUE_MAX_SIZE = config('UPLOAD_QUEUE_MAX_SIZE', default=256, cast=int)
+UPLOAD_QUEUE_BATCH_SIZE = config('UPLOAD_QUEUE_BATCH_SIZE', default=16, cast=int)
+UPLOAD_QUEUE_WORKERS = config('UPLOAD_QUEUE_WORKERS', default=4, cast=int)
+UPLOAD_QUEUE_MAX_RETRIES = config('UPLOAD_QUEUE_MAX_RETRIES', default=3, cast=int)
+UPLOAD_QUEUE_RETRY_DELAY = config('UPLOAD_QUEUE_RETRY_DELAY', default=0.5, cast=float)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -162,11 +197,76 @@ CELERY_BROKER_URL = '{protocol}://{username}:{password}@{host}:{port}/{vhost}'.f
     vhost=config('CELERY_BROKER_VHOST', default='image_weaver'),
 )
 CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+# Warm inference workers load the model in `worker_process_init`, which takes far longer
+# than celery's default 4 seconds.
+CELERY_WORKER_PROC_ALIVE_TIMEOUT = config('CELERY_WORKER_PROC_ALIVE_TIMEOUT', default=300, cast=float)
+
+# Stable Diffusion
+
+STABLE_DIFFUSION_BACKEND = config('STABLE_DIFFUSION_BACKEND', default='keras_cv')  # 'keras_cv' or 'dummy'
+STABLE_DIFFUSION_WEIGHTS_PATH = config('STABLE_DIFFUSION_WEIGHTS_PATH', default='')
+# Part of the result cache key, defaults to the backend and weights file name.
+STABLE_DIFFUSION_MODEL_VERSION = config('STABLE_DIFFUSION_MODEL_VERSION', default='')
+STABLE_DIFFUSION_IMAGE_WIDTH = config('STABLE_DIFFUSION_IMAGE_WIDTH', default=512, cast=int)
+STABLE_DIFFUSION_IMAGE_HEIGHT = config('STABLE_DIFFUSION_IMAGE_HEIGHT', default=512, cast=int)
+# Load the model once per worker process instead of on every task.
+STABLE_DIFFUSION_WARM_POOL = config('STABLE_DIFFUSION_WARM_POOL', default=False, cast=bool)
+# Prompts submitted concurrently are batched into one diffusion run of up to this many images,
+# waiting at most STABLE_DIFFUSION_MAX_BATCH_WAIT seconds. Only threads of one process share a
+# batch: the generation service's thread executor (not the default process executor), whose
+# default worker count follows this setting, or a Celery inference worker started with
+# `-P threads -c <batch size>`. The inference profile's default prefork pool runs one task per
+# process and never fills a batch, there batching only adds STABLE_DIFFUSION_MAX_BATCH_WAIT to
+# every generation.
+STABLE_DIFFUSION_MAX_BATCH_SIZE = config('STABLE_DIFFUSION_MAX_BATCH_SIZE', default=1, cast=int)
+STABLE_DIFFUSION_MAX_BATCH_WAIT = config('STABLE_DIFFUSION_MAX_BATCH_WAIT', default=0.05, cast=float)
+
+# Generation service used by async views. 'process' runs the model in spawned child processes,
+# which keeps TensorFlow out of the web process; 'thread' runs it in the web process itself.
+GENERATION_SERVICE_EXECUTOR = config('GENERATION_SERVICE_EXECUTOR', default='process')
+GENERATION_SERVICE_WORKERS = config(
+    'GENERATION_SERVICE_WORKERS',
+    default=STABLE_DIFFUSION_MAX_BATCH_SIZE if GENERATION_SERVICE_EXECUTOR == 'thread' else 1,
+    cast=int,
+)
+GENERATION_SERVICE_MAX_PENDING = config('GENERATION_SERVICE_MAX_PENDING', default=256, cast=int)
+GENERATION_SERVICE_TIMEOUT = config('GENERATION_SERVICE_TIMEOUT', default=300, cast=float)
+
+# DeepDream
+DEEP_DREAM_MAX_DIM = config('DEEP_DREAM_MAX_DIM', default=500, cast=int)
+DEEP_DREAM_STEPS_PER_OCTAVE = config('DEEP_DREAM_STEPS_PER_OCTAVE', default=50, cast=int)
+# Progress, with a preview of at most DEEP_DREAM_PREVIEW_SIZE pixels, is streamed every chunk.
+DEEP_DREAM_CHUNK_SIZE = config('DEEP_DREAM_CHUNK_SIZE', default=10, cast=int)
+DEEP_DREAM_PREVIEW_SIZE = config('DEEP_DREAM_PREVIEW_SIZE', default=128, cast=int)
+# Layers are maximized on this base network. Requests may pick any of DEEP_DREAM_ALLOWED_LAYERS;
+# every layer set shares the base network's weights.
+DEEP_DREAM_BASE_NETWORK = config('DEEP_DREAM_BASE_NETWORK', default='inception_v3')
+DEEP_DREAM_LAYERS = config('DEEP_DREAM_LAYERS', default='mixed3,mixed5', cast=Csv())
+DEEP_DREAM_ALLOWED_LAYERS = config(
+    'DEEP_DREAM_ALLOWED_LAYERS', default=','.join(f'mixed{i}' for i in range(11)), cast=Csv(),
+)
+
+# Prompt embeddings, in process and shared through the default cache
+EMBEDDING_CACHE_MAX_ENTRIES = config('EMBEDDING_CACHE_MAX_ENTRIES', default=1024, cast=int)
+EMBEDDING_CACHE_TTL = config('EMBEDDING_CACHE_TTL', default=24 * 60 * 60, cast=int)
+
+# Content-addressed cache of generated images
+RESULT_CACHE_TTL = config('RESULT_CACHE_TTL', default=7 * 24 * 60 * 60, cast=int)
+RESULT_CACHE_MAX_ENTRIES = config('RESULT_CACHE_MAX_ENTRIES', default=10000, cast=int)
+RESULT_CACHE_MAX_BYTES = config('RESULT_CACHE_MAX_BYTES', default=10 * 1024 ** 3, cast=int)
+
+# Identical generations in flight are coalesced; a crashed leader's lock expires after this many seconds.
+SINGLE_FLIGHT_TTL = config('SINGLE_FLIGHT_TTL', default=30 * 60, cast=int)
+# Seconds between checks whether a follower's leader still runs.
+SINGLE_FLIGHT_POLL_INTERVAL = config('SINGLE_FLIGHT_POLL_INTERVAL', default=60, cast=int)
 
 # Constance
 
 CONSTANCE_DATABASE_PREFIX = 'constance_image_weaver'
-CONSTANCE_BACKEND = 'constance.backends.database.DatabaseBackend'
+CONSTANCE_BACKEND = 'common.constance_backend.CachedDatabaseBackend'
+# Seconds config values are kept in process, and while invalidations cannot be received.
+CONSTANCE_CACHE_TTL = config('CONSTANCE_CACHE_TTL', default=60, cast=float)
+CONSTANCE_CACHE_FALLBACK_TTL = config('CONSTANCE_CACHE_FALLBACK_TTL', default=1, cast=float)
 CONSTANCE_ADDITIONAL_FIELDS = {
     'decimal_field': ['django.forms.DecimalField', {}],
     'integer_field': ['django.forms.IntegerField', {}],
@@ -181,8 +281,44 @@ CONSTANCE_ADDITIONAL_FIELDS = {
 
 CONSTANCE_CONFIG = {
     'EXAMPLE': (30, _('example'), 'int_field'),
+    'METRICS_ENABLED': (True, _('record inference and task metrics')),
+    # Adaptive scheduling, see `common.scheduler`.
+    'SCHEDULER_ENABLED': (True, _('degrade generation parameters to meet the latency targets')),
+    'SCHEDULER_CAPACITY': (1, _('generation jobs run in parallel across the cluster'), 'int_field'),
+    'GENERATION_LATENCY_TARGET': (60, _('seconds a text to image job may take, queueing included'), 'int_field'),
+    'GENERATION_MIN_STEPS': (20, _('fewest diffusion steps a degraded job may run'), 'int_field'),
+    'DEEP_DREAM_LATENCY_TARGET': (30, _('seconds a DeepDream job may take, queueing included'), 'int_field'),
+    'DEEP_DREAM_MIN_STEPS': (10, _('fewest steps per octave a degraded DeepDream job may run'), 'int_field'),
+    'DEEP_DREAM_MIN_OCTAVES': (2, _('fewest octaves a degraded DeepDream job may run'), 'int_field'),
+    'DEEP_DREAM_MIN_DIM': (256, _('smallest image size a degraded DeepDream job may run at'), 'int_field'),
 }
 
+# Metrics
+
+# Seconds between reads of the METRICS_ENABLED flag, and between worker snapshot flushes.
+METRICS_FLAG_TTL = config('METRICS_FLAG_TTL', default=5, cast=float)
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=10, cast=float)
+
+# Scheduler
+
+# Per step timings kept for the latency estimates, and seconds between reads of them.
+SCHEDULER_TIMING_WINDOW = config('SCHEDULER_TIMING_WINDOW', default=50, cast=int)
+SCHEDULER_REFRESH_INTERVAL = config('SCHEDULER_REFRESH_INTERVAL', default=5, cast=float)
+
+# Full text search
+
+# Matching descriptions ranked per search, the newest ones; older matches of a very common term are
+# ignored.
+DESCRIPTION_SEARCH_MAX_CANDIDATES = config('DESCRIPTION_SEARCH_MAX_CANDIDATES', default=1000, cast=int)
+
+# Near-duplicate images
+
+# Differing perceptual hash bits up to which a user's new image counts as a duplicate of an
+# earlier one, and up to which images are listed as similar. Below 8 the chunk indexes are probed
+# for one flipped bit per chunk; from 8 on for two, which reads many times more rows.
+PERCEPTUAL_HASH_DUPLICATE_DISTANCE = config('PERCEPTUAL_HASH_DUPLICATE_DISTANCE', default=5, cast=int)
+PERCEPTUAL_HASH_SIMILAR_DISTANCE = config('PERCEPTUAL_HASH_SIMILAR_DISTANCE', default=7, cast=int)
+
 # EMAIL
 
 EMAIL_HOST = config('EMAIL_HOST', default='localhost')
@@ -213,6 +349,25 @@ LOG_VIEWER_EXCLUDE_TEXT_PATTERN = None  # String regex expression to exclude the
 LOG_VIEWER_FILE_LIST_TITLE = "Image Weaver Logs"
 
 LOG_DIR = BASE_DIR / 'logs'
+# Log files are written from a background thread per handler. Records beyond LOG_QUEUE_SIZE
+# waiting to be written are dropped. Every process appends to the same files and none rotates
+# them, rotate them with logrotate instead (the handlers reopen moved files), e.g.
+#   /srv/image_weaver/logs/*.log {
+#       daily
+#       rotate 5
+#       maxsize 50M
+#       compress
+#       delaycompress
+#       missingok
+#   }
+LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', default=10000, cast=int)
+# Queries logged to db_queries.log: 'all', 'sampled', 'slow' or 'off'. Queries of at least
+# SQL_LOG_SLOW_MS are kept in 'sampled' and 'slow' modes; 'sampled' also keeps a
+# SQL_LOG_SAMPLE_RATE share of the rest, at most SQL_LOG_MAX_PER_SECOND per process.
+SQL_LOG_MODE = config('SQL_LOG_MODE', default='sampled')
+SQL_LOG_SAMPLE_RATE = config('SQL_LOG_SAMPLE_RATE', default=0.01, cast=float)
+SQL_LOG_SLOW_MS = config('SQL_LOG_SLOW_MS', default=200, cast=float)
+SQL_LOG_MAX_PER_SECOND = config('SQL_LOG_MAX_PER_SECOND', default=50, cast=int)
 
 LOGGING = {
     'version': 1,
@@ -234,6 +389,15 @@ LOGGING = {
             'format': '%(asctime)s %(name)-5s %(levelname)-5s %(message)s'
         },
     },
+    'filters': {
+        'sql_sample': {
+            '()': 'common.log_handlers.SqlSampleFilter',
+            'mode': SQL_LOG_MODE,
+            'sample_rate': SQL_LOG_SAMPLE_RATE,
+            'slow_ms': SQL_LOG_SLOW_MS,
+            'max_per_second': SQL_LOG_MAX_PER_SECOND,
+        },
+    },
     'handlers': {
         'console': {
             'level': 'DEBUG',
@@ -242,26 +406,31 @@ LOGGING = {
         },
         'django_requests': {
             'level': 'WARNING',
-            'class': 'logging.FileHandler',
+            '()': 'common.log_handlers.QueuedFileHandler',
             'filename': LOG_DIR / 'django_requests.log',
+            'queue_size': LOG_QUEUE_SIZE,
             'formatter': 'verbose'
         },
         'info': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            '()': 'common.log_handlers.QueuedFileHandler',
             'filename': LOG_DIR / 'info.log',
+            'queue_size': LOG_QUEUE_SIZE,
             'formatter': 'verbose',
         },
         'error': {
             'level': 'ERROR',
-            'class': 'logging.FileHandler',
+            '()': 'common.log_handlers.QueuedFileHandler',
             'filename': LOG_DIR / 'error.log',
+            'queue_size': LOG_QUEUE_SIZE,
             'formatter': 'verbose',
         },
         'db_queries': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            '()': 'common.log_handlers.QueuedFileHandler',
             'filename': LOG_DIR / 'db_queries.log',
+            'queue_size': LOG_QUEUE_SIZE,
+            'filters': ['sql_sample'],
         },
         'celery_console': {
             'level': 'DEBUG',
@@ -270,8 +439,9 @@ LOGGING = {
         },
         'celery_file': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            '()': 'common.log_handlers.QueuedFileHandler',
             'filename': LOG_DIR / 'celery.log',
+            'queue_size': LOG_QUEUE_SIZE,
             'formatter': 'verbose'
         },
     },
@@ -305,4 +475,45 @@ LOGGING = {
 
 QUEUE_NAMES = {
     "GENERAL": "general",
+    # Long-running diffusion and DeepDream jobs
+    "INFERENCE": "inference",
+    # Light image work such as encoding derivatives
+    "POSTPROCESS": "postprocess",
+    # Short database writes
+    "BOOKKEEPING": "bookkeeping",
+}
+
+CELERY_TASK_DEFAULT_QUEUE = QUEUE_NAMES['GENERAL']
+CELERY_TASK_ROUTES = {
+    'images.tasks.generate_image': {'queue': QUEUE_NAMES['INFERENCE']},
+    'images.tasks.create_image_derivatives': {'queue': QUEUE_NAMES['POSTPROCESS']},
+    'images.tasks.record_generated_images': {'queue': QUEUE_NAMES['BOOKKEEPING']},
+}
+CELERY_TASK_QUEUE_MAX_PRIORITY = 10
+CELERY_TASK_DEFAULT_PRIORITY = 5
+CELERY_TASK_ANNOTATIONS = {
+    'images.tasks.generate_image': {'rate_limit': config('GENERATION_RATE_LIMIT', default='60/m')},
+}
+
+# Start a worker with WORKER_PROFILE set to one of these to consume only its queues with
+# matching concurrency and prefetch, e.g. `WORKER_PROFILE=inference celery -A image_weaver worker`.
+WORKER_PROFILE = config('WORKER_PROFILE', default='')
+WORKER_PROFILES = {
+    'inference': {
+        'queues': [QUEUE_NAMES['INFERENCE']],
+        'concurrency': 1,
+        # Do not reserve minutes of work that another idle worker could pick up.
+        'prefetch_multiplier': 1,
+        'warm_pool': True,
+    },
+    'postprocess': {
+        'queues': [QUEUE_NAMES['POSTPROCESS']],
+        'concurrency': 4,
+        'prefetch_multiplier': 4,
+    },
+    'bookkeeping': {
+        'queues': [QUEUE_NAMES['BOOKKEEPING'], QUEUE_NAMES['GENERAL']],
+        'concurrency': 8,
+        'prefetch_multiplier': 16,
+    },
 }
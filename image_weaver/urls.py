@@ -15,8 +15,23 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path
+from django.urls import include, path, re_path
+from log_viewer import urls as log_viewer_urls
+
+from common.log_tail import log_tail_json
+from common.metrics import metrics_view
+
+# django-log-viewer, with its JSON endpoints served by the tail reading view.
+log_viewer_patterns = [
+    re_path(r'^json/(?P<file_name>[\.\w-]*)/(?P<page>[0-9]+)$', log_tail_json, name='log_json_view'),
+    re_path(r'^json/(?P<file_name>[\.\w-]*)$', log_tail_json, name='log_json_view'),
+    *log_viewer_urls.urlpatterns,
+]
 
 urlpatterns = [
+    path('admin/logs/', include((log_viewer_patterns, 'log_viewer'))),
     path('admin/', admin.site.urls),
+    path('descriptions/', include('descriptions.urls')),
+    path('images/', include('images.urls')),
+    path('metrics/', metrics_view, name='metrics'),
 ]
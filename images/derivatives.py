@@ -0,0 +1,76 @@
+import hashlib
+import io
+import posixpath
+
+import PIL.Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from common import metrics
+from common.perceptual_hash import perceptual_hash
+
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+
+# variant: (longest side or None to keep the size, format, save options)
+DERIVATIVES = {
+    'thumbnail': (256, 'WEBP', {'quality': 80}),
+    'medium': (768, 'WEBP', {'quality': 85}),
+    'webp': (None, 'WEBP', {'quality': 90}),
+    'avif': (None, 'AVIF', {'quality': 70}),
+    'jpeg': (None, 'JPEG', {'quality': 90, 'progressive': True, 'optimize': True}),
+}
+
+
+def _info(name, content, width, height, image_format):
+    return {
+        'name': name,
+        'width': width,
+        'height': height,
+        'size': len(content),
+        'content_type': CONTENT_TYPES[image_format],
+        'etag': hashlib.sha256(content).hexdigest()[:32],
+    }
+
+
+def create_derivatives(name, storage=default_storage):
+    # Encodes every variant of the stored image `name` once and returns their metadata by variant,
+    # including the original's own copy. Formats this Pillow build cannot write (e.g. AVIF without
+    # the plugin) are skipped.
+    with storage.open(name, 'rb') as file:
+        content = file.read()
+    original = PIL.Image.open(io.BytesIO(content))
+    original.load()
+    # `name` may be a result cache entry, which is deleted on eviction: keep a copy of the
+    # original of our own, named after its content.
+    info = _info(name, content, original.width, original.height, original.format)
+    own_name = f'originals/{info["etag"][:2]}/{info["etag"]}{posixpath.splitext(name)[1]}'
+    if not storage.exists(own_name):
+        storage.save(own_name, ContentFile(content))
+    derivatives = {'original': {**info, 'name': own_name}}
+    # For finding near-duplicates, see `GeneratedImageQuerySet.similar`.
+    derivatives['original']['phash'] = perceptual_hash(original)
+
+    # Register every available plugin so `PIL.Image.SAVE` lists all writable formats.
+    PIL.Image.init()
+    stem = posixpath.splitext(name)[0]
+    for variant, (max_size, image_format, options) in DERIVATIVES.items():
+        if image_format not in PIL.Image.SAVE:
+            continue
+
+        image = original.convert('RGB')
+        if max_size:
+            image.thumbnail((max_size, max_size))
+        buffer = io.BytesIO()
+        with metrics.encode_time.time(format=image_format):
+            image.save(buffer, format=image_format, **options)
+
+        derivative_name = f'derivatives/{stem}/{variant}.{image_format.lower()}'
+        if not storage.exists(derivative_name):
+            storage.save(derivative_name, ContentFile(buffer.getvalue()))
+        derivatives[variant] = _info(derivative_name, buffer.getvalue(), image.width, image.height, image_format)
+
+    return derivatives
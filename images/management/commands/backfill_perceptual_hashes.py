@@ -0,0 +1,34 @@
+import PIL.Image
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from common.perceptual_hash import perceptual_hash
+from images.models import GeneratedImage
+
+
+class Command(BaseCommand):
+    help = 'Computes the perceptual hash of generated images recorded without one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = GeneratedImage.objects.filter(phash=None).order_by('pk').only('id', 'image')
+        last_pk, hashed = 0, 0
+        while True:
+            images = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not images:
+                break
+            last_pk = images[-1].pk
+
+            for image in images:
+                try:
+                    with default_storage.open(image.image.name, 'rb') as file:
+                        image.phash = perceptual_hash(PIL.Image.open(file))
+                except OSError as exc:
+                    self.stderr.write(f'Skipping {image.image.name}: {exc}')
+            images = [image for image in images if image.phash is not None]
+            GeneratedImage.objects.bulk_update(images, ['phash'])
+            hashed += len(images)
+
+        self.stdout.write(f'Hashed {hashed} images.')
@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common.benchmarks import BENCHMARKS, compare, run
+
+
+class Command(BaseCommand):
+    help = 'Runs the performance benchmarks and prints their results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*', choices=[[]] + list(BENCHMARKS),
+                            help='Benchmarks to run, all of them by default.')
+        parser.add_argument('--output', help='Also write the results to this file.')
+        parser.add_argument('--baseline', help='Fail if any metric regressed against this earlier output.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed relative regression against the baseline.')
+
+    def handle(self, *args, **options):
+        results = run(options['benchmarks'])
+        output = json.dumps(results, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                regressions = compare(results, json.load(file), options['tolerance'])
+            if regressions:
+                raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
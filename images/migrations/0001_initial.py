@@ -0,0 +1,78 @@
+# Generated by Django 5.0 on 2026-10-18 09:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('descriptions', '0001_initial'),
+        ('orders', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_time', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='created time')),
+                ('updated_time', models.DateTimeField(auto_now=True, verbose_name='updated time')),
+                ('is_active', models.BooleanField(default=True, verbose_name='is active')),
+                ('kind', models.CharField(choices=[('text_to_image', 'text to image'), ('deep_dream', 'deep dream')], default='text_to_image', max_length=16, verbose_name='kind')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='pending', max_length=16, verbose_name='status')),
+                ('prompt_hash', models.CharField(max_length=64, verbose_name='prompt hash')),
+                ('parameters', models.JSONField(blank=True, default=dict, verbose_name='parameters')),
+                ('task_id', models.CharField(blank=True, max_length=255, verbose_name='task id')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('started_time', models.DateTimeField(blank=True, null=True, verbose_name='started time')),
+                ('finished_time', models.DateTimeField(blank=True, null=True, verbose_name='finished time')),
+                ('description', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='descriptions.description', verbose_name='description')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='orders.order', verbose_name='order')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='generation_jobs', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'generation job',
+                'verbose_name_plural': 'generation jobs',
+            },
+        ),
+        migrations.CreateModel(
+            name='GeneratedImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_time', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='created time')),
+                ('updated_time', models.DateTimeField(auto_now=True, verbose_name='updated time')),
+                ('is_active', models.BooleanField(default=True, verbose_name='is active')),
+                ('prompt_hash', models.CharField(max_length=64, verbose_name='prompt hash')),
+                ('image', models.ImageField(max_length=255, upload_to='', verbose_name='image')),
+                ('width', models.PositiveIntegerField(blank=True, null=True, verbose_name='width')),
+                ('height', models.PositiveIntegerField(blank=True, null=True, verbose_name='height')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='generated_images', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='images', to='images.generationjob', verbose_name='job')),
+            ],
+            options={
+                'verbose_name': 'generated image',
+                'verbose_name_plural': 'generated images',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(fields=['user', 'status', '-created_time'], name='job_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(fields=['prompt_hash'], name='job_prompt_hash_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=models.Index(fields=['user', '-created_time'], include=('image',), name='image_user_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=models.Index(fields=['prompt_hash'], name='image_prompt_hash_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0 on 2026-10-18 09:18
+
+import django.contrib.postgres.indexes
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('descriptions', '0002_description_description_active_idx'),
+        ('images', '0001_initial'),
+        ('orders', '0002_order_order_active_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['-created_time', '-id'], name='generatedimage_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['-created_time', '-id'], name='generationjob_active_idx'),
+        ),
+    ]
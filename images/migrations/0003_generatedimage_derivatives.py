@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0002_generatedimage_generatedimage_active_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generatedimage',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, verbose_name='derivatives'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.0 on 2026-10-18 09:18
+
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+import django.db.models.expressions
+import django.db.models.functions.comparison
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0003_generatedimage_derivatives'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generatedimage',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='images.generatedimage', verbose_name='duplicate of'),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='phash',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='perceptual hash'),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='phash_0',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('phash'), '>>', models.Value(48)), '&', models.Value(65535)), models.IntegerField()), output_field=models.IntegerField(), verbose_name='perceptual hash chunk'),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='phash_1',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('phash'), '>>', models.Value(32)), '&', models.Value(65535)), models.IntegerField()), output_field=models.IntegerField(), verbose_name='perceptual hash chunk'),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='phash_2',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('phash'), '>>', models.Value(16)), '&', models.Value(65535)), models.IntegerField()), output_field=models.IntegerField(), verbose_name='perceptual hash chunk'),
+        ),
+        migrations.AddField(
+            model_name='generatedimage',
+            name='phash_3',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.comparison.Cast(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('phash'), '>>', models.Value(0)), '&', models.Value(65535)), models.IntegerField()), output_field=models.IntegerField(), verbose_name='perceptual hash chunk'),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['phash_0'], name='image_phash_0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['phash_1'], name='image_phash_1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['phash_2'], name='image_phash_2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generatedimage',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['phash_3'], name='image_phash_3_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0 on 2026-10-18 09:18
+
+import django.contrib.postgres.indexes
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('descriptions', '0003_search'),
+        ('images', '0004_perceptual_hash'),
+        ('orders', '0002_order_order_active_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='generationjob',
+            name='job_user_status_idx',
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=django.contrib.postgres.indexes.BTreeIndex(condition=models.Q(('is_active', True)), fields=['user', 'status', '-created_time'], name='job_user_status_idx'),
+        ),
+    ]
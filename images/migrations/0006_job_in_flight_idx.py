@@ -0,0 +1,25 @@
+# Generated by Django 5.0 on 2026-10-18 09:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('descriptions', '0003_search'),
+        ('images', '0005_job_user_status_idx_active'),
+        ('orders', '0002_order_order_active_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(condition=models.Q(('status__in', ['pending', 'running'])), fields=['user'], name='job_in_flight_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='generationjob',
+            index=models.Index(condition=models.Q(('status__in', ['pending', 'running'])), fields=['kind'], name='job_in_flight_kind_idx'),
+        ),
+    ]
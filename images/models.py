@@ -1 +1,215 @@
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Q, Value
+from django.db.models.functions import Cast
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from common.base_models import ActiveManager, ActiveQuerySet, BaseModel, active_index
+from common.perceptual_hash import CHUNK_BITS, CHUNKS, chunk_neighbours, hamming_distance, hash_chunks
+
+
+# Jobs waiting for or holding a worker. Queries filtering on exactly this condition are served by
+# the small partial indexes on in-flight jobs.
+IN_FLIGHT = Q(status__in=['pending', 'running'])
+
+
+class GenerationJobQuerySet(ActiveQuerySet):
+    def in_flight(self):
+        return self.filter(IN_FLIGHT)
+
+    def status_counts(self, user):
+        # Through `actives`, served by an index-only scan of `job_user_status_idx`.
+        return dict(self.filter(user=user).values_list('status').annotate(count=models.Count('*')))
+
+
+class GenerationJob(BaseModel):
+    class Kind(models.TextChoices):
+        TEXT_TO_IMAGE = 'text_to_image', _('text to image')
+        DEEP_DREAM = 'deep_dream', _('deep dream')
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', _('pending')
+        RUNNING = 'running', _('running')
+        SUCCEEDED = 'succeeded', _('succeeded')
+        FAILED = 'failed', _('failed')
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'), related_name='generation_jobs',
+                             on_delete=models.CASCADE)
+    order = models.ForeignKey('orders.Order', verbose_name=_('order'), related_name='jobs', null=True, blank=True,
+                              on_delete=models.SET_NULL)
+    description = models.ForeignKey('descriptions.Description', verbose_name=_('description'), related_name='jobs',
+                                    null=True, blank=True, on_delete=models.SET_NULL)
+    kind = models.CharField(verbose_name=_('kind'), max_length=16, choices=Kind.choices, default=Kind.TEXT_TO_IMAGE)
+    status = models.CharField(verbose_name=_('status'), max_length=16, choices=Status.choices,
+                              default=Status.PENDING)
+    prompt_hash = models.CharField(verbose_name=_('prompt hash'), max_length=64)
+    parameters = models.JSONField(verbose_name=_('parameters'), default=dict, blank=True)
+    task_id = models.CharField(verbose_name=_('task id'), max_length=255, blank=True)
+    error = models.TextField(verbose_name=_('error'), blank=True)
+    started_time = models.DateTimeField(verbose_name=_('started time'), null=True, blank=True)
+    finished_time = models.DateTimeField(verbose_name=_('finished time'), null=True, blank=True)
+
+    objects = GenerationJobQuerySet.as_manager()
+    actives = ActiveManager.from_queryset(GenerationJobQuerySet)()
+
+    def __str__(self):
+        return f'{self.pk} {self.kind} {self.status}'
+
+    def _set_status(self, status, **fields):
+        self.status = status
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.save(update_fields=['status', 'updated_time', *fields])
+
+    def mark_running(self, task_id=''):
+        self._set_status(self.Status.RUNNING, task_id=task_id, started_time=timezone.now())
+
+    def mark_succeeded(self):
+        self._set_status(self.Status.SUCCEEDED, finished_time=timezone.now())
+
+    def mark_failed(self, error):
+        self._set_status(self.Status.FAILED, error=str(error), finished_time=timezone.now())
+
+    class Meta(BaseModel.Meta):
+        verbose_name = _('generation job')
+        verbose_name_plural = _('generation jobs')
+        indexes = [
+            *BaseModel.Meta.indexes,
+            active_index('user', 'status', '-created_time', name='job_user_status_idx'),
+            models.Index(fields=['prompt_hash'], name='job_prompt_hash_idx'),
+            models.Index(fields=['user'], condition=IN_FLIGHT, name='job_in_flight_user_idx'),
+            models.Index(fields=['kind'], condition=IN_FLIGHT, name='job_in_flight_kind_idx'),
+        ]
+
+
+class HammingDistance(models.Func):
+    # Number of differing bits between two 64 bit hashes (PostgreSQL 14 or later).
+    template = 'bit_count((%(expressions)s)::bit(64))'
+    arg_joiner = ' # '
+    output_field = models.IntegerField()
+
+
+def _near(phashes, distance):
+    # Multi-index hashing: split into CHUNKS parts, a hash within `distance` bits of one of
+    # `phashes` has at least one part within `distance // CHUNKS` bits of the same part of it, so
+    # the chunk indexes give a few candidates and only those need comparing in full.
+    per_chunk = distance // CHUNKS
+    neighbours = [set() for _ in range(CHUNKS)]
+    for phash in phashes:
+        for i, chunk in enumerate(hash_chunks(phash)):
+            neighbours[i].update(chunk_neighbours(chunk, per_chunk))
+    condition = Q()
+    for i, values in enumerate(neighbours):
+        condition |= Q(**{f'phash_{i}__in': sorted(values)})
+    return condition
+
+
+class GeneratedImageQuerySet(ActiveQuerySet):
+    def bulk_create_for_job(self, job, names, width=None, height=None, derivatives=None, batch_size=500):
+        # One INSERT per `batch_size` images instead of one per image. Images near-identical to
+        # one the user already has, or to an earlier one of the batch, are recorded as its
+        # duplicates; the user's originals are looked up once for the whole batch.
+        derivatives = derivatives or {}
+        distance = settings.PERCEPTUAL_HASH_DUPLICATE_DISTANCE
+        images = []
+        for name in names:
+            original = derivatives.get(name, {}).get('original', {})
+            images.append(self.model(
+                # The copy of the original outlives `name` when that is an evicted result cache entry.
+                job=job, user_id=job.user_id, prompt_hash=job.prompt_hash, image=original.get('name', name),
+                width=width, height=height, derivatives=derivatives.get(name, {}), phash=original.get('phash'),
+            ))
+
+        # Originals of the user first, then those of the batch: ties go to the existing image.
+        originals = self.find_originals(job.user_id, [image.phash for image in images if image.phash is not None])
+        in_batch = []
+        for image in images:
+            if image.phash is None:
+                continue
+            closest = min(originals + in_batch, key=lambda original: hamming_distance(original.phash, image.phash),
+                          default=None)
+            if closest is not None and hamming_distance(closest.phash, image.phash) <= distance:
+                image.duplicate_of = closest
+            else:
+                in_batch.append(image)
+
+        # Duplicates of images in the batch can only point at them once those have their ids.
+        in_batch_duplicates = [image.duplicate_of in in_batch for image in images]
+        self.bulk_create([image for image, later in zip(images, in_batch_duplicates) if not later],
+                         batch_size=batch_size)
+        self.bulk_create([image for image, later in zip(images, in_batch_duplicates) if later], batch_size=batch_size)
+        return images
+
+    def similar(self, phash, distance):
+        # Images whose perceptual hash differs from `phash` in at most `distance` bits, closest
+        # first.
+        return (
+            self.filter(_near([phash], distance))
+            .annotate(distance=HammingDistance('phash', Value(phash, output_field=models.BigIntegerField())))
+            .filter(distance__lte=distance)
+            .order_by('distance', '-id')
+        )
+
+    def find_originals(self, user_id, phashes):
+        # The user's active originals that may be within PERCEPTUAL_HASH_DUPLICATE_DISTANCE of any
+        # of `phashes`, newest first, with a single query. Callers compare the hashes in full.
+        if not phashes:
+            return []
+        return list(
+            self.model.actives.filter(user_id=user_id, duplicate_of=None)
+            .filter(_near(phashes, settings.PERCEPTUAL_HASH_DUPLICATE_DISTANCE))
+            .only('id', 'phash').order_by('-id')
+        )
+
+
+def _phash_chunk(i):
+    # Bits of `phash` for the chunk index `i`, most significant first.
+    return models.GeneratedField(
+        verbose_name=_('perceptual hash chunk'),
+        expression=Cast(F('phash').bitrightshift(CHUNK_BITS * (CHUNKS - 1 - i)).bitand((1 << CHUNK_BITS) - 1),
+                         models.IntegerField()),
+        output_field=models.IntegerField(),
+        db_persist=True,
+    )
+
+
+class GeneratedImage(BaseModel):
+    job = models.ForeignKey(GenerationJob, verbose_name=_('job'), related_name='images', on_delete=models.CASCADE)
+    # Denormalized from the job so galleries do not need a join.
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'), related_name='generated_images',
+                             on_delete=models.CASCADE)
+    prompt_hash = models.CharField(verbose_name=_('prompt hash'), max_length=64)
+    image = models.ImageField(verbose_name=_('image'), max_length=255)
+    width = models.PositiveIntegerField(verbose_name=_('width'), null=True, blank=True)
+    height = models.PositiveIntegerField(verbose_name=_('height'), null=True, blank=True)
+    # Variant name to stored file metadata, see `images.derivatives.create_derivatives`.
+    derivatives = models.JSONField(verbose_name=_('derivatives'), default=dict, blank=True)
+    # Perceptual hash of the original, see `common.perceptual_hash`, and its parts for `similar`.
+    phash = models.BigIntegerField(verbose_name=_('perceptual hash'), null=True, blank=True)
+    phash_0 = _phash_chunk(0)
+    phash_1 = _phash_chunk(1)
+    phash_2 = _phash_chunk(2)
+    phash_3 = _phash_chunk(3)
+    duplicate_of = models.ForeignKey('self', verbose_name=_('duplicate of'), related_name='duplicates', null=True,
+                                     blank=True, on_delete=models.SET_NULL)
+
+    objects = GeneratedImageQuerySet.as_manager()
+    actives = ActiveManager.from_queryset(GeneratedImageQuerySet)()
+
+    def __str__(self):
+        return f'{self.image.name}'
+
+    def get_file_url(self, variant='thumbnail'):
+        return reverse('images:file', kwargs={'pk': self.pk, 'variant': variant})
+
+    class Meta(BaseModel.Meta):
+        verbose_name = _('generated image')
+        verbose_name_plural = _('generated images')
+        indexes = [
+            *BaseModel.Meta.indexes,
+            models.Index(fields=['user', '-created_time'], include=['image'], name='image_user_recent_idx'),
+            models.Index(fields=['prompt_hash'], name='image_prompt_hash_idx'),
+            *[active_index(f'phash_{i}', name=f'image_phash_{i}_idx') for i in range(CHUNKS)],
+        ]
@@ -0,0 +1,164 @@
+import functools
+import logging
+import uuid
+
+from celery import shared_task
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from common import metrics
+from common.single_flight import get_single_flight
+from images.derivatives import create_derivatives
+from images.models import GeneratedImage, GenerationJob
+
+logger = logging.getLogger('info')
+
+
+def user_priority(user):
+    # Users with fewer jobs in flight go first, so one heavy user cannot starve everybody else.
+    in_flight = GenerationJob.objects.in_flight().filter(user=user).count()
+    priority = settings.CELERY_TASK_DEFAULT_PRIORITY - in_flight
+    if user.is_staff:
+        priority += 2
+    return min(max(priority, 0), settings.CELERY_TASK_QUEUE_MAX_PRIORITY)
+
+
+def submit_generation(user, prompt, num_steps=50, seed=None, order=None, description=None):
+    from common.result_cache import generation_key
+    from common.scheduler import get_scheduler
+
+    priority = user_priority(user)
+    # Jobs already waiting for or holding the inference workers.
+    depth = GenerationJob.objects.in_flight().filter(kind=GenerationJob.Kind.TEXT_TO_IMAGE).count()
+    plan = get_scheduler().plan_generation(num_steps, depth)
+    num_steps = plan.num_steps
+    job = GenerationJob.objects.create(
+        user=user,
+        order=order,
+        description=description,
+        kind=GenerationJob.Kind.TEXT_TO_IMAGE,
+        prompt_hash=generation_key(prompt, num_steps=num_steps, seed=seed),
+        parameters={'prompt': prompt, 'num_steps': num_steps, 'seed': seed, 'degraded': plan.degraded},
+    )
+    # Identical requests in flight share one generation, the leader's task hands them its images.
+    # Unseeded requests are random and never identical.
+    task_id = str(uuid.uuid4())
+    leader = None if seed is None else get_single_flight().acquire(job.prompt_hash, task_id, job.pk)
+    if leader is not None:
+        job.task_id = leader
+        job.save(update_fields=['task_id', 'updated_time'])
+        metrics.coalesced_requests.inc(kind=job.kind)
+        # The leader may crash and never hand over its images, then this job runs on its own.
+        resubmit_follower.apply_async((job.pk,), countdown=settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        return job
+
+    _start_generation(job, priority, task_id)
+    return job
+
+
+def _start_generation(job, priority, task_id):
+    parameters = job.parameters
+    generate_image.apply_async((parameters['prompt'],),
+                               {'num_steps': parameters['num_steps'], 'seed': parameters['seed'], 'job_id': job.pk},
+                               priority=priority, task_id=task_id)
+
+
+@shared_task
+def resubmit_follower(job_id):
+    # Checks on a follower every SINGLE_FLIGHT_POLL_INTERVAL seconds, short countdowns keep the
+    # broker from holding long ETA messages. A follower still pending once its leader no longer
+    # holds the single flight lock lost its leader.
+    with transaction.atomic():
+        job = GenerationJob.objects.select_for_update().filter(pk=job_id, status=GenerationJob.Status.PENDING).first()
+        if job is None:
+            return
+        if get_single_flight().leader(job.prompt_hash) == job.task_id:
+            resubmit_follower.apply_async((job.pk,), countdown=settings.SINGLE_FLIGHT_POLL_INTERVAL)
+            return
+        leader, task_id = job.task_id, str(uuid.uuid4())
+        job.mark_running(task_id=task_id)
+    logger.info('Resubmitting generation job %s, its leader %s did not finish', job.pk, leader)
+    _start_generation(job, user_priority(job.user), task_id)
+
+
+@shared_task(bind=True, acks_late=True)
+def generate_image(self, prompt, num_steps=50, seed=None, job_id=None):
+    from common.stable_diffusion import generate_and_save
+
+    job = GenerationJob.objects.get(pk=job_id) if job_id else None
+    if job is not None:
+        job.mark_running(task_id=self.request.id or '')
+
+    try:
+        stored = generate_and_save(prompt, num_steps=num_steps, seed=seed)
+    except Exception as exc:
+        if job is not None:
+            _fail(job, exc)
+        raise
+
+    # Encoding, uploads and bookkeeping run in the background and on their own queues, so this
+    # worker can start the next job. The derivatives need the files, they wait for the uploads.
+    if job is not None:
+        stored.add_done_callback(functools.partial(_stored, job))
+
+
+def _with_fresh_connections(callback):
+    # For callbacks of the upload threads, whose database connections nothing else closes. Left
+    # alone inside a transaction, which closing the connection would break.
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            return callback(*args, **kwargs)
+        close_old_connections()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+@_with_fresh_connections
+def _stored(job, stored):
+    try:
+        names = stored.result()
+    except Exception as exc:
+        _fail(job, exc)
+        return
+    followers = _release_followers(job)
+    create_image_derivatives.delay(job.pk, names, follower_ids=[follower.pk for follower in followers])
+
+
+@_with_fresh_connections
+def _fail(job, exc):
+    for follower in _release_followers(job):
+        follower.mark_failed(exc)
+    job.mark_failed(exc)
+
+
+def _release_followers(job):
+    # Claims the followers still waiting, a follower resubmitted meanwhile runs on its own.
+    if job.parameters.get('seed') is None:
+        return []
+    follower_ids = get_single_flight().release(job.prompt_hash, job.task_id)
+    with transaction.atomic():
+        followers = list(GenerationJob.objects.select_for_update().filter(
+            pk__in=follower_ids, status=GenerationJob.Status.PENDING))
+        for follower in followers:
+            follower.mark_running(task_id=job.task_id)
+    return followers
+
+
+@shared_task
+def create_image_derivatives(job_id, names, follower_ids=()):
+    derivatives = {name: create_derivatives(name) for name in names}
+    for pk in [job_id, *follower_ids]:
+        record_generated_images.delay(pk, names, derivatives)
+
+
+@shared_task
+def record_generated_images(job_id, names, derivatives):
+    job = GenerationJob.objects.get(pk=job_id)
+    GeneratedImage.objects.bulk_create_for_job(
+        job, names, width=settings.STABLE_DIFFUSION_IMAGE_WIDTH, height=settings.STABLE_DIFFUSION_IMAGE_HEIGHT,
+        derivatives=derivatives)
+    job.mark_succeeded()
@@ -1,3 +1,386 @@
-from django.test import TestCase
+import io
+import json
+from unittest import mock
 
-# Create your tests here.
+import PIL.Image
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from common import stable_diffusion
+from common.result_cache import generation_key, get_result_cache
+from common.scheduler import GenerationPlan, get_scheduler
+from common.single_flight import get_single_flight
+from common.tests.cases import MediaTestCase
+from images.derivatives import create_derivatives
+from images.models import GeneratedImage, GenerationJob
+from images.tasks import (
+    _release_followers, record_generated_images, resubmit_follower, submit_generation, user_priority,
+)
+
+
+def _fake_dream(content, layers, plan, progress, cancelled):
+    for step in (1, 2):
+        progress.put({'octave': 0, 'step': step, 'loss': 0.5, 'preview': ''})
+    return 'deep_dream/result.jpg', content
+
+
+class DeepDreamStreamTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user('dreamer')
+
+    def post(self, client, **data):
+        return client.post(reverse('images:deep_dream'), {'image': SimpleUploadedFile('in.jpg', b'jpeg'), **data})
+
+    async def test_streams_progress_then_the_result(self):
+        await self.async_client.aforce_login(self.user)
+        with mock.patch('images.views._run_dream', _fake_dream):
+            response = await self.post(self.async_client)
+            body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        events = [block.split('\n')[0] for block in body.strip().split('\n\n')]
+        self.assertEqual(events, ['event: plan', 'event: progress', 'event: progress', 'event: result'])
+        self.assertTrue(default_storage.exists('deep_dream/result.jpg'))
+
+    def test_requires_authentication(self):
+        self.assertEqual(self.post(self.client).status_code, 401)
+
+    def test_rejects_unknown_layers(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.post(self.client, layers='mixed3,not_a_layer').status_code, 400)
+
+
+class GenerateViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('maker', password='secret')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        patcher = mock.patch('images.views.get_generation_service')
+        self.service = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.service.pending = 0
+        self.service.generate = mock.AsyncMock(return_value=['generated/ab/ab_0.jpg'])
+
+    def post(self, body):
+        return self.client.post(reverse('images:generate'), body, content_type='application/json')
+
+    def test_generates(self):
+        response = self.post({'prompt': 'a red fox', 'num_steps': 20, 'seed': 7})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['images'], ['generated/ab/ab_0.jpg'])
+        self.service.generate.assert_awaited_once_with('a red fox', num_steps=20, seed=7, timeout=mock.ANY)
+
+    def test_requires_authentication(self):
+        self.client.logout()
+        response = self.post({'prompt': 'a red fox'})
+        self.assertEqual(response.status_code, 401)
+        self.service.generate.assert_not_called()
+
+    def test_requires_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        response = client.post(reverse('images:generate'), {'prompt': 'a red fox'}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_rejects_malformed_bodies(self):
+        bodies = [
+            'not json',
+            ['a red fox'],
+            {},
+            {'prompt': ''},
+            {'prompt': 5},
+            {'prompt': 'x' * 1001},
+            {'prompt': 'a red fox', 'num_steps': 'abc'},
+            {'prompt': 'a red fox', 'num_steps': 0},
+            {'prompt': 'a red fox', 'num_steps': 151},
+            {'prompt': 'a red fox', 'num_steps': True},
+            {'prompt': 'a red fox', 'seed': -1},
+            {'prompt': 'a red fox', 'seed': '7'},
+        ]
+        with mock.patch('images.views.get_scheduler') as get_scheduler:
+            for body in bodies:
+                with self.subTest(body=body):
+                    response = self.post(body if isinstance(body, str) else json.dumps(body))
+                    self.assertEqual(response.status_code, 400)
+        get_scheduler.return_value.plan_generation.assert_not_called()
+        self.service.generate.assert_not_called()
+
+    def test_degraded_plan(self):
+        with mock.patch('images.views.get_scheduler') as get_scheduler:
+            get_scheduler.return_value.plan_generation.return_value = GenerationPlan(10, 5.0, True)
+            response = self.post({'prompt': 'a red fox', 'num_steps': 50})
+        self.assertEqual(response.json()['num_steps'], 10)
+        self.assertTrue(response.json()['degraded'])
+
+
+class GenerationJobTests(TestCase):
+    def test_status_counts_of_active_jobs(self):
+        user = get_user_model().objects.create_user('maker')
+        other = get_user_model().objects.create_user('other')
+        for status in ['pending', 'pending', 'running', 'failed']:
+            GenerationJob.objects.create(user=user, prompt_hash='0' * 64, status=status)
+        GenerationJob.objects.create(user=user, prompt_hash='0' * 64, status='failed', is_active=False)
+        GenerationJob.objects.create(user=other, prompt_hash='0' * 64)
+        self.assertEqual(GenerationJob.actives.status_counts(user), {'pending': 2, 'running': 1, 'failed': 1})
+
+    def test_in_flight_counts_use_the_partial_indexes(self):
+        user = get_user_model().objects.create_user('maker')
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        self.assertIn('job_in_flight_user_idx', GenerationJob.objects.in_flight().filter(user=user).explain())
+        self.assertIn('job_in_flight_kind_idx',
+                      GenerationJob.objects.in_flight().filter(kind=GenerationJob.Kind.TEXT_TO_IMAGE).explain())
+
+
+class SubmitGenerationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_submission_is_planned_for_the_jobs_in_flight(self):
+        user = get_user_model().objects.create_user('maker')
+        for status in ['pending', 'running', 'succeeded']:
+            GenerationJob.objects.create(user=user, prompt_hash='0' * 64, status=status)
+        get_scheduler().record('stable_diffusion', 50, 50)
+        with mock.patch('images.tasks.generate_image.apply_async') as apply_async:
+            job = submit_generation(user, 'a red fox', num_steps=50)
+        self.assertEqual((job.parameters['num_steps'], job.parameters['degraded']), (20, True))
+        self.assertEqual(apply_async.call_args.kwargs['priority'], user_priority(user) + 1)
+
+
+class FollowerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('maker')
+        for name in ('generate_image', 'resubmit_follower'):
+            patch = mock.patch(f'images.tasks.{name}.apply_async')
+            setattr(self, name, patch.start())
+            self.addCleanup(patch.stop)
+        self.leader = submit_generation(self.user, 'a red fox', num_steps=2, seed=3)
+        self.leader.mark_running(task_id=self.generate_image.call_args.kwargs['task_id'])
+        self.follower = submit_generation(self.user, 'a red fox', num_steps=2, seed=3)
+
+    def test_follower_waits_for_the_leader(self):
+        self.assertEqual(self.generate_image.call_count, 1)
+        self.assertEqual(self.follower.task_id, self.leader.task_id)
+        self.resubmit_follower.assert_called_once_with(
+            (self.follower.pk,), countdown=settings.SINGLE_FLIGHT_POLL_INTERVAL)
+
+    def test_follower_of_a_running_leader_is_checked_again(self):
+        resubmit_follower(self.follower.pk)
+        self.assertEqual(self.generate_image.call_count, 1)
+        self.assertEqual(self.resubmit_follower.call_count, 2)
+        self.follower.refresh_from_db()
+        self.assertEqual(self.follower.status, GenerationJob.Status.PENDING)
+
+    def test_follower_of_a_crashed_leader_is_resubmitted(self):
+        single_flight = get_single_flight()
+        # The lock of a crashed leader expires.
+        single_flight.redis.delete(single_flight._lock_key(self.leader.prompt_hash))
+        resubmit_follower(self.follower.pk)
+        self.follower.refresh_from_db()
+        self.assertEqual(self.follower.status, GenerationJob.Status.RUNNING)
+        self.assertEqual(self.generate_image.call_args.kwargs['task_id'], self.follower.task_id)
+        self.assertEqual(self.generate_image.call_args.args[1]['job_id'], self.follower.pk)
+
+    def test_released_follower_is_not_resubmitted(self):
+        self.assertEqual(_release_followers(self.leader), [self.follower])
+        resubmit_follower(self.follower.pk)
+        self.assertEqual(self.generate_image.call_count, 1)
+        self.follower.refresh_from_db()
+        self.assertEqual(self.follower.task_id, self.leader.task_id)
+
+
+class JobViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('maker')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_submit_queues_a_generation(self):
+        with mock.patch('images.tasks.generate_image.apply_async') as apply_async:
+            response = self.client.post(reverse('images:jobs'), {'prompt': 'a red fox', 'num_steps': 20, 'seed': 7},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        job = GenerationJob.objects.get(pk=response.json()['id'])
+        self.assertEqual(job.user, self.user)
+        self.assertEqual(job.parameters['prompt'], 'a red fox')
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args.args, (('a red fox',), {'num_steps': 20, 'seed': 7, 'job_id': job.pk}))
+
+    def test_submit_rejects_malformed_bodies(self):
+        response = self.client.post(reverse('images:jobs'), {'prompt': 'a red fox', 'num_steps': 0},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(GenerationJob.objects.exists())
+
+    def test_job_detail(self):
+        job = GenerationJob.objects.create(user=self.user, prompt_hash='0' * 64, status='succeeded',
+                                           parameters={'num_steps': 20})
+        image = GeneratedImage.objects.create(job=job, user=self.user, prompt_hash=job.prompt_hash, image='a.jpg')
+        response = self.client.get(reverse('images:job', kwargs={'pk': job.pk}))
+        self.assertEqual(response.json()['status'], 'succeeded')
+        self.assertEqual(response.json()['images'], [{'id': image.pk, 'url': image.get_file_url()}])
+
+    def test_job_detail_of_another_user(self):
+        other = get_user_model().objects.create_user('other')
+        job = GenerationJob.objects.create(user=other, prompt_hash='0' * 64)
+        response = self.client.get(reverse('images:job', kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 404)
+
+
+class ImageFileTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user('maker')
+        job = GenerationJob.objects.create(user=self.user, prompt_hash='0' * 64)
+        pixels = np.random.default_rng(0).integers(0, 256, (64, 48, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        PIL.Image.fromarray(pixels).save(buffer, format='JPEG')
+        name = default_storage.save('generated/image.jpg', buffer)
+        self.image, = GeneratedImage.objects.bulk_create_for_job(
+            job, [name], width=48, height=64, derivatives={name: create_derivatives(name)})
+        self.client.force_login(self.user)
+
+    def get(self, variant='original', **headers):
+        return self.client.get(reverse('images:file', args=[self.image.pk, variant]), headers=headers)
+
+    def content(self, variant='original'):
+        with default_storage.open(self.image.derivatives[variant]['name'], 'rb') as file:
+            return file.read()
+
+    def test_variants(self):
+        for variant, info in self.image.derivatives.items():
+            response = self.get(variant)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], info['content_type'])
+            self.assertEqual(response['ETag'], f'"{info["etag"]}"')
+            self.assertEqual(b''.join(response.streaming_content), self.content(variant))
+        self.assertEqual(self.get('huge').status_code, 404)
+
+    def test_head(self):
+        response = self.client.head(reverse('images:file', args=[self.image.pk, 'original']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{self.image.derivatives["original"]["etag"]}"')
+
+    def test_not_modified(self):
+        response = self.get(if_none_match=self.get()['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_single_range(self):
+        size = len(self.content())
+        response = self.get(range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{size}')
+        self.assertEqual(b''.join(response.streaming_content), self.content()[10:20])
+        response = self.get(range='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.content()[-5:])
+
+    def test_unsatisfiable_ranges(self):
+        size = len(self.content())
+        for header in [f'bytes={size}-', 'bytes=20-10']:
+            response = self.get(range=header)
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    def test_only_the_owner(self):
+        other = get_user_model().objects.create_user('other')
+        self.client.force_login(other)
+        self.assertEqual(self.get().status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.get().status_code, 401)
+
+
+class DuplicateImageTests(TestCase):
+    original = -0x1234_5678_9ABC_DEF0
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('maker')
+        self.job = GenerationJob.objects.create(user=self.user, prompt_hash='0' * 64)
+
+    def create(self, *phashes):
+        names = [f'generated/{i}.jpg' for i in range(len(phashes))]
+        derivatives = {name: {'original': {'phash': phash}} for name, phash in zip(names, phashes)}
+        return GeneratedImage.objects.bulk_create_for_job(self.job, names, derivatives=derivatives)
+
+    def test_duplicates_of_existing_and_batch_images(self):
+        existing, = self.create(self.original)
+        other = self.original ^ 0xFFFF_FFFF
+        with self.assertNumQueries(3):
+            images = self.create(self.original ^ 0b111, other, other ^ 0b11, None, self.original ^ 0xFF)
+        self.assertEqual([image.duplicate_of for image in images], [existing, None, images[1], None, None])
+        self.assertEqual(GeneratedImage.objects.get(pk=images[2].pk).duplicate_of_id, images[1].pk)
+
+    def test_only_active_originals_of_the_user(self):
+        inactive, = self.create(self.original)
+        GeneratedImage.objects.filter(pk=inactive.pk).update(is_active=False)
+        other_user = get_user_model().objects.create_user('other')
+        GeneratedImage.objects.bulk_create_for_job(
+            GenerationJob.objects.create(user=other_user, prompt_hash='0' * 64), ['generated/other.jpg'],
+            derivatives={'generated/other.jpg': {'original': {'phash': self.original}}})
+        image, = self.create(self.original)
+        self.assertIsNone(image.duplicate_of)
+
+    def test_similar_closest_first(self):
+        images = self.create(self.original ^ 0b1, self.original ^ 0xFFFF_FFFF, self.original ^ 0b111)
+        similar = GeneratedImage.actives.similar(self.original, 7)
+        self.assertEqual([image.pk for image in similar], [images[0].pk, images[2].pk])
+
+
+class SimilarImagesViewTests(TestCase):
+    original = -0x1234_5678_9ABC_DEF0
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('maker')
+        self.other = get_user_model().objects.create_user('other')
+        self.image, self.close, self.far = self.create(self.user, self.original, self.original ^ 0b1, ~self.original)
+        self.others_close, = self.create(self.other, self.original ^ 0b11)
+        self.client.force_login(self.user)
+
+    def create(self, user, *phashes):
+        job = GenerationJob.objects.create(user=user, prompt_hash='0' * 64)
+        names = [f'generated/{user.pk}-{i}.jpg' for i in range(len(phashes))]
+        derivatives = {name: {'original': {'phash': phash}} for name, phash in zip(names, phashes)}
+        return GeneratedImage.objects.bulk_create_for_job(job, names, derivatives=derivatives)
+
+    def get(self, image):
+        return self.client.get(reverse('images:similar', kwargs={'pk': image.pk}))
+
+    def test_only_the_callers_images(self):
+        response = self.get(self.image)
+        self.assertEqual([result['id'] for result in response.json()['results']], [self.close.pk])
+
+    def test_images_of_other_users(self):
+        self.assertEqual(self.get(self.others_close).status_code, 404)
+
+    def test_requires_a_login(self):
+        self.client.logout()
+        self.assertEqual(self.get(self.image).status_code, 401)
+
+
+@override_settings(STABLE_DIFFUSION_BACKEND='dummy', STABLE_DIFFUSION_MAX_BATCH_SIZE=1)
+class RecordedImageTests(MediaTestCase):
+    def test_images_outlive_their_evicted_cache_entry(self):
+        user = get_user_model().objects.create_user('maker')
+        job = GenerationJob.objects.create(user=user, prompt_hash='0' * 64)
+        names = stable_diffusion.generate_and_save('a red fox', num_steps=2, seed=3).result(5)
+        record_generated_images(job.pk, names, {name: create_derivatives(name) for name in names})
+
+        get_result_cache().delete(generation_key('a red fox', num_steps=2, seed=3))
+        self.assertFalse(default_storage.exists(names[0]))
+        image = GeneratedImage.objects.get(job=job)
+        self.assertTrue(default_storage.exists(image.image.name))
+        self.client.force_login(user)
+        response = self.client.get(reverse('images:file', args=[image.pk, 'original']))
+        self.assertEqual(response.status_code, 200)
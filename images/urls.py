@@ -0,0 +1,14 @@
+from django.urls import path
+
+from images import views
+
+app_name = 'images'
+
+urlpatterns = [
+    path('generate/', views.generate, name='generate'),
+    path('jobs/', views.submit_job, name='jobs'),
+    path('jobs/<int:pk>/', views.job_detail, name='job'),
+    path('deep-dream/', views.deep_dream_stream, name='deep_dream'),
+    path('<int:pk>/similar/', views.similar_images, name='similar'),
+    path('<int:pk>/<slug:variant>/', views.image_file, name='file'),
+]
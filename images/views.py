@@ -1,3 +1,338 @@
-from django.shortcuts import render
+import asyncio
+import base64
+import functools
+import hashlib
+import io
+import json
+import logging
+import queue
+import re
+import time
 
-# Create your views here.
+import PIL.Image
+import numpy as np
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import (FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse,
+                         StreamingHttpResponse)
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_GET, require_POST, require_safe
+
+from common.encoding import get_encoder
+from common.generation_service import ServiceBusy, get_generation_service
+from common.scheduler import get_scheduler, octave_work
+from common.storage import get_upload_queue
+from images.models import GeneratedImage, GenerationJob
+from images.tasks import submit_generation
+
+logger = logging.getLogger('error')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+SIMILAR_LIMIT = 20
+MAX_PROMPT_LENGTH = 1000
+MAX_NUM_STEPS = 150
+MAX_SEED = 2 ** 31 - 1
+# Seconds between checks for DeepDream progress.
+PROGRESS_POLL_INTERVAL = 0.1
+
+
+def login_required_json(view):
+    # For API views: a 401 response instead of a redirect to the login page.
+    if not iscoroutinefunction(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                return JsonResponse({'error': 'authentication required'}, status=401)
+            return view(request, *args, **kwargs)
+        return wrapper
+
+    @functools.wraps(view)
+    async def async_wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return JsonResponse({'error': 'authentication required'}, status=401)
+        return await view(request, *args, **kwargs)
+    return async_wrapper
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _parse_generation(body):
+    # The prompt, step count and seed of a generation request. Raises ValueError with a message
+    # for the client when the body is malformed.
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise ValueError('the body must be JSON') from None
+    if not isinstance(data, dict):
+        raise ValueError('the body must be a JSON object')
+
+    prompt = data.get('prompt')
+    if not isinstance(prompt, str) or not prompt.strip() or len(prompt) > MAX_PROMPT_LENGTH:
+        raise ValueError(f'prompt must be a non-empty string of at most {MAX_PROMPT_LENGTH} characters')
+    num_steps = data.get('num_steps', 50)
+    if not _is_int(num_steps) or not 1 <= num_steps <= MAX_NUM_STEPS:
+        raise ValueError(f'num_steps must be an integer from 1 to {MAX_NUM_STEPS}')
+    seed = data.get('seed')
+    if seed is not None and (not _is_int(seed) or not 0 <= seed <= MAX_SEED):
+        raise ValueError(f'seed must be an integer from 0 to {MAX_SEED}')
+    return prompt, num_steps, seed
+
+
+@require_POST
+@login_required_json
+async def generate(request):
+    try:
+        prompt, num_steps, seed = _parse_generation(request.body)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+
+    service = get_generation_service()
+    # Fewer steps when the queue is too deep to meet the latency target at the requested count.
+    plan = await sync_to_async(get_scheduler().plan_generation)(num_steps, service.pending)
+    try:
+        images = await service.generate(
+            prompt,
+            num_steps=plan.num_steps,
+            seed=seed,
+            timeout=settings.GENERATION_SERVICE_TIMEOUT,
+        )
+    except ServiceBusy:
+        return JsonResponse({'error': 'too many pending generations'}, status=503, headers={'Retry-After': '5'})
+    except asyncio.TimeoutError:
+        return JsonResponse({'error': 'generation timed out'}, status=504)
+
+    return JsonResponse({'images': images, 'num_steps': plan.num_steps, 'degraded': plan.degraded})
+
+
+def _job_data(job, images=()):
+    return {
+        'id': job.pk,
+        'status': job.status,
+        'num_steps': job.parameters.get('num_steps'),
+        'degraded': job.parameters.get('degraded', False),
+        'error': job.error,
+        'images': [{'id': image.pk, 'url': image.get_file_url()} for image in images],
+    }
+
+
+@require_POST
+@login_required_json
+async def submit_job(request):
+    # Queues the generation on the inference workers and answers at once; poll `job` for the images.
+    try:
+        prompt, num_steps, seed = _parse_generation(request.body)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+
+    job = await sync_to_async(submit_generation)(await request.auser(), prompt, num_steps=num_steps, seed=seed)
+    return JsonResponse(_job_data(job), status=202)
+
+
+@require_GET
+@login_required_json
+async def job_detail(request, pk):
+    user = await request.auser()
+    try:
+        job = await GenerationJob.actives.aget(pk=pk, user=user)
+    except GenerationJob.DoesNotExist:
+        raise Http404
+    images = [image async for image in GeneratedImage.actives.filter(job=job).only('id').order_by('id')]
+    return JsonResponse(_job_data(job, images))
+
+
+def _parse_range(header, size):
+    # Returns the inclusive (start, end) of a single byte range, None to send the whole file,
+    # or raises ValueError when the range cannot be satisfied.
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+def _read_chunks(file, length):
+    with file:
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+def _plan_dream(depth):
+    return get_scheduler().plan_dream(
+        settings.DEEP_DREAM_STEPS_PER_OCTAVE, range(-2, 3), settings.DEEP_DREAM_MAX_DIM, depth=depth)
+
+
+def _run_dream(content, layers, plan, progress, cancelled):
+    # Runs on the generation service, possibly in another process: reports through the `progress`
+    # queue, stops once `cancelled` is set and returns the name and bytes of the result.
+    from common.deep_dream import dream, encode_preview
+
+    img = PIL.Image.open(io.BytesIO(content)).convert('RGB')
+    img.thumbnail((plan.max_dim, plan.max_dim))
+
+    def report(octave, step, loss, chunk_img):
+        preview = encode_preview(chunk_img, settings.DEEP_DREAM_PREVIEW_SIZE)
+        progress.put({'octave': octave, 'step': step, 'loss': loss, 'preview': base64.b64encode(preview).decode()})
+
+    started = time.perf_counter()
+    result = dream(
+        np.asarray(img),
+        steps_per_octave=plan.steps_per_octave,
+        chunk_size=settings.DEEP_DREAM_CHUNK_SIZE,
+        on_chunk=report,
+        cancelled=cancelled,
+        base=settings.DEEP_DREAM_BASE_NETWORK,
+        layers=layers,
+        octaves=plan.octaves,
+    )
+    pixel_steps = plan.steps_per_octave * octave_work(plan.octaves, 1.3, 1) * img.width * img.height
+    get_scheduler().record('deep_dream', time.perf_counter() - started, pixel_steps)
+    content = get_encoder().encode(result, 'JPEG', quality=90)
+    return f'deep_dream/{hashlib.sha256(content).hexdigest()[:32]}.jpg', content
+
+
+def _drain(progress):
+    while True:
+        try:
+            yield progress.get_nowait()
+        except queue.Empty:
+            return
+
+
+async def _deep_dream_events(content, layers):
+    service = get_generation_service()
+    progress, cancelled = service.channel()
+    plan = await sync_to_async(_plan_dream)(service.pending)
+    yield _event('plan', {
+        'steps_per_octave': plan.steps_per_octave,
+        'octaves': len(plan.octaves),
+        'max_dim': plan.max_dim,
+        'degraded': plan.degraded,
+    })
+
+    run = asyncio.ensure_future(service.submit(
+        _run_dream, content, layers, plan, progress, cancelled, timeout=settings.GENERATION_SERVICE_TIMEOUT))
+    try:
+        while True:
+            # Everything reported before the run finished is sent before its result.
+            finished = run.done()
+            for data in _drain(progress):
+                yield _event('progress', data)
+            if finished:
+                break
+            await asyncio.wait({run}, timeout=PROGRESS_POLL_INTERVAL)
+
+        try:
+            name, result = run.result()
+            # The upload runs on the upload queue's threads, not the service's workers.
+            name = await asyncio.wrap_future(get_upload_queue().submit(name, result))
+            yield _event('result', {'url': default_storage.url(name)})
+        except ServiceBusy:
+            yield _event('error', {'error': 'too many pending generations'})
+        except asyncio.TimeoutError:
+            yield _event('error', {'error': 'generation timed out'})
+        except Exception:
+            logger.exception('DeepDream stream failed')
+            yield _event('error', {'error': 'generation failed'})
+    finally:
+        # The client went away or the run failed, stop at the next chunk.
+        cancelled.set()
+        run.cancel()
+
+
+@require_POST
+@login_required_json
+async def deep_dream_stream(request):
+    # Streams server-sent `progress` events with a low resolution preview per chunk,
+    # then a `result` event with the URL of the final image.
+    upload = request.FILES.get('image')
+    if upload is None:
+        return JsonResponse({'error': 'an image file is required'}, status=400)
+    # Optional comma separated layers whose activations are maximized.
+    layers = tuple(layer.strip() for layer in request.POST.get('layers', '').split(',') if layer.strip())
+    layers = layers or tuple(settings.DEEP_DREAM_LAYERS)
+    if not set(layers) <= set(settings.DEEP_DREAM_ALLOWED_LAYERS):
+        return JsonResponse({'error': 'unknown layers'}, status=400)
+
+    response = StreamingHttpResponse(_deep_dream_events(upload.read(), layers), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Ask proxies such as nginx not to buffer the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_safe
+@login_required_json
+def image_file(request, pk, variant):
+    image = get_object_or_404(GeneratedImage.actives, pk=pk, user=request.user)
+    info = image.derivatives.get(variant)
+    if info is None:
+        raise Http404
+
+    etag = f'"{info["etag"]}"'
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        # Files are named after their content, so they never change. Only their owner may see
+        # them, so shared caches must not keep them.
+        'Cache-Control': 'private, max-age=31536000, immutable',
+    }
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        return HttpResponseNotModified(headers=headers)
+
+    size = info['size']
+    range_header = request.headers.get('Range')
+    if request.headers.get('If-Range', etag) != etag:
+        range_header = None
+    try:
+        byte_range = _parse_range(range_header, size)
+    except ValueError:
+        return HttpResponse(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+    file = default_storage.open(info['name'], 'rb')
+    if byte_range is None:
+        return FileResponse(file, content_type=info['content_type'], headers=headers)
+
+    start, end = byte_range
+    file.seek(start)
+    response = StreamingHttpResponse(_read_chunks(file, end - start + 1), status=206,
+                                     content_type=info['content_type'], headers=headers)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(end - start + 1)
+    return response
+
+
+@require_GET
+@login_required_json
+def similar_images(request, pk):
+    # Only among the caller's own images.
+    image = get_object_or_404(GeneratedImage.actives, pk=pk, user=request.user)
+    if image.phash is None:
+        return JsonResponse({'results': []})
+
+    similar = (GeneratedImage.actives.filter(user=request.user)
+               .similar(image.phash, settings.PERCEPTUAL_HASH_SIMILAR_DISTANCE)
+               .exclude(pk=image.pk).only('id')[:SIMILAR_LIMIT])
+    return JsonResponse({'results': [
+        {'id': result.pk, 'url': result.get_file_url(), 'distance': result.distance} for result in similar
+    ]})
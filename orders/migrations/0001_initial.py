@@ -0,0 +1,35 @@
+# Generated by Django 5.0 on 2026-10-18 09:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('descriptions', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_time', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='created time')),
+                ('updated_time', models.DateTimeField(auto_now=True, verbose_name='updated time')),
+                ('is_active', models.BooleanField(default=True, verbose_name='is active')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('completed', 'completed'), ('failed', 'failed'), ('canceled', 'canceled')], default='pending', max_length=16, verbose_name='status')),
+                ('description', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='orders', to='descriptions.description', verbose_name='description')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='orders', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'order',
+                'verbose_name_plural': 'orders',
+                'indexes': [models.Index(fields=['user', 'status', '-created_time'], name='order_user_status_idx')],
+            },
+        ),
+    ]
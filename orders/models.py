@@ -1 +1,32 @@
+from django.conf import settings
 from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+from common.base_models import BaseModel
+
+
+class Order(BaseModel):
+    class Status(models.TextChoices):
+        PENDING = 'pending', _('pending')
+        PROCESSING = 'processing', _('processing')
+        COMPLETED = 'completed', _('completed')
+        FAILED = 'failed', _('failed')
+        CANCELED = 'canceled', _('canceled')
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('user'), related_name='orders',
+                             on_delete=models.CASCADE)
+    description = models.ForeignKey('descriptions.Description', verbose_name=_('description'),
+                                    related_name='orders', on_delete=models.PROTECT)
+    status = models.CharField(verbose_name=_('status'), max_length=16, choices=Status.choices,
+                              default=Status.PENDING)
+
+    def __str__(self):
+        return f'{self.pk} {self.status}'
+
+    class Meta(BaseModel.Meta):
+        verbose_name = _('order')
+        verbose_name_plural = _('orders')
+        indexes = [
+            *BaseModel.Meta.indexes,
+            models.Index(fields=['user', 'status', '-created_time'], name='order_user_status_idx'),
+        ]